@@ -0,0 +1,116 @@
+import numpy as np
+import time
+import argparse
+from skimage.morphology import skeletonize
+from skimage.measure import label as sl
+from utils.utils import dijkstra, convert_np_graph
+from utils.Calculate_metrics import get_region_num
+from utils.Make_tree import convert_np_tree
+from utils.Make_graph import divide_cl
+from benchmark.synthetic import make_vessel_tree
+
+'''
+中心线邻接关系的对比：稠密距离矩阵的双重循环 vs Centerline_graph稀疏邻接，检查三个函数的输出是否相同
+python -m benchmark.bench_centerline_graph --shape 160 160 128 --branch_num 4 8 12
+'''
+
+
+def dense_adj(loc, threshold):
+    # 原来的稠密距离矩阵，作为参照
+    point_nums = loc.shape[0]
+    adj = np.zeros((point_nums, point_nums))
+    for i in range(point_nums):
+        for j in range(i + 1, point_nums):
+            d = np.sqrt(np.sum((loc[i, :] - loc[j, :]) ** 2))
+            adj[i, j] = d
+    adj = adj + adj.T
+    adj[adj > threshold] = 0
+    return adj
+
+
+def convert_np_tree_dense(img):
+    x, y, z = np.where(img == 1)
+    loc = np.array([x, y, z]).T
+    adj = dense_adj(loc, 1.8)
+    leaf = [i for i in range(loc.shape[0]) if np.sum(adj[i, :] != 0) == 1]
+    adj[adj == 0] = float('inf')
+    for i in range(loc.shape[0]):
+        adj[i, i] = 0
+    if len(leaf) <= 1:
+        return None, None
+    leaf = np.array(leaf)
+    root_index = leaf[np.argmax(loc[leaf, 2])]
+    path_dict = dict()
+    for i in leaf:
+        if i != root_index:
+            path_dict[str(i)] = dijkstra(adj.copy(), root_index, i)
+    return path_dict, {'root': root_index, 'loc': loc, 'leaves': leaf}
+
+
+def convert_np_graph_dense(img):
+    x, y, z = np.where(img == 1)
+    loc = np.array([x, y, z]).T
+    adj = dense_adj(loc, np.sqrt(3))
+    leaf = np.array([i for i in range(loc.shape[0]) if np.sum(adj[i, :] != 0) == 1])
+    root_index = leaf[np.argmax(loc[leaf, 2])]
+    path_list = [root_index]
+    index = root_index
+    for i in range(loc.shape[0]):
+        neighbor = np.where(adj[index, :] != 0)[0]
+        for n in neighbor:
+            if n not in path_list:
+                path_list.append(n)
+                index = n
+    return {str(path_list[-1]): path_list}, {'root': root_index, 'loc': loc, 'leaves': leaf,
+                                             'normal': np.gradient(loc[path_list, :], axis=0)}
+
+
+def divide_cl_dense(cl):
+    x, y, z = np.where(cl == 1)
+    loc = np.array([x, y, z]).T
+    adj = dense_adj(loc, 1.8)
+    for i in range(loc.shape[0]):
+        if np.sum(adj[i, :] != 0) > 2:
+            cl[loc[i, 0], loc[i, 1], loc[i, 2]] = 0
+    return sl(cl)
+
+
+def same_dict(a, b):
+    if a is None or b is None:
+        return a is b
+    return a.keys() == b.keys() and all(np.array_equal(np.array(a[k]), np.array(b[k])) for k in a.keys())
+
+
+def branch_segment(cl):
+    # 去掉分支节点后长度最大的一段，作为convert_np_graph的输入
+    seg = divide_cl(cl.copy())
+    area = np.bincount(seg.ravel())[1:]
+    return (seg == np.argmax(area) + 1).astype(np.float64)
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--shape', type=int, nargs=3, default=[160, 160, 128])
+    p.add_argument('--branch_num', type=int, nargs='+', default=[4, 8, 12])
+    args = p.parse_args()
+
+    for branch_num in args.branch_num:
+        _, label = make_vessel_tree(tuple(args.shape), branch_num=branch_num, seed=branch_num)
+        cl = get_region_num(skeletonize(label.astype(np.uint8)).astype(np.float64), 1)
+        segment = branch_segment(cl)
+
+        t0 = time.time()
+        tree_dense = convert_np_tree_dense(cl)
+        graph_dense = convert_np_graph_dense(segment)
+        divide_dense = divide_cl_dense(cl.copy())
+        t1 = time.time()
+        tree = convert_np_tree(cl)
+        graph = convert_np_graph(segment)
+        divide = divide_cl(cl.copy())
+        t2 = time.time()
+
+        same = same_dict(tree_dense[0], tree[0]) and same_dict(tree_dense[1], tree[1]) and \
+            same_dict(graph_dense[0], graph[0]) and same_dict(graph_dense[1], graph[1]) and \
+            np.array_equal(divide_dense, divide)
+        print('points:%d | dense:%.2fs | sparse:%.2fs | speedup:%.0fx | identical:%s' % (
+            int(cl.sum()), t1 - t0, t2 - t1, (t1 - t0) / (t2 - t1), same))
@@ -0,0 +1,120 @@
+import numpy as np
+import time
+import argparse
+import torch as th
+import dgl
+from skimage.morphology import skeletonize
+from utils.utils import convert_np_graph
+from utils.Calculate_metrics import get_region_num
+from utils.Make_graph import Construct_graph, get_point_feature, get_contour, divide_cl
+from benchmark.synthetic import make_vessel_tree
+
+'''
+每段血管建图的耗时对比：逐层add_edges并逐层写节点特征 vs 所有边一次add_edges并整体写入特征
+python -m benchmark.bench_construct_graph --shape 160 160 128
+'''
+
+
+def construct_graph_loop(mk_graph, cl):
+    # 原Construct_graph.construct_graph，作为参照
+    image, contour, spacing = mk_graph.image, mk_graph.contour, mk_graph.spacing
+    tangle, radiu_stride = mk_graph.tangle, mk_graph.radiu_stride
+    path_dict, node_dict, normal_dict = convert_np_graph(cl)
+    node_path = path_dict[list(path_dict.keys())[0]]
+    loc = node_dict['loc']
+    radius_nums = 360 // tangle
+
+    node_num = loc.shape[0] * radius_nums
+    g = dgl.DGLGraph()
+    g.add_nodes(node_num)
+    g.ndata['xv'] = th.zeros(node_num, 33)
+    g.ndata['rv'] = th.zeros(node_num)
+    g.ndata['dist_map'] = th.zeros(node_num, 33)
+    g.ndata['loc'] = th.zeros(node_num, 33, 3)
+    g.ndata['layer'] = th.zeros(node_num, 1)
+    g.ndata['normal'] = th.zeros(node_num, 33, 3)
+    g.ndata['point'] = th.zeros(node_num, 33, 3)
+    g.add_edges(th.arange(0, node_num - 1), th.arange(1, node_num))
+    g.add_edges(th.arange(1, node_num), th.arange(0, node_num - 1))
+
+    point = loc[node_path, :]
+    normal = node_dict['normal'][node_path, :]
+    X_all, X_loc_all, dist_map_all = get_point_feature(point, normal, image, contour, spacing,
+                                                       radiu_stride=radiu_stride, tangle=tangle)
+    for i in range(loc.shape[0]):
+        X = X_all[i, :, :]
+        s = slice(i * radius_nums, (i + 1) * radius_nums)
+        g.ndata['xv'][s] = th.tensor(X[:, :(radiu_stride + 1)])
+        g.ndata['rv'][s] = th.tensor(X[:, -1])
+        g.ndata['dist_map'][s] = th.tensor(dist_map_all[i])
+        g.ndata['loc'][s] = th.tensor(X_loc_all[i])
+        g.ndata['layer'][s] = th.zeros(1, 1) + i
+        g.ndata['normal'][s] = th.tensor(normal[i, :])
+        g.ndata['point'][s] = th.tensor(point[i, :])
+
+        g.add_edges(i * radius_nums, (i + 1) * radius_nums - 1)
+        g.add_edges((i + 1) * radius_nums - 1, i * radius_nums)
+        if i != loc.shape[0] - 1:
+            g.add_edges(th.arange((i * radius_nums), ((i + 1) * radius_nums)),
+                        th.arange(((i + 1) * radius_nums), ((i + 2) * radius_nums)))
+            g.add_edges(th.arange(((i + 1) * radius_nums), ((i + 2) * radius_nums)),
+                        th.arange((i * radius_nums), ((i + 1) * radius_nums)))
+            g.add_edges(th.arange((i * radius_nums), ((i + 1) * radius_nums) - 1),
+                        th.arange(((i + 1) * radius_nums) + 1, ((i + 2) * radius_nums)))
+            g.add_edges(th.arange(((i + 1) * radius_nums) + 1, ((i + 2) * radius_nums)),
+                        th.arange((i * radius_nums), ((i + 1) * radius_nums) - 1))
+            g.add_edges(th.arange((i * radius_nums) + 1, ((i + 1) * radius_nums)),
+                        th.arange(((i + 1) * radius_nums), ((i + 2) * radius_nums) - 1))
+            g.add_edges(th.arange(((i + 1) * radius_nums), ((i + 2) * radius_nums) - 1),
+                        th.arange((i * radius_nums) + 1, ((i + 1) * radius_nums)))
+            g.add_edges(i * radius_nums, (i + 2) * radius_nums - 1)
+            g.add_edges((i + 2) * radius_nums - 1, i * radius_nums)
+    return g
+
+
+def same_graph(g1, g2):
+    '''
+    节点编号相同，因此同构检查即为边集合(含重边)相同；另外检查边的顺序与所有节点特征
+    :return: 边集合相同, 边顺序相同, 特征相同
+    '''
+    (s1, d1), (s2, d2) = g1.edges(), g2.edges()
+    n = g1.num_nodes()
+    iso = g1.num_nodes() == g2.num_nodes() and np.array_equal(np.sort((s1 * n + d1).numpy()),
+                                                              np.sort((s2 * n + d2).numpy()))
+    order = th.equal(s1, s2) and th.equal(d1, d2)
+    feat = g1.ndata.keys() == g2.ndata.keys() and all(
+        th.equal(th.nan_to_num(g1.ndata[k]), th.nan_to_num(g2.ndata[k])) and
+        th.equal(th.isnan(g1.ndata[k]), th.isnan(g2.ndata[k])) for k in g1.ndata)
+    return iso, order, feat
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--shape', type=int, nargs=3, default=[160, 160, 128])
+    args = p.parse_args()
+
+    image, label = make_vessel_tree(tuple(args.shape))
+    contour = get_contour(label)
+    spacing = np.array([0.5, 0.5, 0.5])
+    cl = get_region_num(skeletonize(label.astype(np.uint8)).astype(np.float64), 1)
+    cl_branch = divide_cl(cl)
+    mk_graph = Construct_graph(cl_branch, image, contour, spacing, 15)
+
+    t_old, t_new, seg_num, all_same = 0, 0, 0, True
+    for i in range(1, cl_branch.max() + 1):
+        per_lc = (cl_branch == i).astype(np.int64)
+        if per_lc.sum() <= 5:
+            continue
+        t0 = time.time()
+        g_old = construct_graph_loop(mk_graph, per_lc)
+        t1 = time.time()
+        g_new = mk_graph.construct_graph(per_lc)
+        t2 = time.time()
+        t_old, t_new, seg_num = t_old + t1 - t0, t_new + t2 - t1, seg_num + 1
+        iso, order, feat = same_graph(g_old, g_new)
+        all_same = all_same and iso and order and feat
+        print('segment:%d | nodes:%d | edges:%d | loop:%.1fms | bulk:%.1fms | isomorphic:%s | edge order:%s | '
+              'features:%s' % (i, g_new.num_nodes(), g_new.num_edges(), (t1 - t0) * 1000, (t2 - t1) * 1000,
+                               iso, order, feat))
+    print('segments:%d | loop:%.1fms/segment | bulk:%.1fms/segment | identical:%s' % (
+        seg_num, t_old * 1000 / max(seg_num, 1), t_new * 1000 / max(seg_num, 1), all_same))
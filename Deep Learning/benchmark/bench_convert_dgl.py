@@ -0,0 +1,77 @@
+import numpy as np
+import time
+import argparse
+import torch as th
+import dgl
+from utils.Make_tree import convert_dgl
+
+'''
+树转DGL图的对比：list.index查编号、has_edges_between去重并逐条add_edges vs 预先映射编号、去重后一次add_edges
+在随机生成的大树上测试，树由若干段链状分支组成，与血管中心线相同
+python -m benchmark.bench_convert_dgl --nodes 1000 5000 20000
+'''
+
+
+def convert_dgl_loop(path_set, node_data, path_dict):
+    # 原convert_dgl的建边方式，作为参照
+    path_set = path_set.tolist()
+    g = dgl.DGLGraph()
+    g.add_nodes(len(path_set))
+    for k in path_dict.keys():
+        p = path_dict[k]
+        for index in range(len(p) - 1):
+            dgl_src = path_set.index(p[index + 1])
+            dgl_dst = path_set.index(p[index])
+            if g.has_edges_between(dgl_src, dgl_dst):
+                continue
+            g.add_edges(dgl_src, dgl_dst)
+    for key, value in node_data.items():
+        g.ndata[key] = th.tensor(value)
+    return g
+
+
+def random_tree(node_num, seed=0):
+    '''
+    随机的血管状树：从根开始的一条链，之后每段分支从已有节点上长出，长度50~300，节点编号随机打乱
+    :return: path_set, path_dict 与convert_np_tree得到的形式相同
+    '''
+    rs = np.random.RandomState(seed)
+    parent = [-1]
+    is_leaf = [True]
+    while len(parent) < node_num:
+        n = len(parent)
+        start = 0 if n == 1 else rs.randint(0, n)
+        length = min(rs.randint(50, 300), node_num - n)
+        for i in range(length):
+            p = start if i == 0 else n + i - 1
+            is_leaf[p] = False
+            parent.append(p)
+            is_leaf.append(True)
+    name = rs.permutation(node_num * 3)[:node_num]
+    path_dict = dict()
+    for leaf in np.where(is_leaf)[0]:
+        path = [leaf]
+        while parent[path[-1]] != -1:
+            path.append(parent[path[-1]])
+        path_dict[str(name[leaf])] = [int(name[i]) for i in path[::-1]]
+    return np.unique(name), path_dict
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--nodes', type=int, nargs='+', default=[1000, 5000, 20000])
+    args = p.parse_args()
+
+    for node_num in args.nodes:
+        path_set, path_dict = random_tree(node_num)
+        node_data = {'origin': np.arange(node_num * 3).reshape(node_num, 3)}
+        t0 = time.time()
+        g_old = convert_dgl_loop(path_set, node_data, path_dict)
+        t1 = time.time()
+        g_new = convert_dgl(path_set, node_data, path_dict)
+        t2 = time.time()
+        same = g_old.num_nodes() == g_new.num_nodes() and all(
+            th.equal(a, b) for a, b in zip(g_old.edges(), g_new.edges())) and th.equal(
+            g_old.ndata['origin'], g_new.ndata['origin'])
+        print('nodes:%d | paths:%d | edges:%d | loop:%.2fs | mapped:%.4fs | identical:%s' % (
+            node_num, len(path_dict), g_new.num_edges(), t1 - t0, t2 - t1, same))
@@ -0,0 +1,79 @@
+import numpy as np
+import time
+import argparse
+import torch as th
+import dgl
+from skimage.morphology import skeletonize
+from utils.Calculate_metrics import get_region_num
+from utils.Make_tree import convert_np_tree, get_picture3d, patch_origin, get_patches, convert_dgl, recover_img
+from benchmark.synthetic import make_vessel_tree
+
+'''
+树结构3D块的对比：逐节点生成[img, label, i, j, k]再逐节点写入图 vs 只保存块起点、一次取出所有块并一次写入
+python -m benchmark.bench_convert_tree --shape 256 256 160 --patch_size 16 16 4
+'''
+
+
+def convert_dgl_loop(path_set, img_list, path_dict):
+    # 原convert_dgl，作为参照
+    path_set = path_set.tolist()
+    g = dgl.DGLGraph()
+    g.add_nodes(len(path_set))
+    for k in path_dict.keys():
+        p = path_dict[k]
+        for index in range(len(p) - 1):
+            dgl_src = path_set.index(p[index + 1])
+            dgl_dst = path_set.index(p[index])
+            if g.has_edges_between(dgl_src, dgl_dst):
+                continue
+            g.add_edges(dgl_src, dgl_dst)
+            for n in [dgl_src, dgl_dst]:
+                g.nodes[n].data['data'] = th.tensor(np.expand_dims(img_list[n, 0, :, :, :], axis=0))
+                g.nodes[n].data['label'] = th.tensor(np.expand_dims(img_list[n, 1, :, :, :], axis=0))
+                g.nodes[n].data['loc'] = th.tensor(np.expand_dims(img_list[n, 2:5, :, :, :], axis=0))
+    return g
+
+
+def ndata_bytes(g):
+    return sum(v.numel() * v.element_size() for v in g.ndata.values())
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--shape', type=int, nargs=3, default=[256, 256, 160])
+    p.add_argument('--patch_size', type=int, nargs=3, default=[16, 16, 4])
+    args = p.parse_args()
+    patch_size = tuple(args.patch_size)
+
+    image, label = make_vessel_tree(tuple(args.shape))
+    # 与CT相同取整数值，float32可以精确表示
+    image = np.round(image * 1000)
+    cl = get_region_num(skeletonize(label.astype(np.uint8)).astype(np.float64), 1)
+    path_dict, node_dict = convert_np_tree(cl)
+    path_list = []
+    for k in path_dict.keys():
+        path_list = path_list + path_dict[k]
+    path_set = np.unique(np.array(path_list))
+
+    t0 = time.time()
+    img_list = np.array([get_picture3d(node_dict['loc'][i, :], image, label, patch_size) for i in path_set])
+    g_old = convert_dgl_loop(path_set, img_list, path_dict)
+    t1 = time.time()
+    img32, label32 = image.astype(np.float32), label.astype(np.float32)
+    origin = patch_origin(node_dict['loc'][path_set, :], image.shape, patch_size)
+    node_data = {'data': get_patches(img32, origin, patch_size), 'label': get_patches(label32, origin, patch_size),
+                 'origin': origin}
+    g_new = convert_dgl(path_set, node_data, path_dict)
+    t2 = time.time()
+
+    same_edges = all(th.equal(a, b) for a, b in zip(g_old.edges(), g_new.edges()))
+    same_data = all(np.array_equal(g_old.ndata[k].numpy(), g_new.ndata[k].numpy()) for k in ['data', 'label'])
+    old_bytes, new_bytes = ndata_bytes(g_old), ndata_bytes(g_new)
+    # 恢复时由起点得到的坐标与原来保存的坐标相同
+    pre = np.random.RandomState(0).rand(g_new.num_nodes(), 1, *patch_size)
+    g_old.ndata['pre_label'] = th.tensor(pre)
+    g_new.ndata['pre_label'] = th.tensor(pre)
+    same_recover = np.array_equal(recover_img(g_old, image), recover_img(g_new, image))
+    print('nodes:%d | loop:%.2fs %.1fMB (img_list %.1fMB) | bulk:%.2fs %.1fMB | identical:%s' % (
+        g_new.num_nodes(), t1 - t0, old_bytes / 1024 ** 2, img_list.nbytes / 1024 ** 2, t2 - t1,
+        new_bytes / 1024 ** 2, same_edges and same_data and same_recover))
@@ -0,0 +1,114 @@
+import numpy as np
+import os
+import time
+import argparse
+import tempfile
+import multiprocessing
+import nibabel as nib
+from utils.Recover_patch import Recover_patch
+from utils.Crop_box import Recover_Crop
+from utils.Calculate_metrics import Cal_metrics
+from utils.Executor import Executor, Volume_slots
+from benchmark.synthetic import make_vessel_tree
+
+'''
+patch_seg.py推断之后三个阶段(恢复patch、恢复裁剪、计算指标)的对比：
+每个阶段新建Pool并从gzip读取上一阶段的结果 vs 常驻进程池+共享内存中的图像
+计算指标的耗时主要在距离变换上，单个图像读取的对比单独列出
+python -m benchmark.bench_executor --shape 192 192 128 --cases 16 --pools 4
+'''
+
+
+class Save_pre:
+    def __init__(self, recover, prob_path):
+        # 代替由patch融合得到的概率图，只保留Recover_patch.save这一步
+        self.recover = recover
+        self.prob_path = prob_path
+
+    def __call__(self, i):
+        self.recover.save(i, np.load(os.path.join(self.prob_path, i + '.npy')), np.eye(4))
+
+
+def fresh_pool(pools, func, id_list):
+    # 原来每个阶段的方式
+    p = multiprocessing.Pool(pools)
+    r = p.map(func, id_list)
+    p.close()
+    p.join()
+    return r
+
+
+def stages(tmp, name, id_list, crop_dict, slots):
+    pre_path = os.path.join(tmp, name)
+    recover = Recover_patch(32, None, None, pre_path, os.path.join(tmp, 'crop'), save_file_name='pre_crop.nii.gz',
+                            slots=slots)
+    return [Save_pre(recover, os.path.join(tmp, 'prob')),
+            Recover_Crop(pre_path, os.path.join(tmp, 'img'), crop_dict, slots=slots).run,
+            Cal_metrics(pre_path, os.path.join(tmp, 'crop'), slots=slots).calculate_dice]
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--shape', type=int, nargs=3, default=[192, 192, 128])
+    p.add_argument('--cases', type=int, default=16)
+    p.add_argument('--pools', type=int, default=4)
+    args = p.parse_args()
+
+    shape = tuple(args.shape)
+    rng = np.random.RandomState(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        id_list = ['case_%d' % n for n in range(args.cases)]
+        box = []
+        for n, i in enumerate(id_list):
+            image, label = make_vessel_tree(shape, seed=n)
+            # 模拟推断得到的概率图：标签上加噪声
+            prob = np.clip(label + rng.normal(0, 0.3, shape), 0, 1).astype(np.float32)
+            os.makedirs(os.path.join(tmp, 'prob'), exist_ok=True)
+            np.save(os.path.join(tmp, 'prob', i + '.npy'), prob)
+            # 原图像带噪声，与CT一样gzip压缩率低，读取较慢
+            image = np.round(image * 1000 + rng.normal(0, 20, shape))
+            for d, v in [('crop', label), ('img', np.pad(image, 8))]:
+                os.makedirs(os.path.join(tmp, d, i), exist_ok=True)
+                nib.save(nib.Nifti1Image(v, np.eye(4)), os.path.join(tmp, d, i, 'img.nii.gz'))
+            nib.save(nib.Nifti1Image(label, np.eye(4)), os.path.join(tmp, 'crop', i, 'label.nii.gz'))
+            box.append([8, 8, 8] + [s + 8 for s in shape])
+        crop_dict = {'ID': id_list, 'box': box}
+
+        t_fresh = []
+        for func in stages(tmp, 'fresh', id_list, crop_dict, None):
+            t0 = time.time()
+            ref = fresh_pool(args.pools, func, id_list)
+            t_fresh.append(time.time() - t0)
+
+        executor = Executor(args.pools)
+        t_shared = []
+        for func in stages(tmp, 'shared', id_list, crop_dict, executor.slots):
+            t0 = time.time()
+            out = executor.map(func, id_list)
+            t_shared.append(time.time() - t0)
+        print(executor.report())
+        executor.close()
+
+        same = np.allclose(np.array(ref), np.array(out))
+        for i in id_list:
+            a = nib.load(os.path.join(tmp, 'fresh', i, 'pre_label.nii.gz')).get_fdata()
+            b = nib.load(os.path.join(tmp, 'shared', i, 'pre_label.nii.gz')).get_fdata()
+            same = same and np.array_equal(a, b)
+        # 单个图像的读取：gzip解压 vs 共享内存；原图像在恢复裁剪中只需要头文件
+        slots = Volume_slots()
+        for d, name in [('fresh', 'pre_label.nii.gz'), ('crop', 'label.nii.gz'), ('img', 'img.nii.gz')]:
+            path = os.path.join(tmp, d, id_list[0], name)
+            slots.load(path)
+            t0 = time.time()
+            nib.load(path).get_fdata()
+            t1 = time.time()
+            slots.load(path)[0].astype(np.float64)
+            t2 = time.time()
+            nib.load(path).shape
+            t3 = time.time()
+            print('%s | gzip:%.3fs | shared memory:%.3fs | header only:%.4fs' % (name, t1 - t0, t2 - t1, t3 - t2))
+        slots.clear()
+        for stage, a, b in zip(['recover patch', 'recover crop', 'metrics'], t_fresh, t_shared):
+            print('%s | fresh pool:%.2fs | executor+shared memory:%.2fs' % (stage, a, b))
+        print('shape:%s | cases:%d | fresh pool:%.2fs | executor+shared memory:%.2fs | speedup:%.2fx | identical:%s' % (
+            shape, args.cases, sum(t_fresh), sum(t_shared), sum(t_fresh) / sum(t_shared), same))
@@ -0,0 +1,75 @@
+import numpy as np
+import time
+import argparse
+from utils.utils import loc_convert, extract_slice
+from benchmark.synthetic import make_vessel_tree
+
+'''
+斜切片提取的对比：逐节点expm旋转与逐像素循环 vs Rodrigues批量旋转与一次取值
+python -m benchmark.bench_extract_slice --shape 160 160 128 --node_num 500 2000
+'''
+
+
+def extract_slice_loop(img, c, v, radius):
+    # 原extract_slice，作为参照
+    N = v.shape[0]
+    epsilon = 1e-12
+    x = np.arange(-radius, radius, 1)
+    y = np.arange(-radius, radius, 1)
+    X, Y = np.meshgrid(x, y)
+    Z = np.zeros_like(X)
+    loc = np.array([X.flatten(), Y.flatten(), Z.flatten()])
+    h_v = np.array([0, 0, 1]) / 1.0
+    h_v[h_v == 0] = epsilon
+    v = v / np.linalg.norm(v, axis=1).reshape(N, 1)
+    v[v == 0] = epsilon
+    loc = loc_convert(loc, [0, 0, 1], 0)
+    hspVecXvec = np.cross(h_v, v) / np.linalg.norm(np.cross(h_v, v), axis=1).reshape(v.shape[0], 1)
+    h_v = h_v[np.newaxis, :]
+    acosineVal = np.arccos(np.dot(v, h_v.T))
+    hspVecXvec[np.isnan(hspVecXvec)] = epsilon
+    acosineVal[np.isnan(acosineVal)] = epsilon
+    loc_arr = np.array([loc_convert(loc, hspVecXvec[i, :], 180 * acosineVal[i, :] / np.pi) for i in range(N)])
+    sub_loc = loc_arr + c[:, :, np.newaxis]
+    loc = np.round(sub_loc)
+    loc = np.reshape(loc, (N, 3, X.shape[0], X.shape[1]))
+    slicer = np.zeros((N, X.shape[0], X.shape[1]))
+    for i in range(X.shape[0]):
+        for j in range(X.shape[1]):
+            ll = loc[:, :, i, j]
+            flag = (0 <= ll[:, 0]) & (ll[:, 0] < img.shape[0]) & (0 <= ll[:, 1]) & (ll[:, 1] < img.shape[1]) & (
+                    0 <= ll[:, 2]) & (ll[:, 2] < img.shape[2])
+            slicer[flag, i, j] = img[ll[flag, 0].astype(int), ll[flag, 1].astype(int), ll[flag, 2].astype(int)]
+    loc = np.transpose(loc, axes=(0, 2, 3, 1))
+    loc[loc[:, :, :, 0] >= img.shape[0], 0] = 0
+    loc[loc[:, :, :, 1] >= img.shape[1], 1] = 0
+    loc[loc[:, :, :, 2] >= img.shape[2], 2] = 0
+    loc = np.transpose(loc, axes=(0, 3, 1, 2))
+    loc[loc < 0] = 0
+    return slicer, sub_loc, loc.astype(int)
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--shape', type=int, nargs=3, default=[160, 160, 128])
+    p.add_argument('--node_num', type=int, nargs='+', default=[500, 2000])
+    p.add_argument('--radius', type=int, default=32)
+    args = p.parse_args()
+
+    _, label = make_vessel_tree(tuple(args.shape))
+    rng = np.random.RandomState(0)
+    for node_num in args.node_num:
+        center = np.argwhere(label > 0)[rng.randint(0, int((label > 0).sum()), node_num)]
+        normal = rng.randn(node_num, 3)
+        # 包含与坐标轴平行的法向量，与recover_node中的用法相同
+        normal[:node_num // 4] = np.eye(3)[rng.randint(0, 3, node_num // 4)]
+
+        t0 = time.time()
+        old = extract_slice_loop(label, center, normal, args.radius)
+        t1 = time.time()
+        new = extract_slice(label, center, normal, args.radius)
+        t2 = time.time()
+        same = np.array_equal(old[0], new[0]) and np.array_equal(old[2], new[2]) and \
+            np.allclose(old[1], new[1], atol=1e-9)
+        print('nodes:%d | loop:%.2fs | batched:%.3fs | speedup:%.0fx | identical:%s' % (
+            node_num, t1 - t0, t2 - t1, (t1 - t0) / (t2 - t1), same))
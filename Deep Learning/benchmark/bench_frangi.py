@@ -0,0 +1,117 @@
+import numpy as np
+import nibabel as nib
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import argparse
+import resource
+from scipy.ndimage import distance_transform_edt
+from utils.Frangi_filter import Frangi, Frangi_engine
+from benchmark.synthetic import make_vessel_tree
+
+'''
+Frangi滤波的对比：skimage对整幅float64图像滤波 vs 分块float32引擎 vs 只在粗分割膨胀区域内计算
+每种方式在单独的进程中运行，分别统计耗时与内存峰值，并与skimage的结果比较(整幅图像，包括边界)
+box:只在两个部分重叠的裁剪框(模拟不同fold的粗分割)内计算，第二个框复用tile缓存，结果与整幅图像滤波后裁剪比较
+默认--truncate 8(halo为34)；--truncate 0与skimage的高斯核截断完全相同(sigma=1时halo为142)，很慢，两者结果相同；
+与skimage只在Hessian为float32时的舍入上不同，个别特征值接近0的体素差约3e-4，其余约1e-5
+python -m benchmark.bench_frangi --shape 256 256 160 --roi_radius 10
+'''
+
+
+def peak_rss():
+    # 与utils.Inference_patch.peak_rss相同，这里不引入torch
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM'):
+                    return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def crop_boxes(label, shape):
+    # 标签的包围框，以及向一侧平移1/8的框
+    x, y, z = np.where(label > 0)
+    box = [x.min(), y.min(), z.min(), x.max() + 1, y.max() + 1, z.max() + 1]
+    shift = [s // 8 for s in shape]
+    moved = [max(0, b - d) for b, d in zip(box[:3], shift)] + [max(1, b - d) for b, d in zip(box[3:], shift)]
+    return [[int(b) for b in box], [int(b) for b in moved]]
+
+
+def run_box(args):
+    label = np.asarray(nib.load(os.path.join(args.work_dir, 'case', 'pre_label.nii.gz')).dataobj)
+    opt = Frangi(args.work_dir, os.path.join(args.work_dir, 'box'), engine=Frangi_engine(
+        block_size=tuple(args.block_size), truncate=args.truncate), cache_path=os.path.join(args.work_dir, 'cache'))
+    result = []
+    for b, box in enumerate(crop_boxes(label, label.shape)):
+        opt.enhance_name = 'frangi_%d.nii.gz' % b
+        t0 = time.time()
+        opt.run_box('case', box)
+        result.append(time.time() - t0)
+    print('box %f %f %f' % (result[0], result[1], peak_rss()))
+
+
+def run_mode(args):
+    if args.mode == 'box':
+        run_box(args)
+        return
+    engine = None if args.mode == 'skimage' else Frangi_engine(block_size=tuple(args.block_size),
+                                                                truncate=args.truncate)
+    roi_path = args.work_dir if args.mode == 'roi' else None
+    opt = Frangi(args.work_dir, os.path.join(args.work_dir, args.mode), engine=engine, roi_path=roi_path,
+                 roi_radius=args.roi_radius)
+    t0 = time.time()
+    opt.run_enhance('case')
+    print('%s %f %f' % (args.mode, time.time() - t0, peak_rss()))
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--shape', type=int, nargs=3, default=[256, 256, 160])
+    p.add_argument('--block_size', type=int, nargs=3, default=[128, 128, 32])
+    p.add_argument('--roi_radius', type=int, default=10)
+    p.add_argument('--truncate', type=float, default=8, help='0:与skimage的截断完全相同')
+    p.add_argument('--mode', type=str, default='')
+    p.add_argument('--work_dir', type=str, default='')
+    args = p.parse_args()
+    args.truncate = args.truncate if args.truncate > 0 else None
+
+    if args.mode:
+        run_mode(args)
+        sys.exit()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        img, label = make_vessel_tree(tuple(args.shape))
+        os.makedirs(os.path.join(work_dir, 'case'))
+        nib.save(nib.Nifti1Image(img.astype(np.int16), np.eye(4)), os.path.join(work_dir, 'case', 'img.nii.gz'))
+        nib.save(nib.Nifti1Image(label.astype(np.uint8), np.eye(4)),
+                 os.path.join(work_dir, 'case', 'pre_label.nii.gz'))
+        modes = ['skimage', 'block', 'roi', 'box']
+        result = dict()
+        for mode in modes:
+            out = subprocess.run([sys.executable, '-m', 'benchmark.bench_frangi', '--mode', mode,
+                                  '--work_dir', work_dir, '--roi_radius', str(args.roi_radius),
+                                  '--block_size'] + [str(s) for s in args.block_size] +
+                                 ['--truncate', '0' if args.truncate is None else str(args.truncate)],
+                                 stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+            result[mode] = out.strip().split('\n')[-1].split()[1:]
+        v = {m: nib.load(os.path.join(work_dir, m, 'case', 'frangi.nii.gz')).get_fdata(dtype=np.float32)
+             for m in modes[:3]}
+        inner = tuple(slice(16, -16) for _ in range(3))
+        roi = distance_transform_edt(label == 0) <= args.roi_radius
+        for mode in modes[:3]:
+            print('%s | %.2fs | peak RSS:%.0fMB' % (mode, float(result[mode][0]), float(result[mode][1])))
+        same = True
+        for b, box in enumerate(crop_boxes(label, label.shape)):
+            crop = nib.load(os.path.join(work_dir, 'box', 'case', 'frangi_%d.nii.gz' % b)).get_fdata(dtype=np.float32)
+            same = same and np.array_equal(crop, v['block'][box[0]:box[3], box[1]:box[4], box[2]:box[5]])
+        print('box | first box:%.2fs | overlapping box:%.2fs | peak RSS:%.0fMB | identical to block crop:%s' % (
+            float(result['box'][0]), float(result['box'][1]), float(result['box'][2]), same))
+        print('block vs skimage | max abs diff:%.2e | interior max abs diff:%.2e | corr:%.6f' % (
+            np.abs(v['block'] - v['skimage']).max(), np.abs(v['block'] - v['skimage'])[inner].max(),
+            np.corrcoef(v['block'].ravel(), v['skimage'].ravel())[0, 1]))
+        # roi方式的gamma只在roi内统计，与整幅图像的结果只比较相关性
+        print('roi | volume fraction:%.3f | outside max:%.4f | corr with block inside roi:%.4f' % (
+            roi.mean(), np.abs(v['roi'][~roi]).max(), np.corrcoef(v['roi'][roi], v['block'][roi])[0, 1]))
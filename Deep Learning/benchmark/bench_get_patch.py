@@ -0,0 +1,82 @@
+import numpy as np
+import time
+import argparse
+from skimage.morphology import skeletonize
+from utils.Get_patch import get_patch
+from benchmark.synthetic import make_vessel_tree
+
+'''
+逐体素循环与批量中心线采样的对比
+python -m benchmark.bench_get_patch --shape 512 512 256
+'''
+
+
+def get_patch_loop(image, label, enhance, patch_size):
+    # 原逐体素循环版本，作为参照
+    flag_label = label
+    shape = np.array(flag_label.shape)
+    loc_record = []
+    flag_record = skeletonize(flag_label.astype(np.uint8))
+    i, j, k = np.where(flag_record == 1)
+    pos = 0
+    neg = 0
+    for index in range(i.shape[0]):
+        if flag_record[i[index], j[index], k[index]] == 1:
+            c = np.array([i[index], j[index], k[index]])
+            s = c - patch_size // 2
+            e = c + patch_size // 2
+            z_s = np.zeros_like(s)
+            e[s < z_s] = patch_size
+            s[s < z_s] = 0
+            s[e > shape] = shape[e > shape] - patch_size
+            e[e > shape] = shape[e > shape]
+            loc_record.append(s)
+            flag_record[s[0]:e[0], s[1]:e[1], s[2]:e[2]] = 0
+            pos = pos + 1
+    x = np.arange(patch_size // 2, shape[0], patch_size)
+    y = np.arange(patch_size // 2, shape[1], patch_size)
+    z = np.arange(patch_size // 2, shape[2], patch_size)
+    i, j, k = np.meshgrid(x, y, z)
+    i, j, k = i.flatten(), j.flatten(), k.flatten()
+    arr = np.arange(i.shape[0])
+    np.random.shuffle(arr)
+    for index in arr.tolist():
+        c = np.array([i[index], j[index], k[index]])
+        s = c - patch_size // 2
+        e = c + patch_size // 2
+        z_s = np.zeros_like(s)
+        e[s < z_s] = patch_size
+        s[s < z_s] = 0
+        s[e > shape] = shape[e > shape] - patch_size
+        e[e > shape] = shape[e > shape]
+        if label[s[0]:e[0], s[1]:e[1], s[2]:e[2]].sum() == 0:
+            loc_record.append(s)
+            neg = neg + 1
+        if neg >= pos:
+            break
+    return loc_record
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--shape', type=int, nargs=3, default=[512, 512, 256])
+    p.add_argument('--branch_num', type=int, default=16)
+    p.add_argument('--cases', type=int, default=3)
+    p.add_argument('--patch_size', type=int, default=32)
+    args = p.parse_args()
+
+    for seed in range(args.cases):
+        image, label = make_vessel_tree(args.shape, args.branch_num, seed=seed)
+
+        np.random.seed(seed)
+        t0 = time.time()
+        loop_record = get_patch_loop(image, label, image, args.patch_size)
+        t1 = time.time()
+
+        np.random.seed(seed)
+        _, _, _, batch_record = get_patch(image, label, image, args.patch_size)
+        t2 = time.time()
+
+        same = np.array_equal(np.array(loop_record), np.array(batch_record))
+        print('case %d | patches:%d | loop:%.3fs | batch:%.3fs | speedup:%.1fx | identical:%s' % (
+            seed, len(batch_record), t1 - t0, t2 - t1, (t1 - t0) / (t2 - t1), same))
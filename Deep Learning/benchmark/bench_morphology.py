@@ -0,0 +1,71 @@
+import numpy as np
+import time
+import argparse
+from scipy.ndimage import binary_dilation
+from skimage.morphology import skeletonize
+from utils.Calculate_metrics import get_region_num
+from utils.Morphology import mask_box, ball_dilation, skeleton
+from benchmark.synthetic import make_vessel_tree
+
+'''
+Morphology_process的对比：binary_dilation+球形结构元并对整幅图像做连通域与skeletonize vs
+可分离的平方距离变换膨胀，连通域与中心线只在包围盒内计算(uint8)
+python -m benchmark.bench_morphology --shape 512 512 256 --se_size 3 5 7 9
+python -m benchmark.bench_morphology --shape 512 512 256 --se_size 3 5 7 9 --dense_max 5  # 参照版本在大半径时需要数分钟
+'''
+
+
+def generate_sphere3d(r):
+    # 与morphology_process.generate_sphere3d相同，这里不引入utils.utils
+    d = 2 * r + 1
+    x, y, z = np.meshgrid(np.arange(d), np.arange(d), np.arange(d), indexing='ij')
+    d_c = np.sqrt((x - r) ** 2 + (y - r) ** 2 + (z - r) ** 2)
+    S = np.zeros_like(d_c)
+    S[x[d_c <= r], y[d_c <= r], z[d_c <= r]] = 1
+    return S
+
+
+def process_dense(pre_label, se_size, con_num):
+    # 原Morphology_process.process中的方式，作为参照
+    d_img = binary_dilation(pre_label, generate_sphere3d(se_size))
+    d_img = get_region_num(d_img, con_num)
+    cl_img = skeletonize(d_img.astype(np.uint8))
+    return d_img, cl_img
+
+
+def process_edt(pre_label, se_size, con_num):
+    d_img = ball_dilation(pre_label, se_size)
+    box = mask_box(d_img)
+    if box is not None:
+        d_img[box] = get_region_num(d_img[box], con_num)
+    return d_img, skeleton(d_img)
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--shape', type=int, nargs=3, default=[512, 512, 256])
+    p.add_argument('--se_size', type=int, nargs='+', default=[3, 5, 7, 9])
+    p.add_argument('--con_num', type=int, default=2)
+    p.add_argument('--noise', type=float, default=0.0002)
+    p.add_argument('--dense_max', type=int, default=9)
+    args = p.parse_args()
+
+    # 血管树加上随机散点，模拟粗分割结果
+    image, label = make_vessel_tree(tuple(args.shape))
+    rng = np.random.RandomState(0)
+    pre_label = (label > 0) | (rng.rand(*args.shape) < args.noise)
+    print('shape:%s | foreground:%.4f' % (tuple(args.shape), pre_label.mean()))
+
+    for se_size in args.se_size:
+        t0 = time.time()
+        d_edt, cl_edt = process_edt(pre_label, se_size, args.con_num)
+        t_edt = time.time() - t0
+        if se_size > args.dense_max:
+            print('se_size:%d | edt:%.2fs | dense skipped' % (se_size, t_edt))
+            continue
+        t0 = time.time()
+        d_dense, cl_dense = process_dense(pre_label, se_size, args.con_num)
+        t_dense = time.time() - t0
+        same = np.array_equal(d_dense != 0, d_edt != 0) and np.array_equal(cl_dense != 0, cl_edt != 0)
+        print('se_size:%d | dense:%.2fs | edt:%.2fs | speedup:%.1fx | identical:%s' % (
+            se_size, t_dense, t_edt, t_dense / t_edt, same))
@@ -0,0 +1,114 @@
+import numpy as np
+import nibabel as nib
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import argparse
+import multiprocessing
+import resource
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from model.CNN_model import Unet_Patch
+from data.Patch_loader import CoronaryPatchOnline
+from utils.Get_patch import load_patch_record
+from utils.Recover_patch import Patch_blender
+from utils.Inference_patch import Patch_inference, peak_rss
+from benchmark.synthetic import make_vessel_tree
+from patch_seg import inference
+
+'''
+验证集推断的对比：逐patch保存pre_patch再由进程池融合 vs 按病例滑窗推断并在内存中融合
+每种方式在单独的进程中运行，分别统计cases/s与内存峰值
+python -m benchmark.bench_patch_inference --case_num 4 --shape 128 128 96 --patch_size 32
+'''
+
+
+def recover_case(pre_patch_path, record_path, crop_path, save_path, patch_size, id):
+    # 与Recover_patch.run_recover相同的读回与融合过程，作为参照
+    name, loc = load_patch_record(record_path, id)
+    shape = nib.load(os.path.join(crop_path, id, 'img.nii.gz')).shape
+    blender = Patch_blender(shape, patch_size)
+    affine = None
+    for i, s in zip(name, loc):
+        p_nii = nib.load(os.path.join(pre_patch_path, i))
+        affine = p_nii.affine
+        blender.add(p_nii.get_fdata(dtype=np.float32), s)
+    os.makedirs(os.path.join(save_path, id), exist_ok=True)
+    nib.save(nib.Nifti1Image((blender.result() > 0.5).astype(np.float32), affine),
+             os.path.join(save_path, id, 'pre_crop.nii.gz'))
+
+
+def run_path(args):
+    torch.manual_seed(0)
+    torch.set_num_threads(args.threads)
+    # 默认用单层卷积，使对比集中在patch读写与融合上
+    net = (Unet_Patch(3, 1) if args.model == 'unet' else nn.Conv3d(1, 1, 3, 1, 1)).eval()
+    ID_list = sorted(os.listdir(os.path.join(args.work_dir, 'crop')))
+    crop_path = os.path.join(args.work_dir, 'crop')
+    record_path = os.path.join(args.work_dir, 'record')
+    save_path = os.path.join(args.work_dir, 'pre_label_%s' % args.path)
+
+    t0 = time.time()
+    if args.path == 'patch':
+        pre_patch_path = os.path.join(args.work_dir, 'pre_patch')
+        valid_set = CoronaryPatchOnline(crop_path, ID_list, args.patch_size, 'grid', record_dir=record_path)
+        valid_loader = DataLoader(valid_set, args.batch_size, shuffle=False, num_workers=2)
+        inference(net, [], valid_loader, torch.device('cpu'), pre_patch_path)
+        p = multiprocessing.Pool(4)
+        p.starmap(recover_case, [(pre_patch_path, record_path, crop_path, save_path, args.patch_size, i)
+                                 for i in ID_list])
+        p.close()
+        p.join()
+    else:
+        window = Patch_inference(net, torch.device('cpu'), crop_path, save_path, args.patch_size, args.batch_size,
+                                 record_path=record_path)
+        window.run_all(ID_list)
+    t = time.time() - t0
+    # 进程池中的子进程也计入内存峰值
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print('%s %f %f' % (args.path, len(ID_list) / t, max(peak_rss(), children)))
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--case_num', type=int, default=4)
+    p.add_argument('--shape', type=int, nargs=3, default=[128, 128, 96])
+    p.add_argument('--patch_size', type=int, default=32)
+    p.add_argument('--batch_size', type=int, default=16)
+    p.add_argument('--threads', type=int, default=4)
+    p.add_argument('--model', type=str, default='conv')
+    p.add_argument('--path', type=str, default='')
+    p.add_argument('--work_dir', type=str, default='')
+    args = p.parse_args()
+
+    if args.path:
+        run_path(args)
+        sys.exit()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        for c in range(args.case_num):
+            img, label = make_vessel_tree(tuple(args.shape), seed=c)
+            os.makedirs(os.path.join(work_dir, 'crop', 'case%d' % c))
+            nib.save(nib.Nifti1Image(img.astype(np.float32), np.eye(4)),
+                     os.path.join(work_dir, 'crop', 'case%d' % c, 'img.nii.gz'))
+            nib.save(nib.Nifti1Image(label.astype(np.float32), np.eye(4)),
+                     os.path.join(work_dir, 'crop', 'case%d' % c, 'label.nii.gz'))
+        result = dict()
+        for path in ['patch', 'window']:
+            out = subprocess.run([sys.executable, '-m', 'benchmark.bench_patch_inference', '--path', path,
+                                  '--work_dir', work_dir, '--patch_size', str(args.patch_size),
+                                  '--batch_size', str(args.batch_size), '--threads', str(args.threads),
+                                  '--model', args.model],
+                                 stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+            result[path] = out.strip().split('\n')[-1].split()[1:]
+        same = True
+        for c in range(args.case_num):
+            a = nib.load(os.path.join(work_dir, 'pre_label_patch', 'case%d' % c, 'pre_crop.nii.gz')).get_fdata()
+            b = nib.load(os.path.join(work_dir, 'pre_label_window', 'case%d' % c, 'pre_crop.nii.gz')).get_fdata()
+            same = same and np.array_equal(a, b)
+        for path in ['patch', 'window']:
+            print('%s | %.3f cases/s | peak RSS:%.0fMB' % (path, float(result[path][0]), float(result[path][1])))
+        print('identical:%s' % same)
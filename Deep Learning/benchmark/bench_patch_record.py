@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import os
+import time
+import tempfile
+import argparse
+from utils.Get_patch import save_patch_record, load_patch_record
+
+'''
+patch位置记录的写出时间对比：逐行增加DataFrame并每次to_csv vs 一次写出
+python -m benchmark.bench_patch_record --patch_num 2000 4000
+'''
+
+
+def save_record_loop(save_path, ID, loc_record):
+    # 原来在每个patch之后重写整个csv的方式，作为参照
+    df = pd.DataFrame(columns=['x', 'y', 'z'])
+    for index in range(len(loc_record)):
+        df.loc[ID + '_%d.nii.gz' % index] = [loc_record[index][0], loc_record[index][1], loc_record[index][2]]
+        df.to_csv(os.path.join(save_path, ID + '.csv'))
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--patch_num', type=int, nargs='+', default=[500, 2000, 4000])
+    args = p.parse_args()
+
+    rng = np.random.RandomState(0)
+    for num in args.patch_num:
+        loc_record = list(rng.randint(0, 400, (num, 3)))
+        with tempfile.TemporaryDirectory() as loop_dir, tempfile.TemporaryDirectory() as record_dir:
+            t0 = time.time()
+            save_record_loop(loop_dir, 'case', loc_record)
+            t1 = time.time()
+            save_patch_record(record_dir, 'case', loc_record, 'csv')
+            t2 = time.time()
+            save_patch_record(record_dir, 'case', loc_record, 'npz')
+            t3 = time.time()
+
+            loop_df = pd.read_csv(os.path.join(loop_dir, 'case.csv'), index_col=0)
+            name, loc = load_patch_record(record_dir, 'case')
+            same = np.array_equal(loop_df.index.to_numpy(), name) and np.array_equal(loop_df.to_numpy(), loc)
+            print('patches:%d | loop csv:%.3fs | csv once:%.4fs | npz once:%.4fs | speedup:%.0fx | identical:%s' % (
+                num, t1 - t0, t2 - t1, t3 - t2, (t1 - t0) / (t2 - t1), same))
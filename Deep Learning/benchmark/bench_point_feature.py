@@ -0,0 +1,82 @@
+import numpy as np
+import time
+import argparse
+from skimage.morphology import skeletonize
+from utils.utils import loc_convert, convert_np_graph
+from utils.Calculate_metrics import get_region_num
+from utils.Make_graph import get_point_feature, get_contour, divide_cl
+from benchmark.synthetic import make_vessel_tree
+from benchmark.bench_extract_slice import extract_slice_loop
+
+'''
+射线特征的吞吐量对比：逐方向、逐半径取值并逐节点找轮廓 vs 所有射线点一次取值
+python -m benchmark.bench_point_feature --shape 160 160 128 --repeat 8
+'''
+
+
+def get_point_feature_loop(point, normal, image, contour, spacing, radiu_stride=32, tangle=15):
+    # 原get_point_feature，作为参照
+    N = point.shape[0]
+    normal[normal == 0] = 1e-12
+    normal = normal / np.linalg.norm(normal, axis=1).reshape(N, 1)
+    stride = np.repeat(np.arange(0, radiu_stride + 1)[:, np.newaxis], 3, axis=1)
+    init_point_arr = np.zeros((1, 3)) + stride * 0.1 * np.array([1, 0, 0]).reshape(1, 3)
+    _, _, true_loc = extract_slice_loop(np.zeros_like(image), point, normal, 32)
+    point1_list = np.array([loc_convert(init_point_arr.T, np.array([0, 0, 1]).reshape(1, 3), i).T + 16
+                            for i in range(0, 360, tangle)])
+    point1_list = np.floor(point1_list / spacing).astype(int)
+    point2 = true_loc[:, :, point1_list[:, :, 0], point1_list[:, :, 1]]
+    point2 = np.transpose(point2, (0, 2, 3, 1)) * spacing
+    X = np.zeros((N, 360 // tangle, radiu_stride + 2))
+    for i in range(point2.shape[1]):
+        xyz_index = np.round(point2[:, i, :, :] / spacing.reshape(1, 3)).astype(int)
+        c_p = np.zeros((xyz_index.shape[0], xyz_index.shape[1]))
+        for p_index in range(xyz_index.shape[1]):
+            mid_loc = xyz_index[:, p_index, :]
+            flag = (mid_loc[:, 0] >= 0) & (mid_loc[:, 0] < image.shape[0]) & (mid_loc[:, 1] >= 0) & (
+                    mid_loc[:, 1] < image.shape[1]) & (mid_loc[:, 2] >= 0) & (mid_loc[:, 2] < image.shape[2])
+            X[flag, i, p_index] = image[mid_loc[flag, 0], mid_loc[flag, 1], mid_loc[flag, 2]]
+            c_p[flag, p_index] = contour[mid_loc[flag, 0], mid_loc[flag, 1], mid_loc[flag, 2]]
+        edge_index = []
+        for n in range(N):
+            c_index = np.where(c_p[n, :] != 0)
+            edge_index.append(radiu_stride if c_index[0].shape[0] == 0 else np.max(c_index[0]))
+        edge_point = xyz_index[list(range(xyz_index.shape[0])), edge_index]
+        X[:, i, radiu_stride + 1] = np.sqrt(np.sum((edge_point * spacing - point * spacing) ** 2, axis=1))
+    dist_map = np.sqrt(np.sum((point2 - point[:, np.newaxis, np.newaxis, :] * spacing) ** 2, axis=3))
+    return [X, point2, dist_map]
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--shape', type=int, nargs=3, default=[160, 160, 128])
+    p.add_argument('--repeat', type=int, default=8)
+    args = p.parse_args()
+
+    image, label = make_vessel_tree(tuple(args.shape))
+    contour = get_contour(label)
+    spacing = np.array([0.5, 0.5, 0.5])
+    cl = get_region_num(skeletonize(label.astype(np.uint8)).astype(np.float64), 1)
+    cl_branch = divide_cl(cl)
+    # 把所有分段的节点与法向量拼在一起，重复多次增大节点数
+    point_list, normal_list = [], []
+    for i in range(1, cl_branch.max() + 1):
+        if (cl_branch == i).sum() <= 5:
+            continue
+        path_dict, node_dict, _ = convert_np_graph((cl_branch == i).astype(np.int64))
+        path = list(path_dict.values())[0]
+        point_list.append(node_dict['loc'][path])
+        normal_list.append(node_dict['normal'])
+    point = np.concatenate(point_list * args.repeat)
+    normal = np.concatenate(normal_list * args.repeat)
+
+    t0 = time.time()
+    old = get_point_feature_loop(point, normal.copy(), image, contour, spacing)
+    t1 = time.time()
+    new = get_point_feature(point, normal.copy(), image, contour, spacing)
+    t2 = time.time()
+    get_point_feature(point, normal.copy(), image, contour, spacing, interp='linear')
+    t3 = time.time()
+    same = all(np.array_equal(a, b) for a, b in zip(old, new))
+    print('nodes:%d | loop:%.0f nodes/s | batched:%.0f nodes/s | trilinear:%.0f nodes/s | identical:%s' % (
+        point.shape[0], point.shape[0] / (t1 - t0), point.shape[0] / (t2 - t1), point.shape[0] / (t3 - t2), same))
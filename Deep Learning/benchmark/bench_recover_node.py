@@ -0,0 +1,71 @@
+import numpy as np
+import time
+import argparse
+import torch as th
+from scipy import ndimage
+from skimage.morphology import skeletonize
+from utils.utils import get_line, extract_slice
+from utils.Calculate_metrics import get_region_num
+from utils.Make_graph import Construct_graph, recover_node, get_contour, divide_cl
+from benchmark.synthetic import make_vessel_tree
+
+'''
+由图恢复血管的耗时对比：稠密邻接矩阵上逐边画线、逐张切片填充 vs 边表一次画线、切片成批填充
+python -m benchmark.bench_recover_node --shape 160 160 128
+'''
+
+
+def recover_node_loop(g, image, spacing, str_key):
+    # 原recover_node，作为参照
+    label = np.zeros_like(image)
+    rv = g.ndata[str_key].numpy()
+    rv = rv.reshape(rv.shape[0], 1)
+    loc = np.round(g.ndata['loc'].numpy() / spacing).astype(np.int64)
+    dist_map = g.ndata['dist_map'].numpy()
+    min_index = np.argmin(np.abs(dist_map - rv), axis=1)
+    edge_loc = loc[np.arange(dist_map.shape[0]), min_index, :]
+
+    adj = g.adj().to_dense()
+    n = g.number_of_nodes()
+    for ii in range(n):
+        neighbor_node = th.where(adj[ii, :] == 1)[0]
+        for j in neighbor_node:
+            line = get_line(edge_loc[ii, :], edge_loc[j, :], dim=3)
+            line1 = np.floor(line).astype(np.int64)
+            line2 = np.ceil(line).astype(np.int64)
+            label[line1[:, 0], line1[:, 1], line1[:, 2]] = 1
+            label[line2[:, 0], line2[:, 1], line2[:, 2]] = 1
+
+    center = loc[list(range(0, rv.shape[0], 24)), 0, :]
+    slicer_list = [extract_slice(label, center, np.repeat(v[np.newaxis], center.shape[0], axis=0), 32)
+                   for v in np.eye(3, dtype=np.int64)]
+    for i_index in range(center.shape[0]):
+        for slicer, _, true_loc in slicer_list:
+            ss = ndimage.binary_fill_holes(ndimage.binary_closing(slicer[i_index, :, :]))
+            t = true_loc[i_index]
+            label[t[0], t[1], t[2]] = label[t[0], t[1], t[2]] + ss
+    return label
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--shape', type=int, nargs=3, default=[160, 160, 128])
+    args = p.parse_args()
+
+    image, label = make_vessel_tree(tuple(args.shape))
+    contour = get_contour(label)
+    spacing = np.array([0.5, 0.5, 0.5])
+    cl = get_region_num(skeletonize(label.astype(np.uint8)).astype(np.float64), 1)
+    cl_branch = divide_cl(cl)
+    mk_graph = Construct_graph(cl_branch, image, contour, spacing, 15)
+    graphs = [mk_graph.construct_graph((cl_branch == i).astype(np.int64)) for i in range(1, cl_branch.max() + 1)
+              if (cl_branch == i).sum() > 5]
+
+    t0 = time.time()
+    old = sum(recover_node_loop(g, image, spacing, 'rv') for g in graphs)
+    t1 = time.time()
+    new = sum(recover_node(g, image, spacing, 'rv')[0] for g in graphs)
+    t2 = time.time()
+    print('graphs:%d | nodes:%d | loop:%.2fs | batched:%.2fs | identical:%s' % (
+        len(graphs), sum(g.number_of_nodes() for g in graphs), t1 - t0, t2 - t1,
+        np.array_equal(old > 0.5, new > 0.5)))
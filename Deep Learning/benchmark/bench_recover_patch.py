@@ -0,0 +1,46 @@
+import numpy as np
+import time
+import argparse
+from utils.Get_patch import grid_patch_start
+from utils.Recover_patch import add_patch, Patch_blender
+
+'''
+patch融合回3D图像的时间对比：float64逐个add_patch vs float32 Patch_blender批量融合
+python -m benchmark.bench_recover_patch --shape 256 256 200 --patch_size 32 64
+'''
+
+
+def recover_loop(shape, patch, loc, patch_size):
+    # 原来逐个patch取出、比较、写回的方式，作为参照
+    img = np.zeros(shape, dtype=np.float64)
+    for n in range(patch.shape[0]):
+        img = add_patch(img, patch[n], loc[n], patch_size)
+    return img
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--shape', type=int, nargs=3, default=[256, 256, 200])
+    p.add_argument('--patch_size', type=int, nargs='+', default=[32, 64])
+    args = p.parse_args()
+
+    shape = tuple(args.shape)
+    rng = np.random.RandomState(0)
+    for patch_size in args.patch_size:
+        loc = np.array(grid_patch_start(shape, patch_size))
+        patch = rng.rand(loc.shape[0], patch_size, patch_size, patch_size).astype(np.float32)
+
+        t0 = time.time()
+        img_loop = recover_loop(shape, patch, loc, patch_size)
+        t1 = time.time()
+        result = dict()
+        for mode in ['max', 'mean', 'gaussian']:
+            t = time.time()
+            blender = Patch_blender(shape, patch_size, mode)
+            blender.add(patch, loc)
+            img = blender.result()
+            result[mode] = time.time() - t
+            if mode == 'max':
+                same = np.array_equal(img_loop > 0.5, img > 0.5)
+        print('patch_size:%d | patches:%d | loop:%.3fs | max:%.3fs | mean:%.3fs | gaussian:%.3fs | identical:%s' % (
+            patch_size, loc.shape[0], t1 - t0, result['max'], result['mean'], result['gaussian'], same))
@@ -0,0 +1,61 @@
+import numpy as np
+import time
+import argparse
+from skimage.measure import label
+from utils.Calculate_metrics import get_region_num
+from benchmark.synthetic import make_vessel_tree
+
+'''
+保留最大连通域的时间对比：逐个连通域扫描全图 vs bincount
+python -m benchmark.bench_region_num --shape 160 160 160 --noise 0.001
+python -m benchmark.bench_region_num --shape 512 512 512 --noise 0.0005 --loop 0  # 512^3时参照版本需要数十分钟
+'''
+
+
+def get_region_num_loop(img, get_num):
+    # 原逐个连通域统计体积并逐个写回的方式，作为参照
+    conn_img = label(img, connectivity=3)
+    i_max = conn_img.max()
+    if get_num > i_max:
+        get_num = i_max
+    area_list = []
+    for i in np.arange(1, i_max + 1):
+        area_list.append(np.sum(conn_img == i))
+    index = np.argsort(-np.array(area_list)) + 1
+    record = np.zeros_like(img)
+    for i in np.arange(get_num):
+        record[conn_img == index[i]] = 1
+    return record
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--shape', type=int, nargs=3, default=[160, 160, 160])
+    p.add_argument('--noise', type=float, default=0.001)
+    p.add_argument('--get_num', type=int, nargs='+', default=[1, 2, 50])
+    p.add_argument('--loop', type=int, default=1)
+    args = p.parse_args()
+
+    # 血管树加上随机散点，模拟粗分割结果中大量的小连通域
+    rng = np.random.RandomState(0)
+    _, img = make_vessel_tree(tuple(args.shape))
+    img[rng.rand(*args.shape) < args.noise] = 1
+    print('components:%d' % label(img, connectivity=3).max())
+
+    for get_num in args.get_num:
+        if not args.loop:
+            t0 = time.time()
+            get_region_num(img, get_num)
+            print('get_num:%d | bincount:%.2fs' % (get_num, time.time() - t0))
+            continue
+        t0 = time.time()
+        loop = get_region_num_loop(img, get_num)
+        t1 = time.time()
+        fast = get_region_num(img, get_num)
+        t2 = time.time()
+        print('get_num:%d | loop:%.2fs | bincount:%.2fs | speedup:%.0fx | identical:%s' % (
+            get_num, t1 - t0, t2 - t1, (t1 - t0) / (t2 - t1), np.array_equal(loop, fast)))
+    for connectivity in [6, 18, 26]:
+        t0 = time.time()
+        get_region_num(img, 2, connectivity)
+        print('connectivity:%d | %.2fs' % (connectivity, time.time() - t0))
@@ -0,0 +1,67 @@
+import numpy as np
+import os
+import time
+import argparse
+import tempfile
+import nibabel as nib
+from utils.Make_graph import img_resample, resample_shape, Resample_cache
+from benchmark.synthetic import make_vessel_tree
+
+'''
+重采样缓存的对比：每次img_resample vs 第一次写入缓存 vs 之后从缓存读取，并检查容量限制下的LRU删除、
+缓存文件被其他进程删除时重新计算、源文件改写后不再使用旧的缓存
+python -m benchmark.bench_resample_cache --shape 256 256 160
+'''
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--shape', type=int, nargs=3, default=[256, 256, 160])
+    args = p.parse_args()
+
+    image, label = make_vessel_tree(tuple(args.shape))
+    image = np.round(image * 1000)
+    spacing = np.array([0.5, 0.5, 0.5])
+    with tempfile.TemporaryDirectory() as tmp:
+        affine = np.diag([0.39, 0.39, 0.625, 1])
+        nii_list = []
+        for key, v in [('img', image), ('label', label)]:
+            path = os.path.join(tmp, key + '.nii.gz')
+            nib.save(nib.Nifti1Image(v, affine), path)
+            nii_list.append((key, path))
+
+        cache = Resample_cache(os.path.join(tmp, 'cache'))
+        for key, path in nii_list:
+            dtype = np.float32 if key == 'img' else np.uint8
+            t0 = time.time()
+            _, ref = img_resample(nib.load(path), spacing)
+            t1 = time.time()
+            _, miss = cache.get('case', path, spacing, dtype=dtype)
+            t2 = time.time()
+            _, hit = cache.get('case', path, spacing, dtype=dtype)
+            t3 = time.time()
+            shape = resample_shape(nib.load(path).header, spacing)
+            print('%s | resample:%.2fs | miss:%.2fs | hit:%.2fs | shape from header:%s | identical:%s' % (
+                key, t1 - t0, t2 - t1, t3 - t2, np.array_equal(shape, ref.shape),
+                np.array_equal(ref, miss) and np.array_equal(ref, hit)))
+        size = sum(os.path.getsize(os.path.join(tmp, 'cache', i)) for i in os.listdir(os.path.join(tmp, 'cache')))
+        print('cache size:%.1fMB' % (size / 1024 ** 2))
+
+        # 容量只够一个文件时，只保留最近使用的
+        img_path, label_path = nii_list[0][1], nii_list[1][1]
+        cache.max_size = (size - 1) / 1024 ** 3
+        time.sleep(0.01)
+        cache.get('case', img_path, spacing)
+        cache.evict()
+        left = os.listdir(os.path.join(tmp, 'cache'))
+        print('after eviction:%d file | kept most recent:%s' % (
+            len(left), left == [cache.key('case', img_path, spacing, 0) + '.npz']))
+
+        # 缓存文件在读取前被删除(其他进程的evict)时重新计算
+        os.remove(os.path.join(tmp, 'cache', left[0]))
+        _, again = cache.get('case', img_path, spacing)
+        # 源文件改写后key改变
+        old_key = cache.key('case', img_path, spacing, 0)
+        os.utime(img_path, ns=(0, os.stat(img_path).st_mtime_ns + 10 ** 9))
+        print('recomputed after removal:%s | key changed after rewrite:%s' % (
+            np.array_equal(again, img_resample(nib.load(img_path), spacing)[1].astype(np.float32)),
+            old_key != cache.key('case', img_path, spacing, 0)))
@@ -0,0 +1,41 @@
+import numpy as np
+import time
+import argparse
+from skimage.morphology import skeletonize
+from utils.utils import dijkstra, Centerline_graph
+from utils.Calculate_metrics import get_region_num
+from benchmark.synthetic import make_vessel_tree
+
+'''
+根节点到叶子节点路径的回归检查：每个叶子一次O(V^2)的dijkstra vs 一棵二叉堆最短路径树
+python -m benchmark.bench_shortest_path --shape 160 160 128 --seed 0 1 2 3
+'''
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--shape', type=int, nargs=3, default=[160, 160, 128])
+    p.add_argument('--branch_num', type=int, default=12)
+    p.add_argument('--seed', type=int, nargs='+', default=[0, 1, 2, 3])
+    args = p.parse_args()
+
+    for seed in args.seed:
+        _, label = make_vessel_tree(tuple(args.shape), branch_num=args.branch_num, seed=seed)
+        cl = get_region_num(skeletonize(label.astype(np.uint8)).astype(np.float64), 1)
+        graph = Centerline_graph(cl)
+        leaf = graph.leaves()
+        root_index = leaf[np.argmax(graph.loc[leaf, 2])]
+
+        # 原来convert_np_tree中的做法
+        t0 = time.time()
+        adj = graph.adj.toarray()
+        adj[adj == 0] = float('inf')
+        np.fill_diagonal(adj, 0)
+        old = [dijkstra(adj.copy(), root_index, i) for i in leaf if i != root_index]
+        t1 = time.time()
+        parent = graph.shortest_path_tree(root_index)
+        new = [graph.get_path(parent, root_index, i) for i in leaf if i != root_index]
+        t2 = time.time()
+
+        same = len(old) == len(new) and all(a == b for a, b in zip(old, new))
+        print('points:%d | leaves:%d | dijkstra:%.2fs | heap tree:%.4fs | speedup:%.0fx | identical:%s' % (
+            graph.point_nums, leaf.shape[0], t1 - t0, t2 - t1, (t1 - t0) / (t2 - t1), same))
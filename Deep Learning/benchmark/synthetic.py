@@ -0,0 +1,45 @@
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+
+'''
+生成用于性能测试的合成血管树
+'''
+
+
+def make_vessel_tree(shape=(256, 256, 128), branch_num=12, radius=(1.5, 4), seed=0):
+    '''
+    从体积上方出发随机游走生成分叉的管状结构
+    :param shape: 图像大小
+    :param branch_num: 分支个数
+    :param radius: 管径范围(体素)
+    :param seed: 随机种子
+    :return: image:模拟CT图像 float64 ; label:二值标签 float64
+    '''
+    rng = np.random.RandomState(seed)
+    shape = np.array(shape)
+    cl = np.zeros(shape, dtype=bool)
+    radius_map = np.zeros(shape, dtype=np.float32)
+
+    start = np.array([shape[0] / 2, shape[1] / 2, shape[2] - 2], dtype=np.float64)
+    seeds = [(start, np.array([0, 0, -1.0]), radius[1])]
+    for b in range(branch_num):
+        if b < len(seeds):
+            p, d, r = seeds[b]
+        else:
+            p, d, r = seeds[rng.randint(len(seeds))]
+            d = d + rng.normal(0, 0.8, 3)
+        p = p.copy()
+        for _ in range(rng.randint(shape.min() // 2, shape.min())):
+            d = d + rng.normal(0, 0.15, 3)
+            d = d / np.linalg.norm(d)
+            p = np.clip(p + d, 0, shape - 1)
+            idx = tuple(np.round(p).astype(np.int64))
+            cl[idx] = True
+            radius_map[idx] = r
+            if rng.rand() < 0.01:
+                seeds.append((p.copy(), d.copy(), max(radius[0], r * 0.8)))
+
+    dist, index = distance_transform_edt(~cl, return_indices=True)
+    label = (dist <= radius_map[index[0], index[1], index[2]]).astype(np.float64)
+    image = rng.normal(0, 50, shape) + label * 400
+    return image, label
@@ -0,0 +1,85 @@
+import numpy as np
+import time
+import argparse
+import SimpleITK as sitk
+from scipy.spatial import cKDTree
+from scipy.ndimage import binary_dilation, binary_erosion
+from utils.Calculate_metrics import seg_metrics, HausdorffDistance
+from benchmark.synthetic import make_vessel_tree
+
+'''
+seg_metrics与SimpleITK的对比验证：
+Dice、HD、AHD与SimpleITK比较，HD95、ASSD与对表面体素用KD树逐点求最近距离的结果比较
+SimpleITK的图像轴顺序与numpy相反，这里转置后再设置spacing，使两边的体素间距对应同一个轴；
+Cal_metrics(engine='sitk')没有转置，spacing各向异性时HD/AHD与seg_metrics不同，差值在legacy一行给出
+python -m benchmark.validate_metrics --shape 192 192 128 --spacing 0.4 0.4 0.6
+'''
+
+
+def sitk_metrics(y_true, y_pred, spacing):
+    gt = sitk.GetImageFromArray(y_true.transpose(2, 1, 0).astype(np.uint8))
+    mask = sitk.GetImageFromArray(y_pred.transpose(2, 1, 0).astype(np.uint8))
+    gt.SetSpacing(spacing)
+    mask.SetSpacing(spacing)
+    overlap = sitk.LabelOverlapMeasuresImageFilter()
+    overlap.Execute(gt, mask)
+    hausdorff = sitk.HausdorffDistanceImageFilter()
+    hausdorff.Execute(gt, mask)
+    return overlap.GetDiceCoefficient(), hausdorff.GetHausdorffDistance(), hausdorff.GetAverageHausdorffDistance()
+
+
+def kdtree_surface(y_true, y_pred, spacing, percentile=95):
+    # 在整幅图像上取表面体素，KD树求最近距离
+    true_surface = np.argwhere(y_true & ~binary_erosion(y_true)) * np.array(spacing)
+    pre_surface = np.argwhere(y_pred & ~binary_erosion(y_pred)) * np.array(spacing)
+    pre_to_true = cKDTree(true_surface).query(pre_surface)[0]
+    true_to_pre = cKDTree(pre_surface).query(true_surface)[0]
+    hd95 = max(np.percentile(pre_to_true, percentile), np.percentile(true_to_pre, percentile))
+    assd = (pre_to_true.sum() + true_to_pre.sum()) / (pre_to_true.shape[0] + true_to_pre.shape[0])
+    return hd95, assd
+
+
+def make_pair(shape, seed):
+    # 真实标签为合成血管树，预测为膨胀/腐蚀、删掉一段分支并加上散点后的结果
+    rng = np.random.RandomState(seed)
+    _, label = make_vessel_tree(shape, seed=seed)
+    true = label > 0
+    pre = binary_dilation(true) if seed % 2 == 0 else binary_erosion(true) | (true & (rng.rand(*shape) < 0.5))
+    pre[:shape[0] // 4] = pre[:shape[0] // 4] & (rng.rand(shape[0] // 4, *shape[1:]) < 0.8)
+    pre |= rng.rand(*shape) < 2e-5
+    return true, pre
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--shape', type=int, nargs=3, default=[192, 192, 128])
+    p.add_argument('--spacing', type=float, nargs=3, default=[0.4, 0.4, 0.6])
+    p.add_argument('--case_num', type=int, default=4)
+    args = p.parse_args()
+
+    spacing = tuple(args.spacing)
+    t_sitk = 0
+    t_edt = 0
+    max_err = np.zeros(5)
+    legacy_err = np.zeros(2)
+    for seed in range(args.case_num):
+        true, pre = make_pair(tuple(args.shape), seed)
+        t0 = time.time()
+        dice, hd, ahd = sitk_metrics(true, pre, spacing)
+        t1 = time.time()
+        metrics = seg_metrics(true, pre, spacing)
+        t2 = time.time()
+        hd95, assd = kdtree_surface(true, pre, spacing)
+        legacy_ahd, legacy_hd = HausdorffDistance(true.astype(np.uint8), pre.astype(np.uint8), spacing)
+        legacy_err = np.maximum(legacy_err, np.abs([metrics['hd'] - legacy_hd, metrics['ahd'] - legacy_ahd]))
+        t_sitk += t1 - t0
+        t_edt += t2 - t1
+        err = np.abs(np.array([metrics['dice'] - dice, metrics['hd'] - hd, metrics['ahd'] - ahd,
+                               metrics['hd95'] - hd95, metrics['assd'] - assd]))
+        max_err = np.maximum(max_err, err)
+        print('case %d | dice %.6f/%.6f | hd %.4f/%.4f | ahd %.4f/%.4f | hd95 %.4f/%.4f | assd %.4f/%.4f' % (
+            seed, metrics['dice'], dice, metrics['hd'], hd, metrics['ahd'], ahd, metrics['hd95'], hd95,
+            metrics['assd'], assd))
+    print('max abs error | dice %.2e | hd %.2e | ahd %.2e | hd95 %.2e | assd %.2e' % tuple(max_err))
+    print('legacy Cal_metrics(engine=sitk) vs seg_metrics | hd %.2e | ahd %.2e' % tuple(legacy_err))
+    print('sitk dice+hd:%.2fs | seg_metrics (all five):%.2fs' % (t_sitk, t_edt))
@@ -1,11 +1,14 @@
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Sampler
 import numpy as np
 import nibabel as nib
 from scipy.ndimage.interpolation import zoom
 import os
+import glob
 import pandas as pd
 from monai.transforms import RandFlip, RandRotate
 from utils.utils import reshape_img,normalize
+from utils.Get_patch import skeleton_loc, centerline_patch_start, negative_patch_start, grid_patch_start, \
+    save_patch_record, load_patch_record
 
 # from sklearn.model_selection import KFold
 """
@@ -13,6 +16,19 @@ from utils.utils import reshape_img,normalize
 """
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
 
+
+def source_stat(path):
+    # 源文件的大小与修改时间，与Frangi_cache.case_dir相同，改变时缓存失效
+    stat = os.stat(path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def save_npy(path, array):
+    # 先写临时文件再改名，其他进程不会读到不完整的文件
+    tmp_path = path + '.%d.part.npy' % os.getpid()
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
 class CoronaryImagePatch(Dataset):
 
     def __init__(self, data_dir, label_dir,enhance_path=None,transform=None):
@@ -138,3 +154,214 @@ class CoronaryImageSigle(Dataset):
         return sample
 
 
+class CoronaryPatchStack(Dataset):
+    '''
+    读取Get_patch(save_type='npy')生成的patch数组文件，每个病例一个ID.npy，用mmap直接切片，不需要解压
+    '''
+    def __init__(self, stack_dir, ID_list=None, add_enhance=False, transform=None):
+        '''
+        :param stack_dir: patch数组目录 stack_dir/ID.npy, stack_dir/ID_record.npz
+        :param ID_list: 读取的病例，为None时读取目录下全部病例
+        :param add_enhance: 是否加入frangi通道，与CoronaryImageEnhance一致时不做归一化
+        :param transform: 数据增强
+        '''
+        self.stack_dir = stack_dir
+        self.add_enhance = add_enhance
+        self.transform = transform
+        if ID_list is None:
+            ID_list = sorted([f[:-len('_record.npz')] for f in os.listdir(stack_dir) if f.endswith('_record.npz')])
+
+        self.ID_list = []
+        self.affine = []
+        case_index = []
+        patch_index = []
+        for ID in ID_list:
+            record = np.load(os.path.join(stack_dir, ID + '_record.npz'))
+            num = record['loc'].shape[0]
+            if num == 0:
+                continue
+            case_index.append(np.full(num, len(self.ID_list)))
+            patch_index.append(np.arange(num))
+            self.ID_list.append(ID)
+            self.affine.append(record['affine'])
+        self.case_index = np.concatenate(case_index) if case_index else np.zeros(0, dtype=np.int64)
+        self.patch_index = np.concatenate(patch_index) if patch_index else np.zeros(0, dtype=np.int64)
+        # 每个DataLoader进程第一次用到时才打开mmap
+        self.stack = dict()
+
+    def __len__(self):
+        return self.case_index.shape[0]
+
+    def get_stack(self, case):
+        if case not in self.stack:
+            self.stack[case] = np.load(os.path.join(self.stack_dir, self.ID_list[case] + '.npy'), mmap_mode='r')
+        return self.stack[case]
+
+    def __getitem__(self, index):
+        case = self.case_index[index]
+        p_index = self.patch_index[index]
+        patch = self.get_stack(case)[p_index]
+        ID = '%s_%d' % (self.ID_list[case], p_index)
+
+        if self.add_enhance:
+            concatenate = np.stack([patch[0], patch[2], patch[1]], axis=0)
+            c = 2
+        else:
+            concatenate = np.stack([normalize(patch[0]), patch[1]], axis=0)
+            c = 1
+
+        if self.transform != None:
+            concatenate = self.transform(concatenate)
+        img = concatenate[0:c, :, :, :]
+        label = concatenate[c:, :, :, :]
+        sample = {'img': img, 'label': label, 'affine': self.affine[case], 'image_index': ID}
+        return sample
+
+
+class CoronaryPatchOnline(Dataset):
+    '''
+    直接读取Crop_pre裁剪后的图像，在__getitem__时按patch位置表切片，不需要事先把patch写到硬盘
+    '''
+    def __init__(self, crop_dir, ID_list, patch_size, scheme='centerline', add_enhance=False, transform=None,
+                 seed=0, record_dir=None, cache_dir=None):
+        '''
+        :param crop_dir: 裁剪图像路径 crop_dir/id/(img,label,frangi).nii.gz
+        :param ID_list: 病例id
+        :param patch_size: patch的大小
+        :param scheme: 'centerline' 与get_patch相同,中心线正样本+随机负样本 ; 'grid' 与get_patch_valid相同,重叠一半的规则网格
+        :param add_enhance: 是否加入frangi通道
+        :param transform: 数据增强
+        :param seed: 负样本随机选取的种子，每个病例使用seed+病例序号
+        :param record_dir: patch位置表目录，存在且label、patch大小与种子都没有改变时直接读取，否则计算后以npz保存，
+                           可供Recover_patch使用
+        :param cache_dir: 为None时图像保存在内存中，否则转为float32的.npy并用mmap读取，文件名带有源文件的大小与修改时间
+        '''
+        self.crop_dir = crop_dir
+        self.patch_size = patch_size
+        self.scheme = scheme
+        self.add_enhance = add_enhance
+        self.transform = transform
+        self.record_dir = record_dir
+        self.cache_dir = cache_dir
+        if record_dir is not None:
+            os.makedirs(record_dir, exist_ok=True)
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self.ID_list = ID_list
+        self.volume = []
+        self.affine = []
+        case_index = []
+        loc_list = []
+        for c, ID in enumerate(ID_list):
+            volume, affine = self.load_case(ID)
+            loc = self.get_loc(ID, volume['label'], seed + c)
+            self.volume.append(volume)
+            self.affine.append(affine)
+            case_index.append(np.full(loc.shape[0], c))
+            loc_list.append(loc)
+        self.case_index = np.concatenate(case_index) if case_index else np.zeros(0, dtype=np.int64)
+        self.loc = np.concatenate(loc_list) if loc_list else np.zeros((0, 3), dtype=np.int64)
+        # patch在病例内的编号，与Get_patch保存的文件名ID_index对应
+        self.patch_index = np.concatenate([np.arange(loc.shape[0]) for loc in loc_list]) if loc_list \
+            else np.zeros(0, dtype=np.int64)
+
+    def load_case(self, ID):
+        key_list = ['img', 'label', 'frangi'] if self.add_enhance else ['img', 'label']
+        volume = dict()
+        affine = None
+        for key in key_list:
+            src_path = os.path.join(self.crop_dir, ID, key + '.nii.gz')
+            cache_path = None
+            if self.cache_dir is not None:
+                cache_path = os.path.join(self.cache_dir, '%s_%s_%d_%d.npy' % ((ID, key) + tuple(source_stat(src_path))))
+            nii = nib.load(src_path)
+            affine = nii.affine if key == 'label' else affine
+            if cache_path is not None and os.path.exists(cache_path):
+                volume[key] = np.load(cache_path, mmap_mode='r')
+                continue
+            v = nii.get_fdata(dtype=np.float32)
+            if key == 'label':
+                v = (v > 0).astype(np.float32)
+            if cache_path is not None:
+                # 源文件改变前的缓存不再使用，一并删除
+                for old in glob.glob(os.path.join(self.cache_dir, '%s_%s_*.npy' % (ID, key))):
+                    if old != cache_path and not old.endswith('.part.npy'):
+                        try:
+                            os.remove(old)
+                        except FileNotFoundError:
+                            pass
+                save_npy(cache_path, v)
+                v = np.load(cache_path, mmap_mode='r')
+            volume[key] = v
+        return volume, affine
+
+    def get_loc(self, ID, label, seed):
+        # 位置表由label、patch大小与种子决定，三者之一改变(或旧的位置表没有记录)时重新计算
+        source = np.concatenate([source_stat(os.path.join(self.crop_dir, ID, 'label.nii.gz')),
+                                 np.asarray(self.patch_size, dtype=np.int64).reshape(-1), [seed]])
+        record_path = None if self.record_dir is None else os.path.join(self.record_dir, ID + '.npz')
+        if record_path is not None and os.path.exists(record_path):
+            with np.load(record_path) as record:
+                valid = 'source' in record and np.array_equal(record['source'], source)
+            if valid:
+                return load_patch_record(self.record_dir, ID)[1]
+        if self.scheme == 'centerline':
+            pos_start = centerline_patch_start(skeleton_loc(label), label.shape, self.patch_size)
+            neg_start = negative_patch_start(label, self.patch_size, pos_start.shape[0],
+                                             np.random.RandomState(seed))
+            loc = np.concatenate([pos_start, neg_start], axis=0)
+        elif self.scheme == 'grid':
+            loc = grid_patch_start(label.shape, self.patch_size)
+        else:
+            raise ValueError("value error,no setting")
+        if self.record_dir is not None:
+            save_patch_record(self.record_dir, ID, loc, 'npz', source=source)
+        return loc
+
+    def __len__(self):
+        return self.case_index.shape[0]
+
+    def __getitem__(self, index):
+        case = self.case_index[index]
+        s = self.loc[index]
+        e = s + self.patch_size
+        volume = self.volume[case]
+        ID = '%s_%d' % (self.ID_list[case], self.patch_index[index])
+
+        img = np.array(volume['img'][s[0]:e[0], s[1]:e[1], s[2]:e[2]])
+        label = np.array(volume['label'][s[0]:e[0], s[1]:e[1], s[2]:e[2]])
+        if self.add_enhance:
+            enhance = np.array(volume['frangi'][s[0]:e[0], s[1]:e[1], s[2]:e[2]])
+            concatenate = np.stack([img, enhance, label], axis=0)
+            c = 2
+        else:
+            concatenate = np.stack([normalize(img), label], axis=0)
+            c = 1
+
+        if self.transform != None:
+            concatenate = self.transform(concatenate)
+        img = concatenate[0:c, :, :, :]
+        label = concatenate[c:, :, :, :]
+        sample = {'img': img, 'label': label, 'affine': self.affine[case], 'image_index': ID}
+        return sample
+
+
+class Seeded_sampler(Sampler):
+    '''
+    每个epoch的打乱顺序只由seed和epoch决定，训练可以复现
+    '''
+    def __init__(self, data_source, seed=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        return iter(rng.permutation(len(self.data_source)).tolist())
+
+    def __len__(self):
+        return len(self.data_source)
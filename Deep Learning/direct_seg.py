@@ -12,7 +12,7 @@ from model.loss import DiceLoss,DiceLoss_v1
 import torch.nn as nn
 import time
 from model.FCN import FCN_Gate, FCN
-import multiprocessing
+from utils.Executor import get_executor
 from tqdm import tqdm
 import yaml
 import re
@@ -251,10 +251,7 @@ if __name__ == '__main__':
     # 计算最后的dice
     print('now calculate dice...........')
     CD = Cal_metrics(os.path.join(save_label_path), valid_path, 0)
-    p = multiprocessing.Pool(pool_nums)
-    result = p.map(CD.calculate_dice, ID_list['valid'])
-    p.close()
-    p.join()
+    result = get_executor(pool_nums).map(CD.calculate_dice, ID_list['valid'])
 
     # 保存结果
     record_dice={}
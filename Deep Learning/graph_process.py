@@ -1,9 +1,9 @@
-import multiprocessing
+from utils.Executor import get_executor
 import numpy as np
 import os
 import yaml
 from utils.utils import get_csv_split
-from utils.Make_graph import Make_Graph
+from utils.Make_graph import Make_Graph, Resample_cache
 import argparse
 
 if __name__=='__main__':
@@ -14,6 +14,9 @@ if __name__=='__main__':
     p.add_argument('--Direct_model', type=str, default='FCN')
     p.add_argument('--Direct_parameter', type=str, default='Mid_resolution_4_Dice')
     p.add_argument('--pools', type=int, default=4)
+    # 重采样结果缓存到mid_path/Graph/resample_cache，容量单位GB
+    p.add_argument('--resample_cache', type=int, default=0)
+    p.add_argument('--cache_size', type=float, default=50)
 
     args = p.parse_args()
     k = args.fold
@@ -34,11 +37,9 @@ if __name__=='__main__':
     graph_path=os.path.join(mid_path, 'Graph', coarse_version, direct_parameters, 'fold_%d' % k,'graph')
     pre_seg_path = os.path.join('result/Direct_seg', coarse_version, direct_parameters, 'fold_%d' % k, 'pre_label')
     id_dict=get_csv_split(csv_path,k)
+    cache = Resample_cache(os.path.join(mid_path, 'Graph', 'resample_cache'), args.cache_size) if args.resample_cache else None
 
     for dt in ['train','valid']:
-        make_graph_opt = Make_Graph(img_path, img_path, pre_seg_path, graph_path,dt)
+        make_graph_opt = Make_Graph(img_path, img_path, pre_seg_path, graph_path, dt, cache)
         print('convert_tree %s' % dt)
-        p=multiprocessing.Pool(pool_num)
-        p.map(make_graph_opt.run,id_dict[dt])
-        p.close()
-        p.join()
+        get_executor(pool_num).map(make_graph_opt.run,id_dict[dt])
@@ -15,7 +15,7 @@ from utils.utils import get_csv_split
 import nibabel as nib
 import numpy as np
 import re
-import multiprocessing
+from utils.Executor import get_executor
 from utils.Calculate_metrics import Cal_metrics
 import pandas as pd
 import time
@@ -254,18 +254,12 @@ if __name__ == '__main__':
     # Recover
     print('Recover .........')
     RL = Recover_label(data_path, save_graph_path, recover_path, spacing, 'pre_rv')
-    p = multiprocessing.Pool(pool_num)
-    p.map(RL.run, id_dict['valid'])
-    p.close()
-    p.join()
+    get_executor(pool_num).map(RL.run, id_dict['valid'])
 
     # Calculate_dice
     print('Calculate.........')
     CD = Cal_metrics(recover_path, data_path, pre_label_name='pre_rv.nii.gz')
-    p = multiprocessing.Pool(pool_num)
-    result = p.map(CD.calculate_dice, id_dict['valid'])
-    p.close()
-    p.join()
+    result = get_executor(pool_num).map(CD.calculate_dice, id_dict['valid'])
 
     record_dice = dict()
     record_dice['ID'] = id_dict['valid']
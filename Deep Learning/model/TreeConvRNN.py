@@ -132,8 +132,9 @@ class TreeConvGRUCell3d(nn.Module):
         #     h_k[i, :, :, :, :]=self.U(nodes.mailbox['h'][i, :, :, :, :])
 
         s1, s2, s3, s4, s5, s6 = nodes.mailbox['h'].size()
-        rjk = self.U_r(nodes.mailbox['h'].view(s1 * s2, s3, s4, s5, s6))
-        h_k = self.U(nodes.mailbox['h'].view(s1 * s2, s3, s4, s5, s6))
+        # 卷积后恢复为[节点数,入度,...]，每个节点只对自己的子节点求和
+        rjk = self.U_r(nodes.mailbox['h'].view(s1 * s2, s3, s4, s5, s6)).view(s1, s2, s3, s4, s5, s6)
+        h_k = self.U(nodes.mailbox['h'].view(s1 * s2, s3, s4, s5, s6)).view(s1, s2, s3, s4, s5, s6)
         w = th.sum(th.sigmoid(rjk + nodes.data['r'].unsqueeze(dim=1)) * h_k, 1) + nodes.data['w']
         u = self.U_z(h_child) + nodes.data['u']
         return {'u': u, 'h': h_child, 'w': w}
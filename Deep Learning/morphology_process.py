@@ -3,7 +3,7 @@ import pandas as pd
 from scipy.ndimage.interpolation import zoom
 import os
 from utils.utils import get_csv_split
-import multiprocessing
+from utils.Executor import get_executor
 import numpy as np
 from scipy.ndimage import binary_dilation
 from skimage.measure import label
@@ -11,29 +11,43 @@ from skimage.morphology import skeletonize
 import argparse
 import yaml
 from utils.Calculate_metrics import get_region_num
+from utils.Morphology import mask_box, ball_dilation, skeleton
 
 
 class Morphology_process:
 
-    def __init__(self, pre_path,save_path, str_key,se_size=5,con_num=2):
+    def __init__(self, pre_path,save_path, str_key,se_size=5,con_num=2,engine='edt'):
+        '''
+        :param se_size: 球形结构元的半径
+        :param con_num: 膨胀后保留最大连通域的个数
+        :param engine: 'edt' 距离变换膨胀，连通域与中心线只在包围盒内计算 ; 'dense' 原来的binary_dilation与整幅图像计算
+        '''
         self.pre_path = pre_path
         self.str_key = str_key
         self.se_size=se_size
         self.con_num=con_num
         self.save_path=save_path
+        self.engine=engine
 
     def process(self, id):
         pre_nii = nib.load(os.path.join(self.pre_path, id, self.str_key))
-        pre_label = pre_nii.get_fdata()
-
-        se = generate_sphere3d(self.se_size)
-        d_img = binary_dilation(pre_label, se)
-        d_img = get_region_num(d_img, self.con_num)
-        cl_img = skeletonize(d_img.astype(np.uint8))
-
-        nib.save(nib.Nifti1Image(d_img.astype(np.float), pre_nii.affine),
+        pre_label = np.asarray(pre_nii.dataobj) != 0
+
+        if self.engine == 'edt':
+            d_img = ball_dilation(pre_label, self.se_size)
+            box = mask_box(d_img)
+            if box is not None:
+                d_img[box] = get_region_num(d_img[box], self.con_num)
+            cl_img = skeleton(d_img)
+        else:
+            se = generate_sphere3d(self.se_size)
+            d_img = binary_dilation(pre_label, se).astype(np.uint8)
+            d_img = get_region_num(d_img, self.con_num)
+            cl_img = skeletonize(d_img)
+
+        nib.save(nib.Nifti1Image(d_img.astype(np.uint8), pre_nii.affine),
                  os.path.join(self.save_path, id, 'pre_dilation.nii.gz'))
-        nib.save(nib.Nifti1Image(cl_img.astype(np.float), pre_nii.affine),
+        nib.save(nib.Nifti1Image(cl_img.astype(np.uint8), pre_nii.affine),
                  os.path.join(self.save_path, id, 'pre_cl.nii.gz'))
 
         print('%s:done'%id)
@@ -56,6 +70,8 @@ if __name__=='__main__':
     p.add_argument('--Direct_model',type=str,default='FCN')
     p.add_argument('--Direct_parameter',type=str,default='Mid_resolution_4_Dice')
     p.add_argument('--pools',type=int,default=16)
+    p.add_argument('--se_size',type=int,default=5)
+    p.add_argument('--engine',type=str,default='edt',help='edt:距离变换膨胀 ; dense:binary_dilation')
 
     args = p.parse_args()
     k = args.fold
@@ -73,11 +89,8 @@ if __name__=='__main__':
 
     # save_label_path = r'result/%s/fold_%d/pre_label' % (version, k)
     print('Morphology process......')
-    mp=Morphology_process(p_path,p_path,'pre_label.nii.gz')
+    mp=Morphology_process(p_path,p_path,'pre_label.nii.gz',se_size=args.se_size,engine=args.engine)
 
     ID_dict=get_csv_split(csv_path,k)
     ID_list=ID_dict['valid']+ID_dict['train']
-    p = multiprocessing.Pool(pool_num)
-    p.map(mp.process,ID_list)
-    p.close()
-    p.join()
+    get_executor(pool_num).map(mp.process,ID_list)
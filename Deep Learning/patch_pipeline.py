@@ -0,0 +1,262 @@
+from utils.Pipeline import Node, Pipeline
+from utils.Executor import get_executor
+from utils.Frangi_filter import Frangi, Frangi_engine
+from utils.Crop_box import Crop_pre, Recover_Crop
+from utils.Get_patch import Get_patch
+from utils.Calculate_metrics import Cal_metrics
+from utils.Inference_patch import Patch_inference
+from utils.utils import get_csv_split
+from model.CNN_model import Unet, Unet_Patch
+import torch
+import subprocess
+import argparse
+import yaml
+import sys
+import os
+import pandas as pd
+import numpy as np
+
+'''
+patch_seg.sh的增量版本：Frangi、裁剪、切patch、训练、推断、恢复裁剪、计算指标作为流水线的节点，
+按病例与fold记录输入的内容哈希，只重新计算输入改变了的病例及其下游
+python patch_pipeline.py --fold 1 2 3 4 --patch_size 32 --Direct_parameter "Low_resolution_4_Dice" --dry_run 1
+'''
+
+
+class Crop_task:
+    def __init__(self, crop_opt, crop_path):
+        # Crop_pre.run_crop，并把裁剪框保存为crop_path/id/box.npy
+        self.crop_opt = crop_opt
+        self.crop_path = crop_path
+
+    def __call__(self, id):
+        box = self.crop_opt.run_crop(id)
+        np.save(os.path.join(self.crop_path, id, 'box.npy'), np.array(box, dtype=np.int64))
+
+
+class Crop_dict_task:
+    def __init__(self, crop_path, ID_list, save_path):
+        # 与patch_process.py相同的crop_fold_k.npy
+        self.crop_path = crop_path
+        self.ID_list = ID_list
+        self.save_path = save_path
+
+    def __call__(self):
+        record_box = {}
+        record_box['ID'] = self.ID_list
+        record_box['box'] = [np.load(os.path.join(self.crop_path, i, 'box.npy')).tolist() for i in self.ID_list]
+        np.save(self.save_path, record_box)
+
+
+class Command_task:
+    def __init__(self, cmd):
+        self.cmd = cmd
+
+    def __call__(self):
+        print(' '.join(self.cmd))
+        subprocess.run(self.cmd, check=True)
+
+
+class Infer_task:
+    def __init__(self, model_path, add_frangi, crop_path, pre_label_path, p_size, batch_size, record_path, blend,
+                 gpu_index=0):
+        # 与patch_seg.py中--infer_type window相同的滑窗推断，只对需要重新计算的病例
+        self.model_path = model_path
+        self.add_frangi = add_frangi
+        self.crop_path = crop_path
+        self.pre_label_path = pre_label_path
+        self.p_size = p_size
+        self.batch_size = batch_size
+        self.record_path = record_path
+        self.blend = blend
+        self.gpu_index = gpu_index
+
+    def __call__(self, ID_list):
+        device = torch.device('cuda:%d' % self.gpu_index if torch.cuda.is_available() else 'cpu')
+        net = Unet(2, 3) if self.add_frangi == 1 else Unet_Patch(3, 1)
+        net.load_state_dict(torch.load(self.model_path, map_location=device))
+        window = Patch_inference(net.to(device), device, self.crop_path, self.pre_label_path, self.p_size,
+                                 self.batch_size * 2, self.add_frangi == 1, self.record_path, self.blend,
+                                 save_file_name='pre_crop.nii.gz')
+        window.run_all(ID_list)
+
+
+class Recover_task:
+    def __init__(self, pre_label_path, img_path, crop_dict_path, slots=None):
+        # crop_fold_k.npy在运行时才读取
+        self.pre_label_path = pre_label_path
+        self.img_path = img_path
+        self.crop_dict_path = crop_dict_path
+        self.slots = slots
+
+    def __call__(self, id):
+        crop_dict = np.load(self.crop_dict_path, allow_pickle=True).item()
+        Recover_Crop(self.pre_label_path, self.img_path, crop_dict, slots=self.slots).run(id)
+
+
+class Metric_task:
+    def __init__(self, metrics, pre_label_path):
+        # 每个病例的dice, ahd, hd保存为pre_label_path/id/metrics.npy
+        self.metrics = metrics
+        self.pre_label_path = pre_label_path
+
+    def __call__(self, id):
+        np.save(os.path.join(self.pre_label_path, id, 'metrics.npy'), np.array(self.metrics.calculate_dice(id)))
+
+
+class Result_task:
+    def __init__(self, pre_label_path, ID_list, save_path):
+        # 与patch_seg.py相同的result.csv
+        self.pre_label_path = pre_label_path
+        self.ID_list = ID_list
+        self.save_path = save_path
+
+    def __call__(self):
+        result = np.array([np.load(os.path.join(self.pre_label_path, i, 'metrics.npy')) for i in self.ID_list])
+        record_dice = dict()
+        record_dice['ID'] = self.ID_list
+        record_dice['dice'] = result[:, 0]
+        record_dice['ahd'] = result[:, 1]
+        record_dice['hd'] = result[:, 2]
+        pd.DataFrame(record_dice).to_csv(self.save_path, index=False)
+
+
+def add_fold(pipe, args, config, k, frangi_path):
+    '''
+    一个fold从裁剪到计算指标的节点，路径与patch_process.py, patch_seg.py相同
+    '''
+    img_path = config['General_parameters']['data_path']
+    csv_path = config['General_parameters']['csv_path']
+    mid_path = config['General_parameters']['mid_path']
+    coarse_version = args.Direct_model
+    direct_parameters = args.Direct_parameter
+    p_size = args.patch_size
+    fold = 'fold_%d' % k
+    # 节点名包含粗分割模型与fold，不同参数的节点在状态文件中互不影响
+    tag = '%s/%s/%s' % (coarse_version, direct_parameters, fold)
+
+    ID_dict = get_csv_split(csv_path, k)
+    id_list = ID_dict['train'] + ID_dict['valid']
+    p_path = os.path.join('result/Direct_seg', coarse_version, direct_parameters, fold, 'pre_label')
+    patch_path = os.path.join(mid_path, 'Patches', coarse_version, direct_parameters, fold)
+    crop_path = os.path.join(patch_path, 'crop')
+    crop_dict_path = os.path.join(patch_path, 'crop_fold_%d.npy' % k)
+    record_path = os.path.join(patch_path, 'patch_%d' % p_size, 'csv_patch_record')
+    parameter_record = 'frangi_%d_%s_%s_%d' % (
+        args.frangi, str(args.flip_prob).split('.')[-1], str(args.rotate_prob).split('.')[-1], p_size)
+    result_path = os.path.join('result/Patch_seg', coarse_version, direct_parameters, parameter_record, fold,
+                               'patch_%d' % p_size)
+    pre_label_path = os.path.join(result_path, 'pre_label')
+    crop_files = [os.path.join(crop_path, '{id}', n) for n in ['img.nii.gz', 'label.nii.gz', 'frangi.nii.gz']]
+
+    pipe.add(Node('crop/%s' % tag, Crop_task(Crop_pre(p_path, img_path, crop_path, frangi_path), crop_path),
+                  [os.path.join(p_path, '{id}', 'pre_label.nii.gz'), os.path.join(img_path, '{id}', 'img.nii.gz'),
+                   os.path.join(img_path, '{id}', 'label.nii.gz'), os.path.join(frangi_path, '{id}', 'frangi.nii.gz')],
+                  crop_files + [os.path.join(crop_path, '{id}', 'box.npy')], id_list))
+    pipe.add(Node('crop_dict/%s' % tag, Crop_dict_task(crop_path, id_list, crop_dict_path),
+                  [os.path.join(crop_path, '{id}', 'box.npy')], [crop_dict_path], id_list, per_case=False))
+
+    train_inputs = [t.format(id=i) for t in crop_files for i in id_list]
+    record_inputs = []
+    if args.save_type != 'online':
+        train_inputs = []
+        for dt in ['train', 'valid']:
+            record = [os.path.join(record_path, '{id}.%s' % t) for t in ['csv', 'npz']
+                      if args.record_type in [t, 'both']]
+            stack_path = os.path.join(patch_path, 'patch_%d' % p_size, '%s_patch_stack' % dt)
+            stack = [os.path.join(stack_path, '{id}.npy'), os.path.join(stack_path, '{id}_record.npz')] \
+                if args.save_type == 'npy' else []
+            get_patch_opt = Get_patch(crop_path, crop_path, crop_path, patch_path, p_size, dt,
+                                      save_type=args.save_type, record_type=args.record_type)
+            pipe.add(Node('patch_%d_%s/%s' % (p_size, dt, tag), get_patch_opt.run_main, crop_files, record + stack,
+                          ID_dict[dt], params=[args.save_type, args.record_type]))
+            train_inputs += [t.format(id=i) for t in record + stack for i in ID_dict[dt]]
+            if dt == 'valid':
+                record_inputs = record
+
+    # 与patch_seg.py相同，每5个epoch保存一次模型
+    last_epoch = (args.epochs - 1) // 5 * 5
+    model_path = os.path.join(result_path, 'model_save', 'net_%d.pkl' % last_epoch)
+    cmd = [sys.executable, 'patch_seg.py', '--fold', str(k), '--patch_size', str(p_size), '--frangi', str(args.frangi),
+           '--flip_prob', str(args.flip_prob), '--rotate_prob', str(args.rotate_prob), '--batch_size',
+           str(args.batch_size), '--epochs', str(args.epochs), '--save_type', args.save_type, '--Direct_model',
+           coarse_version, '--Direct_parameter', direct_parameters, '--gpu_index', str(args.gpu_index),
+           '--is_train', '1', '--is_inference', '0', '--load_num', '0']
+    pipe.add(Node('train/%s/%s' % (tag, parameter_record), Command_task(cmd), train_inputs, [model_path],
+                  per_case=False, params=cmd[2:]))
+
+    valid_list = ID_dict['valid']
+    infer_inputs = [model_path, os.path.join(crop_path, '{id}', 'img.nii.gz')]
+    if args.frangi == 1:
+        infer_inputs.append(os.path.join(crop_path, '{id}', 'frangi.nii.gz'))
+    infer_inputs += record_inputs
+    pipe.add(Node('infer/%s/%s' % (tag, parameter_record),
+                  Infer_task(model_path, args.frangi, crop_path, pre_label_path, p_size, args.batch_size, record_path,
+                             args.blend, args.gpu_index),
+                  infer_inputs, [os.path.join(pre_label_path, '{id}', 'pre_crop.nii.gz')], valid_list, batch=True,
+                  params=[args.blend, args.batch_size]))
+    # 恢复裁剪的结果放在共享内存中，计算指标时不再从gzip读取
+    slots = get_executor(args.pools).slots
+    pipe.add(Node('recover/%s/%s' % (tag, parameter_record),
+                  Recover_task(pre_label_path, img_path, crop_dict_path, slots),
+                  [os.path.join(pre_label_path, '{id}', 'pre_crop.nii.gz'), crop_dict_path,
+                   os.path.join(img_path, '{id}', 'img.nii.gz')],
+                  [os.path.join(pre_label_path, '{id}', 'pre_label.nii.gz')], valid_list))
+    pipe.add(Node('metrics/%s/%s' % (tag, parameter_record),
+                  Metric_task(Cal_metrics(pre_label_path, crop_path, p_size, slots=slots), pre_label_path),
+                  [os.path.join(pre_label_path, '{id}', 'pre_label.nii.gz'),
+                   os.path.join(crop_path, '{id}', 'label.nii.gz')],
+                  [os.path.join(pre_label_path, '{id}', 'metrics.npy')], valid_list))
+    pipe.add(Node('result/%s/%s' % (tag, parameter_record),
+                  Result_task(pre_label_path, valid_list, os.path.join(result_path, 'result.csv')),
+                  [os.path.join(pre_label_path, '{id}', 'metrics.npy')], [os.path.join(result_path, 'result.csv')],
+                  valid_list, per_case=False))
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='cmd parameters')
+    p.add_argument('--config_file', type=str, default='config/config.yaml')
+    p.add_argument('--fold', type=int, nargs='+', default=[1])
+    p.add_argument('--Direct_model', type=str, default='FCN')
+    p.add_argument('--Direct_parameter', type=str, default='Low_resolution_4_Dice')
+    p.add_argument('--pools', type=int, default=32)
+    p.add_argument('--patch_size', type=int, default=32)
+    p.add_argument('--save_type', type=str, default='npy')
+    p.add_argument('--record_type', type=str, default='csv')
+    p.add_argument('--frangi', type=int, default=0)
+    p.add_argument('--frangi_engine', type=str, default='skimage', help='skimage:整幅图像ridges.frangi ; block:分块float32')
+    p.add_argument('--frangi_truncate', type=float, default=8, help='block引擎的高斯核截断倍数，0:与skimage完全相同')
+    p.add_argument('--flip_prob', type=float, default=0.2)
+    p.add_argument('--rotate_prob', type=float, default=0.2)
+    p.add_argument('--batch_size', type=int, default=64)
+    p.add_argument('--epochs', type=int, default=30)
+    p.add_argument('--gpu_index', type=int, default=0)
+    p.add_argument('--blend', type=str, default='max')
+    p.add_argument('--targets', type=str, nargs='*', default=None, help='只运行这些节点及其上游')
+    p.add_argument('--force', type=str, nargs='*', default=[], help='这些节点全部重新计算')
+    p.add_argument('--dry_run', type=int, default=0)
+    args = p.parse_args()
+
+    with open(args.config_file) as f:
+        config = yaml.load(f)
+    img_path = config['General_parameters']['data_path']
+    csv_path = config['General_parameters']['csv_path']
+    mid_path = config['General_parameters']['mid_path']
+
+    pipe = Pipeline(os.path.join(mid_path, 'pipeline_state.json'), args.pools)
+    # Frangi与fold无关，所有fold共用
+    frangi_path = os.path.join(mid_path, 'Frangi')
+    all_id = sorted(set(i for k in args.fold for v in get_csv_split(csv_path, k).values() for i in v))
+    # 与patch_process.py相同，引擎及其参数改变时重新计算
+    engine = Frangi_engine(truncate=args.frangi_truncate if args.frangi_truncate > 0 else None) \
+        if args.frangi_engine == 'block' else None
+    pipe.add(Node('frangi', Frangi(img_path, frangi_path, engine=engine).run_enhance,
+                  [os.path.join(img_path, '{id}', 'img.nii.gz')], [os.path.join(frangi_path, '{id}', 'frangi.nii.gz')],
+                  all_id, params=[args.frangi_engine] + ([] if engine is None else [engine.key()])))
+    for k in args.fold:
+        add_fold(pipe, args, config, k, frangi_path)
+
+    summary = pipe.run(args.targets, args.dry_run == 1, args.force)
+    for name, (todo, total, t) in summary.items():
+        print('%s | %d/%d | %.1fs' % (name, todo, total, t))
+    print(get_executor().report())
@@ -1,9 +1,9 @@
-from utils.Frangi_filter import Frangi
+from utils.Frangi_filter import Frangi, Frangi_engine
 from utils.Crop_box import Crop_pre
 from utils.Get_patch import Get_patch
 from utils.utils import get_csv_split
+from utils.Executor import get_executor
 import yaml
-import multiprocessing
 import argparse
 import os
 import pandas as pd
@@ -17,7 +17,14 @@ if __name__ == '__main__':
     p.add_argument('--Direct_model',type=str,default='FCN')
     p.add_argument('--Direct_parameter',type=str,default='Mid_resolution_4_Dice')
     p.add_argument('--pools',type=int,default=4)
+    p.add_argument('--save_type',type=str,default='nii')
+    p.add_argument('--record_type',type=str,default='csv')
     p.add_argument('--patch_size',type=int,default=32)
+    p.add_argument('--frangi_engine',type=str,default='skimage',help='skimage:整幅图像ridges.frangi ; block:分块float32，高斯导数与skimage相同')
+    p.add_argument('--frangi_truncate',type=float,default=8,help='block引擎的高斯核截断倍数，0:与skimage完全相同(halo很大，很慢)')
+    p.add_argument('--frangi_roi',type=int,default=0,help='1:只在粗分割膨胀后的区域内计算Frangi')
+    p.add_argument('--roi_radius',type=int,default=10)
+    p.add_argument('--frangi_box',type=int,default=0,help='1:先裁剪，只在裁剪框内计算Frangi，结果按tile缓存')
 
     args = p.parse_args()
     k = args.fold
@@ -25,7 +32,12 @@ if __name__ == '__main__':
     coarse_version=args.Direct_model
     direct_parameters =args.Direct_parameter
     pool_num=args.pools
+    save_type=args.save_type
+    record_type=args.record_type
     patch_size=args.patch_size
+    frangi_roi=args.frangi_roi
+    frangi_box=args.frangi_box
+    frangi_truncate=args.frangi_truncate if args.frangi_truncate > 0 else None
 
     # 根据预分割进行裁剪
     with open(config_file) as f:
@@ -39,39 +51,55 @@ if __name__ == '__main__':
     patch_path = os.path.join(mid_path,'Patches',coarse_version,direct_parameters,'fold_%d'% k)
     p_path = os.path.join('result/Direct_seg',coarse_version,direct_parameters,'fold_%d' % k, 'pre_label')
     save_enhance=os.path.join(mid_path,'Frangi')
+    if frangi_roi:
+        # 依赖粗分割，按粗分割模型与fold分别保存
+        save_enhance=os.path.join(mid_path,'Frangi',coarse_version,direct_parameters,'fold_%d' % k)
 
+    # 各个阶段共用一个常驻进程池
+    executor = get_executor(pool_num)
     id_dict = get_csv_split(csv_path, k)
     id_list = id_dict['train'] + id_dict['valid']
 
-    if not os.path.exists(save_enhance):
+    if frangi_box:
+        # 裁剪框内的Frangi直接保存在crop中，不同fold与粗分割模型共用tile缓存
+        save_enhance=None
+        frangi_cache=os.path.join(mid_path,'Frangi','cache')
+
+    if save_enhance is not None and not os.path.exists(save_enhance):
         ## 滤波
         print('Frangi..........')
-        frangi_opt = Frangi(img_path, save_enhance)
-        p = multiprocessing.Pool(pool_num)
-        p.map_async(frangi_opt.run_enhance, id_list)
-        p.close()
-        p.join()
+        engine = Frangi_engine(truncate=frangi_truncate) if args.frangi_engine == 'block' else None
+        frangi_opt = Frangi(img_path, save_enhance, engine=engine, roi_path=p_path if frangi_roi else None,
+                            roi_radius=args.roi_radius)
+        executor.map(frangi_opt.run_enhance, id_list)
 
     # # 裁剪
     if not os.path.exists(os.path.join(mid_path,'patches',coarse_version,direct_parameters,'fold_%d'% k,'crop_fold_%d.npy'%k)):
         print('crop...........')
         crop_opt = Crop_pre(p_path, img_path, crop_path, save_enhance)
-        p = multiprocessing.Pool(pool_num)
-        crop_box = p.map(crop_opt.run_crop, id_list)
-        p.close()
-        p.join()
+        crop_box = executor.map(crop_opt.run_crop, id_list)
 
         record_box = {}
         record_box['ID'] = id_list
         record_box['box'] = crop_box
         np.save(os.path.join(mid_path,'patches',coarse_version,direct_parameters,'fold_%d'% k,'crop_fold_%d.npy'%k), record_box)
 
-    # 获取体素块
-    for p_size in [patch_size]:
-        for dt in ['train', 'valid']:
-            print('get_patch %s %d' % (dt, p_size))
-            get_patch_opt = Get_patch(crop_path, crop_path, crop_path, patch_path, p_size, dt)
-            p = multiprocessing.Pool(pool_num)
-            p.map(get_patch_opt.run_main, id_dict[dt])
-            p.close()
-            p.join()
+    if frangi_box:
+        print('Frangi in crop box..........')
+        crop_dict = np.load(os.path.join(mid_path,'patches',coarse_version,direct_parameters,'fold_%d'% k,'crop_fold_%d.npy'%k),
+                            allow_pickle=True).item()
+        frangi_opt = Frangi(img_path, crop_path, engine=Frangi_engine(truncate=frangi_truncate), cache_path=frangi_cache)
+        box_list = [(i, crop_dict['box'][crop_dict['ID'].index(i)]) for i in id_list
+                    if not os.path.exists(os.path.join(crop_path, i, 'frangi.nii.gz'))]
+        executor.starmap(frangi_opt.run_box, box_list)
+
+    # 获取体素块，online模式在训练时直接从crop中切片
+    if save_type != 'online':
+        for p_size in [patch_size]:
+            for dt in ['train', 'valid']:
+                print('get_patch %s %d' % (dt, p_size))
+                get_patch_opt = Get_patch(crop_path, crop_path, crop_path, patch_path, p_size, dt, save_type=save_type,
+                                          record_type=record_type)
+                executor.map(get_patch_opt.run_main, id_dict[dt])
+
+    print(executor.report())
@@ -1,21 +1,24 @@
 import torch
 import argparse
 import os
+import sys
 import numpy as np
 import nibabel as nib
 import torch.optim as optim
 import torch.nn as nn
-import multiprocessing
 import pandas as pd
 import yaml
 import time
 from model.CNN_model import Unet, Unet_Patch
 from tqdm import tqdm
 from utils.parallel import parallel
+from utils.Executor import get_executor
 from utils.Calculate_metrics import Cal_metrics
 from utils.Recover_patch import Recover_patch
+from utils.Inference_patch import Patch_inference
 from utils.utils import Transform
-from data.Patch_loader import CoronaryImagePatch, CoronaryImageEnhance
+from data.Patch_loader import CoronaryImagePatch, CoronaryImageEnhance, CoronaryPatchStack, CoronaryPatchOnline, \
+    Seeded_sampler
 from utils.utils import get_csv_split
 from torch.utils.data import DataLoader
 from model.loss import DiceLoss
@@ -55,8 +58,8 @@ def valid(model, criterion, valid_loader, device, e):
     return valid_sum / len(valid_loader)
 
 
-def inference(model, train_loader, valid_loader, device, save_img_path, is_infer_train=False):
-    # 得到预测的标签以及重构
+def inference(model, train_loader, valid_loader, device, save_img_path, is_infer_train=False, recover=None):
+    # 得到预测的标签以及重构，recover不为None时验证集的预测直接融合为3D图像，不保存patch
     model.eval()
     if is_infer_train:
         for batch in tqdm(train_loader):
@@ -84,6 +87,9 @@ def inference(model, train_loader, valid_loader, device, save_img_path, is_infer
         pre = outputs.cpu().detach().numpy()
         ID = batch['image_index']
         affine = batch['affine']
+        if recover is not None:
+            recover.add_batch(ID, pre, affine)
+            continue
         os.makedirs(os.path.join(save_img_path), exist_ok=True)
         batch_save(ID, affine, pre, save_img_path)
 
@@ -114,6 +120,7 @@ def args_input():
     p.add_argument('--pools', type=int, default=32)
     p.add_argument('--num_workers', type=int, default=8)
     p.add_argument('--is_inference', type=int, default=1)
+    p.add_argument('--is_infer_train', type=int, default=0)
     p.add_argument('--loss', type=str, default='Dice')
     p.add_argument('--frangi', type=int, default=0)
     p.add_argument('--flip_prob', type=float, default=0.2)
@@ -121,6 +128,9 @@ def args_input():
     # p.add_argument('--patch_size', type=int, default=32)
     p.add_argument('--Direct_parameter', type=str, default='Low_resolution_4_Dice')
     p.add_argument('--epochs', type=int, default=30)
+    p.add_argument('--save_type', type=str, default='nii')
+    p.add_argument('--blend', type=str, default='max')
+    p.add_argument('--infer_type', type=str, default='patch')
     return p.parse_args()
 
 
@@ -137,6 +147,9 @@ if __name__ == '__main__':
     rotate_prob = args.rotate_prob
     direct_parameters = args.Direct_parameter
     epochs=args.epochs
+    save_type = args.save_type
+    blend = args.blend
+    infer_type = args.infer_type
 
     parameter_record = 'frangi_%d_%s_%s_%d' % (
     add_frangi, str(flip_prob).split('.')[-1], str(rotate_prob).split('.')[-1], p_size)
@@ -181,6 +194,12 @@ if __name__ == '__main__':
     valid_enhance_path = os.path.join(patch_path, 'patch_%d' % p_size, 'valid_enhance_patch')
 
     csv_record_path = os.path.join(patch_path, 'patch_%d' % p_size, 'csv_patch_record')
+    # online的位置表为npz，与Get_patch保存的csv分开存放
+    online_record_path = os.path.join(patch_path, 'patch_%d' % p_size, 'online_record')
+    record_path = online_record_path if save_type == 'online' else csv_record_path
+    train_stack_path = os.path.join(patch_path, 'patch_%d' % p_size, 'train_patch_stack')
+    valid_stack_path = os.path.join(patch_path, 'patch_%d' % p_size, 'valid_patch_stack')
+    crop_cache_path = os.path.join(patch_path, 'crop_cache')
 
     ID_list = get_csv_split(csv_path, k)
 
@@ -198,10 +217,27 @@ if __name__ == '__main__':
     trans = Transform(flip_prob, rotate_prob)
 
     # 数据加载
-    train_set = Data_set(train_data_path, train_label_path, train_enhance_path, transform=trans.transform)
-    valid_set = Data_set(valid_data_path, valid_label_path, valid_enhance_path, transform=trans.transform)
-    train_loader = DataLoader(train_set, batch_size, num_workers=8, shuffle=True)
-    valid_loader = DataLoader(valid_set, batch_size, num_workers=8, shuffle=False)
+    if save_type == 'npy':
+        train_set = CoronaryPatchStack(train_stack_path, ID_list['train'], add_frangi == 1, transform=trans.transform)
+        valid_set = CoronaryPatchStack(valid_stack_path, ID_list['valid'], add_frangi == 1, transform=trans.transform)
+    elif save_type == 'online':
+        # 读入病例并计算位置表，只推断时不需要
+        if args.is_train == 1:
+            train_set = CoronaryPatchOnline(crop_path, ID_list['train'], p_size, 'centerline', add_frangi == 1,
+                                            trans.transform, k, online_record_path, crop_cache_path)
+            valid_set = CoronaryPatchOnline(crop_path, ID_list['valid'], p_size, 'grid', add_frangi == 1,
+                                            trans.transform, k, online_record_path, crop_cache_path)
+    else:
+        train_set = Data_set(train_data_path, train_label_path, train_enhance_path, transform=trans.transform)
+        valid_set = Data_set(valid_data_path, valid_label_path, valid_enhance_path, transform=trans.transform)
+    if save_type == 'online':
+        if args.is_train == 1:
+            train_sampler = Seeded_sampler(train_set, k)
+            train_loader = DataLoader(train_set, batch_size, num_workers=8, sampler=train_sampler)
+            valid_loader = DataLoader(valid_set, batch_size, num_workers=8, shuffle=False)
+    else:
+        train_loader = DataLoader(train_set, batch_size, num_workers=8, shuffle=True)
+        valid_loader = DataLoader(valid_set, batch_size, num_workers=8, shuffle=False)
 
     model_list = os.listdir(model_save_path)
     if load_num == 0:
@@ -222,6 +258,8 @@ if __name__ == '__main__':
     if args.is_train == 1:
         for e in range(load_num, epochs):
             t0 = time.time()
+            if save_type == 'online':
+                train_sampler.set_epoch(e)
             train_loss = train(net, criterion, train_loader, net_opt, device, e)
             # valid_loss = valid(net, criterion, valid_loader, device, e)
             train_loss_set.append(train_loss)
@@ -241,39 +279,60 @@ if __name__ == '__main__':
         record.to_csv(r'result/Patch_seg/%s/%s/%s/fold_%d/patch_%d/%s' % (
         coarse_version, direct_parameters, parameter_record, k, p_size, record_name), index=False)
 
+    if args.is_inference == 0:
+        # 只训练，推断由patch_pipeline.py按病例进行
+        sys.exit()
+
     # 推断
     print("inference.....")
-    train_set = Data_set(train_data_path, train_enhance_path, train_label_path, transform=None)
-    valid_set = Data_set(valid_data_path, valid_enhance_path, valid_label_path, transform=None)
-    train_infer_loader = DataLoader(train_set, batch_size * 2, shuffle=False, num_workers=8)
+    if save_type == 'npy':
+        train_set = CoronaryPatchStack(train_stack_path, ID_list['train'], add_frangi == 1, transform=None)
+        valid_set = CoronaryPatchStack(valid_stack_path, ID_list['valid'], add_frangi == 1, transform=None)
+    elif save_type == 'online':
+        # 训练集只在is_infer_train时推断，否则不读入
+        train_set = CoronaryPatchOnline(crop_path, ID_list['train'], p_size, 'centerline', add_frangi == 1, None, k,
+                                        online_record_path, crop_cache_path) if args.is_infer_train == 1 else None
+        valid_set = CoronaryPatchOnline(crop_path, ID_list['valid'], p_size, 'grid', add_frangi == 1, None, k,
+                                        online_record_path, crop_cache_path)
+    else:
+        train_set = Data_set(train_data_path, train_enhance_path, train_label_path, transform=None)
+        valid_set = Data_set(valid_data_path, valid_enhance_path, valid_label_path, transform=None)
+    train_infer_loader = None if train_set is None else DataLoader(train_set, batch_size * 2, shuffle=False,
+                                                                   num_workers=8)
     valid_infer_loader = DataLoader(valid_set, batch_size, shuffle=False, num_workers=32)
 
-    inference(net, train_infer_loader, valid_infer_loader, device, pre_patch_path)
-
-    print('Recover Patch......')
-    recover = Recover_patch(p_size, pre_patch_path, csv_record_path,
-                            pre_label_path, crop_path, save_file_name='pre_crop.nii.gz')
-    p = multiprocessing.Pool(48)
-    p.map(recover.run_recover, ID_list['valid'])
-    p.close()
-    p.join()
+    # 恢复patch、恢复裁剪、计算指标共用常驻进程池，每个病例的图像解压一次后放在共享内存中
+    executor = get_executor(48)
+    recover = Recover_patch(p_size, pre_patch_path, record_path,
+                            pre_label_path, crop_path, save_file_name='pre_crop.nii.gz', mode=blend,
+                            slots=executor.slots)
+    if infer_type == 'window':
+        # 从crop图像直接滑窗推断，每个病例只写出pre_crop.nii.gz
+        window = Patch_inference(net, device, crop_path, pre_label_path, p_size, batch_size * 2, add_frangi == 1,
+                                 record_path, blend, save_file_name='pre_crop.nii.gz')
+        window.run_all(ID_list['valid'])
+    elif save_type == 'nii':
+        inference(net, train_infer_loader, valid_infer_loader, device, pre_patch_path, args.is_infer_train == 1)
+
+        print('Recover Patch......')
+        executor.map(recover.run_recover, ID_list['valid'])
+    else:
+        # 验证集patch按病例顺序读取，预测直接融合为pre_crop.nii.gz
+        inference(net, train_infer_loader, valid_infer_loader, device, pre_patch_path, args.is_infer_train == 1,
+                  recover=recover)
 
     print('Recover Crop.....')
     crop_dict = np.load(crop_dict_path, allow_pickle=True).item()
     print(crop_dict)
-    recover_crop = Recover_Crop(pre_label_path, img_path, crop_dict)
-    p = multiprocessing.Pool(48)
-    p.map(recover_crop.run, ID_list['valid'])
-    p.close()
-    p.join()
+    recover_crop = Recover_Crop(pre_label_path, img_path, crop_dict, slots=executor.slots)
+    executor.map(recover_crop.run, ID_list['valid'])
 
     print('calculate dice.......')
     # crop_path = os.path.join(crop_path, coarse_version, 'crop_fold_%d.npy' % k)
-    CD = Cal_metrics(pre_label_path, crop_path, p_size)
-    p = multiprocessing.Pool(48)
-    result = p.map(CD.calculate_dice, ID_list['valid'])
-    p.close()
-    p.join()
+    CD = Cal_metrics(pre_label_path, crop_path, p_size, slots=executor.slots)
+    result = executor.map(CD.calculate_dice, ID_list['valid'])
+    print(executor.report())
+    executor.slots.clear()
 
     # 保存结果
     record_dice = dict()
@@ -1,7 +1,7 @@
 from utils.utils import get_csv_split
 from utils.Get_patch_based_centerline import Get_patch_from_pre
 import yaml
-import multiprocessing
+from utils.Executor import get_executor
 import argparse
 import os
 
@@ -12,6 +12,8 @@ if __name__ == '__main__':
     p.add_argument('--Direct_model',type=str,default='FCN')
     p.add_argument('--Direct_parameter',type=str,default='Mid_resolution_4_Dice')
     p.add_argument('--pools',type=int,default=4)
+    p.add_argument('--save_type',type=str,default='nii')
+    p.add_argument('--record_type',type=str,default='csv')
 
     args = p.parse_args()
     k = args.fold
@@ -19,6 +21,8 @@ if __name__ == '__main__':
     coarse_version=args.Direct_model
     direct_parameters =args.Direct_parameter
     pool_num=args.pools
+    save_type=args.save_type
+    record_type=args.record_type
 
     print('coarse_version:',coarse_version)
 
@@ -39,8 +43,6 @@ if __name__ == '__main__':
     for p_size in [64,32,16]:
         for dt in ['train', 'valid']:
             print('get_patch %s %d' % (dt, p_size))
-            get_patch_opt = Get_patch_from_pre(img_path, img_path, p_path, patch_path, p_size, dt)
-            p = multiprocessing.Pool(pool_num)
-            p.map(get_patch_opt.run, id_dict[dt])
-            p.close()
-            p.join()
+            get_patch_opt = Get_patch_from_pre(img_path, img_path, p_path, patch_path, p_size, dt, save_type=save_type,
+                                               record_type=record_type)
+            get_executor(pool_num).map(get_patch_opt.run, id_dict[dt])
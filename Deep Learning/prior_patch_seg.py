@@ -5,7 +5,7 @@ import numpy as np
 import nibabel as nib
 import torch.optim as optim
 import torch.nn as nn
-import multiprocessing
+from utils.Executor import get_executor
 import pandas as pd
 import yaml
 import time
@@ -14,8 +14,9 @@ from tqdm import tqdm
 from utils.parallel import parallel
 from utils.Calculate_metrics import Cal_metrics
 from utils.Recover_patch import Recover_patch
+from utils.Inference_patch import Patch_inference
 from utils.utils import Transform
-from data.Patch_loader import CoronaryImagePatch, CoronaryImageEnhance
+from data.Patch_loader import CoronaryImagePatch, CoronaryImageEnhance, CoronaryPatchStack
 from utils.utils import get_csv_split
 from torch.utils.data import DataLoader
 from model.loss import DiceLoss
@@ -120,6 +121,9 @@ def args_input():
     # p.add_argument('--patch_size', type=int, default=32)
     p.add_argument('--Direct_parameter', type=str, default='Mid_resolution_4_Dice')
     p.add_argument('--epochs', type=int, default=30)
+    p.add_argument('--save_type', type=str, default='nii')
+    p.add_argument('--blend', type=str, default='max')
+    p.add_argument('--infer_type', type=str, default='patch')
     return p.parse_args()
 
 
@@ -135,6 +139,9 @@ if __name__ == '__main__':
     rotate_prob = args.rotate_prob
     direct_parameters = args.Direct_parameter
     epochs=args.epochs
+    save_type = args.save_type
+    blend = args.blend
+    infer_type = args.infer_type
     parameter_record = '%s' % direct_parameters
 
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu_index)
@@ -175,6 +182,8 @@ if __name__ == '__main__':
     valid_enhance_path = os.path.join(patch_path, 'patch_%d' % p_size, 'valid_enhance_patch')
 
     csv_record_path = os.path.join(patch_path, 'patch_%d' % p_size, 'csv_patch_record')
+    train_stack_path = os.path.join(patch_path, 'patch_%d' % p_size, 'train_patch_stack')
+    valid_stack_path = os.path.join(patch_path, 'patch_%d' % p_size, 'valid_patch_stack')
 
     ID_list = get_csv_split(csv_path, k)
 
@@ -183,8 +192,12 @@ if __name__ == '__main__':
     trans = Transform(flip_prob, rotate_prob)
 
     # 数据加载
-    train_set = Data_set(train_data_path, train_label_path, train_enhance_path, transform=trans.transform)
-    valid_set = Data_set(valid_data_path, valid_label_path, valid_enhance_path, transform=trans.transform)
+    if save_type == 'npy':
+        train_set = CoronaryPatchStack(train_stack_path, ID_list['train'], transform=trans.transform)
+        valid_set = CoronaryPatchStack(valid_stack_path, ID_list['valid'], transform=trans.transform)
+    else:
+        train_set = Data_set(train_data_path, train_label_path, train_enhance_path, transform=trans.transform)
+        valid_set = Data_set(valid_data_path, valid_label_path, valid_enhance_path, transform=trans.transform)
     train_loader = DataLoader(train_set, batch_size, num_workers=8, shuffle=True)
     valid_loader = DataLoader(valid_set, batch_size, num_workers=8, shuffle=False)
 
@@ -229,28 +242,32 @@ if __name__ == '__main__':
 
     # 推断
     print("inference.....")
-    train_set = Data_set(train_data_path, train_label_path,train_enhance_path , transform=None)
-    valid_set = Data_set(valid_data_path, valid_label_path,valid_enhance_path,  transform=None)
+    if save_type == 'npy':
+        train_set = CoronaryPatchStack(train_stack_path, ID_list['train'], transform=None)
+        valid_set = CoronaryPatchStack(valid_stack_path, ID_list['valid'], transform=None)
+    else:
+        train_set = Data_set(train_data_path, train_label_path,train_enhance_path , transform=None)
+        valid_set = Data_set(valid_data_path, valid_label_path,valid_enhance_path,  transform=None)
     train_infer_loader = DataLoader(train_set, batch_size * 2, shuffle=False, num_workers=8)
     valid_infer_loader = DataLoader(valid_set, batch_size, shuffle=False, num_workers=32)
 
-    inference(net, train_infer_loader, valid_infer_loader, device, pre_patch_path)
+    if infer_type == 'window':
+        # patch位置来自先验中心线的记录，从原图直接推断，每个病例只写出pre_label.nii.gz
+        window = Patch_inference(net, device, img_path, pre_label_path, p_size, batch_size, False, csv_record_path,
+                                 blend, save_file_name='pre_label.nii.gz')
+        window.run_all(ID_list['valid'])
+    else:
+        inference(net, train_infer_loader, valid_infer_loader, device, pre_patch_path)
 
-    print('Recover Patch......')
-    recover = Recover_patch(p_size, pre_patch_path, csv_record_path,
-                            pre_label_path, img_path, save_file_name='pre_label.nii.gz')
-    p = multiprocessing.Pool(48)
-    p.map(recover.run_recover, ID_list['valid'])
-    p.close()
-    p.join()
+        print('Recover Patch......')
+        recover = Recover_patch(p_size, pre_patch_path, csv_record_path,
+                                pre_label_path, img_path, save_file_name='pre_label.nii.gz', mode=blend)
+        get_executor(48).map(recover.run_recover, ID_list['valid'])
 
     print('calculate dice.......')
     # crop_path = os.path.join(crop_path, coarse_version, 'crop_fold_%d.npy' % k)
     CD = Cal_metrics(pre_label_path, img_path, p_size)
-    p = multiprocessing.Pool(48)
-    result = p.map(CD.calculate_dice, ID_list['valid'])
-    p.close()
-    p.join()
+    result = get_executor(48).map(CD.calculate_dice, ID_list['valid'])
 
     # 保存结果
     record_dice = dict()
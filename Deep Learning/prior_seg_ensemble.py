@@ -3,7 +3,7 @@ import nibabel as nib
 from scipy.ndimage.interpolation import zoom
 from os.path import join
 from os import listdir
-import multiprocessing
+from utils.Executor import get_executor
 from utils.utils import get_csv_split
 import argparse
 import yaml
@@ -91,18 +91,12 @@ if __name__ == '__main__':
 
     # Ensemble
     print('Ensemble............')
-    p = multiprocessing.Pool(pool_num)
-    p.map(Ec.process, ID_list)
-    p.close()
-    p.join()
+    get_executor(pool_num).map(Ec.process, ID_list)
 
     # Calculate_dice
     print('Calculate_dice.......')
     Cd = Cal_metrics(save_path, img_path, pre_label_name='add_%d.nii.gz' % is_add)
-    p = multiprocessing.Pool(pool_num)
-    res = p.map(Cd.calculate_dice, ID_list)
-    p.close()
-    p.join()
+    res = get_executor(pool_num).map(Cd.calculate_dice, ID_list)
 
     dice_list = []
     ahd_list = []
@@ -4,7 +4,7 @@ import yaml
 import os
 import nibabel as nib
 import numpy as np
-import multiprocessing
+from utils.Executor import get_executor
 import argparse
 from utils.Calculate_metrics import get_region_num
 import time
@@ -49,10 +49,7 @@ if __name__ == '__main__':
     for dt in ['train', 'valid']:
         convert_tree = Convert_tree(pre_seg_path, img_path, img_path, tree_path, dt, (patch_size, patch_size, z_size))
         print('convert_tree %s' % dt)
-        p = multiprocessing.Pool(pool_num)
-        p.map(convert_tree.run_convert, id_dict[dt])
-        p.close()
-        p.join()
+        get_executor(pool_num).map(convert_tree.run_convert, id_dict[dt])
 
     # t2=time.time()
     # print('所用时间：',t2-t1)
@@ -16,7 +16,7 @@ import pandas as pd
 import time
 from utils.Make_tree import Recover_img
 from utils.Calculate_metrics import Cal_metrics
-import multiprocessing
+from utils.Executor import get_executor
 import numpy as np
 
 
@@ -254,17 +254,11 @@ if __name__ == '__main__':
     # 复原图像
     print('recover .......')
     recover_opt = Recover_img(data_path, recover_path, save_graph_path,save_file_name='pre_label.nii.gz')
-    p = multiprocessing.Pool(pool_num)
-    p.map(recover_opt.recover_img_run, id_dict['valid'])
-    p.close()
-    p.join()
+    get_executor(pool_num).map(recover_opt.recover_img_run, id_dict['valid'])
 
     print('calculate dice.......')
     CD = Cal_metrics(recover_path, data_path, p_size)
-    p = multiprocessing.Pool(pool_num)
-    result = p.map(CD.calculate_dice, id_dict['valid'])
-    p.close()
-    p.join()
+    result = get_executor(pool_num).map(CD.calculate_dice, id_dict['valid'])
 
     record_dice=dict()
     record_dice['ID'] = id_dict['valid']
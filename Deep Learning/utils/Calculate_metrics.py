@@ -2,6 +2,8 @@ import nibabel
 import numpy as np
 import os
 from skimage.measure import label
+from scipy.ndimage import binary_erosion
+from scipy.spatial import cKDTree
 import SimpleITK as sitk
 
 
@@ -26,23 +28,86 @@ def HausdorffDistance(y_true, y_pred, spaceing):
     return AvgHD, HD
 
 
-def get_region_num(img, get_num):
+def surface_mask(mask):
+    # 与背景有面相邻的前景体素，图像边界上的前景也算作表面
+    return mask & ~binary_erosion(mask)
+
+
+def directed_distance(tree, points, n):
+    # points为不在另一个标签内的前景体素，标签内的体素距离为0；返回最大值与n个前景体素的平均值
+    if points.shape[0] == 0:
+        return 0.0, 0.0
+    dist = tree.query(points)[0]
+    return dist.max(), dist.sum() / n
+
+
+def seg_metrics(y_true, y_pred, spacing=(1.0, 1.0, 1.0), percentile=95):
+    '''
+    由两个标签的表面体素一起得到Dice, HD, AHD, HD95, ASSD，可以直接输入内存中的数组
+    标签外的体素到标签的最近距离就是到标签表面的最近距离，标签内的体素距离为0，
+    所以只需要对表面体素建KD树，HD与AHD和SimpleITK按全部前景体素的定义相同
+    :param y_true: 真实标签，>0.5为前景
+    :param y_pred: 预测标签，>0.5为前景
+    :param spacing: 与数组各轴对应的体素间距
+    :param percentile: HD95使用的分位数
+    :return: dict dice, hd, ahd, hd95, assd ；有一个标签为空时距离指标为nan
+    '''
+    true = (np.asarray(y_true) > 0.5).astype(np.uint8)
+    pre = (np.asarray(y_pred) > 0.5).astype(np.uint8)
+    n_true = np.count_nonzero(true)
+    n_pre = np.count_nonzero(pre)
+    metrics = dict()
+    metrics['dice'] = 2 * np.count_nonzero(true & pre) / (n_true + n_pre) if n_true + n_pre > 0 else np.nan
+    if n_true == 0 or n_pre == 0:
+        metrics.update(hd=np.nan, ahd=np.nan, hd95=np.nan, assd=np.nan)
+        return metrics
+
+    # 外接框外扩一个体素，使框的边界不会被当作表面
+    loc = np.array(np.nonzero(true | pre))
+    s = np.maximum(loc.min(axis=1) - 1, 0)
+    e = np.minimum(loc.max(axis=1) + 2, true.shape)
+    true = true[s[0]:e[0], s[1]:e[1], s[2]:e[2]].view(bool)
+    pre = pre[s[0]:e[0], s[1]:e[1], s[2]:e[2]].view(bool)
+    spacing = np.array(spacing, dtype=np.float64)
+    true_surface = np.argwhere(surface_mask(true)) * spacing
+    pre_surface = np.argwhere(surface_mask(pre)) * spacing
+    true_tree = cKDTree(true_surface)
+    pre_tree = cKDTree(pre_surface)
+
+    # 全部前景体素到另一个标签的距离
+    hd_1, ahd_1 = directed_distance(true_tree, np.argwhere(pre & ~true) * spacing, n_pre)
+    hd_2, ahd_2 = directed_distance(pre_tree, np.argwhere(true & ~pre) * spacing, n_true)
+    metrics['hd'] = max(hd_1, hd_2)
+    metrics['ahd'] = (ahd_1 + ahd_2) / 2
+
+    # 表面体素到另一个标签表面的距离
+    pre_to_true = true_tree.query(pre_surface)[0]
+    true_to_pre = pre_tree.query(true_surface)[0]
+    metrics['hd95'] = max(np.percentile(pre_to_true, percentile), np.percentile(true_to_pre, percentile))
+    metrics['assd'] = (pre_to_true.sum() + true_to_pre.sum()) / (pre_to_true.shape[0] + true_to_pre.shape[0])
+    return metrics
+
+
+def get_region_num(img, get_num, connectivity=26):
     '''
     :param img: 输入标签图像
     :param get_num: 保留最大连通域的个数
+    :param connectivity: 连通方式 6, 18 or 26
     :return: 提取连通域后的numpy数组
     '''
-    conn_img = label(img, connectivity=3)
+    if connectivity not in [6, 18, 26]:
+        raise ValueError("value error,no setting")
+    conn_img = label(img, connectivity={6: 1, 18: 2, 26: 3}[connectivity])
     i_max = conn_img.max()
     if get_num > i_max:
         get_num = i_max
-    area_list = []
-    for i in np.arange(1, i_max + 1):
-        area_list.append(np.sum(conn_img == i))
-    index = np.argsort(-np.array(area_list)) + 1
+    # 一次bincount得到所有连通域的体积，排序方式与逐个统计时相同
+    area_list = np.bincount(conn_img.ravel(), minlength=i_max + 1)[1:]
+    index = np.argsort(-area_list) + 1
+    keep = np.zeros(i_max + 1, dtype=bool)
+    keep[index[:get_num]] = True
     record = np.zeros_like(img)
-    for i in np.arange(get_num):
-        record[conn_img == index[i]] = 1
+    record[keep[conn_img]] = 1
     return record
 
 
@@ -52,27 +117,47 @@ class Cal_metrics:
     预测标签的目录为id/pre_label.nii.gz
     真实标签的目录为id/(label.nii.gz,image.nii.gz)
     '''
-    def __init__(self, pre_path, true_path, con_num=0 ,pre_label_name='pre_label.nii.gz',is_use_prob=True):
+    def __init__(self, pre_path, true_path, con_num=0 ,pre_label_name='pre_label.nii.gz',is_use_prob=True,
+                 engine='sitk', slots=None):
         '''
         :param pre_path:  the path of prediction
         :param true_path: the path of true label
         :param con_num: the number of max connected domain would be reserved, 如果为0将保留所有连通域
         :param is_use_prob: 是否进行二值化操作
+        :param engine: 'sitk' 使用SimpleITK，与以前的结果一致 ; 'kdtree' 使用seg_metrics(表面体素的KD树)，
+                       dice相同，spacing按numpy的轴对应；'sitk'没有转置轴，spacing各向异性时HD/AHD与'kdtree'不同，
+                       各向同性时结果相同(python -m benchmark.validate_metrics)
+        :param slots: utils.Executor.Volume_slots，预测与标签从共享内存读取
         '''
         self.pre_path = pre_path
         self.true_path = true_path
         self.con_num= con_num
         self.is_use_prob = is_use_prob
         self.pre_label_name=pre_label_name
+        self.engine = engine
+        self.slots = slots
 
-    def calculate_dice(self, i):
+    def calculate_metrics(self, i):
         '''
         :param i: id号，id号必须存在于预测路径以及真实路径
-        :return:
+        :return: dict dice, hd, ahd, hd95, assd
         '''
+        pre, true, spacing = self.load(i)
+        metrics = seg_metrics(true, pre, spacing)
+        print(i, ' dice:%f hd:%f hd95:%f' % (metrics['dice'], metrics['hd'], metrics['hd95']))
+        return metrics
 
-        pre_nii = nibabel.load(os.path.join(self.pre_path, i, self.pre_label_name))
-        pre = pre_nii.get_fdata()
+    def read(self, path):
+        # 共享内存中的图像只读，转为float64即复制一份，与get_fdata相同；计算指标是最后一个阶段，读取后释放
+        if self.slots is not None:
+            img = self.slots.load(path, share=False)[0].astype(np.float64)
+            self.slots.release(path)
+            return img
+        return nibabel.load(path).get_fdata()
+
+    def load(self, i):
+
+        pre = self.read(os.path.join(self.pre_path, i, self.pre_label_name))
 
         if self.is_use_prob:
             pre[pre >= 0.5] = 1
@@ -81,13 +166,24 @@ class Cal_metrics:
         if self.con_num!=0:
             pre = get_region_num(pre, self.con_num)
 
-        true = nibabel.load(os.path.join(self.true_path, i, 'label.nii.gz')).get_fdata()
+        true = self.read(os.path.join(self.true_path, i, 'label.nii.gz'))
         data_nii = nibabel.load(os.path.join(self.true_path, i, 'img.nii.gz'))
 
         header = data_nii.header
         spacing = header.get_zooms()
         spacing = tuple([float(spacing[0]), float(spacing[1]), float(spacing[2])])
+        return pre, true, spacing
+
+    def calculate_dice(self, i):
+        '''
+        :param i: id号，id号必须存在于预测路径以及真实路径
+        :return:
+        '''
+        if self.engine == 'kdtree':
+            metrics = self.calculate_metrics(i)
+            return metrics['dice'], metrics['ahd'], metrics['hd']
 
+        pre, true, spacing = self.load(i)
         max_dice = dice_coef(true, pre)
         ahd, hd = HausdorffDistance(true, pre, spacing)
         print(i,' dice:%f hd:%f'%(max_dice,hd))
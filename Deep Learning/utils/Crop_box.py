@@ -8,7 +8,7 @@ def get_crop(pre_label, img, label,enhance):
     :param pre_label: 粗分割预测图像 3D array
     :param img: CT图像 3D array
     :param label: 标签 3D array
-    :param enhance: 增强图像 3D array
+    :param enhance: 增强图像 3D array，为None时不裁剪
     :return:
     '''
     x, y, z = np.where(pre_label == 1)
@@ -27,7 +27,7 @@ def get_crop(pre_label, img, label,enhance):
 
     img_crop = img[loc_min[0]:loc_max[0], loc_min[1]:loc_max[1], loc_min[2]:loc_max[2]]
     label_crop = label[loc_min[0]:loc_max[0], loc_min[1]:loc_max[1], loc_min[2]:loc_max[2]]
-    enhance_crop = enhance[loc_min[0]:loc_max[0], loc_min[1]:loc_max[1], loc_min[2]:loc_max[2]]
+    enhance_crop = None if enhance is None else enhance[loc_min[0]:loc_max[0], loc_min[1]:loc_max[1], loc_min[2]:loc_max[2]]
     return img_crop, label_crop, enhance_crop, loc_min, loc_max
 
 
@@ -37,7 +37,7 @@ class Crop_pre():
         :param coarse_path: 预测标签路径 coarse_path/id/label.nii.gz
         :param img_path: 真实图像路径 data_path/id/img.nii.gz
         :param save_path: 真实标签路径 label_path/id/label.nii.gz
-        :param enhance_path: 增强图像路径 enhance_path/id/label.nii.gz
+        :param enhance_path: 增强图像路径 enhance_path/id/label.nii.gz，为None时不裁剪增强图像(由Frangi.run_box按裁剪框计算)
         '''
         self.coarse_path=coarse_path
         self.img_path=img_path
@@ -55,7 +55,7 @@ class Crop_pre():
         img_nii = nib.load(os.path.join(self.img_path, i, 'img.nii.gz'))
         img=img_nii.get_fdata()
         label = nib.load(os.path.join(self.img_path, i, 'label.nii.gz')).get_fdata()
-        enhance = nib.load(os.path.join(self.enhance_path, i, 'frangi.nii.gz')).get_fdata()
+        enhance = None if self.enhance_path is None else nib.load(os.path.join(self.enhance_path, i, 'frangi.nii.gz')).get_fdata()
 
         img_crop, label_crop,enhance_crop, l_min, l_max = get_crop(pre, img, label,enhance)
         s_path = os.path.join(self.save_path, i)
@@ -63,24 +63,28 @@ class Crop_pre():
         os.makedirs(s_path, exist_ok=True)
         nib.save(nib.Nifti1Image(img_crop, pre_nii.affine,header=img_nii.header), os.path.join(s_path, 'img.nii.gz'))
         nib.save(nib.Nifti1Image(label_crop, pre_nii.affine), os.path.join(s_path, 'label.nii.gz'))
-        nib.save(nib.Nifti1Image(enhance_crop, pre_nii.affine), os.path.join(s_path, 'frangi.nii.gz'))
+        if enhance_crop is not None:
+            nib.save(nib.Nifti1Image(enhance_crop, pre_nii.affine), os.path.join(s_path, 'frangi.nii.gz'))
 
         return l_min + l_max
 
 
 class Recover_Crop:
-    def __init__(self,pre_path,data_path,crop_dict,pre_file_name='pre_crop.nii.gz',save_file_name='pre_label.nii.gz'):
+    def __init__(self,pre_path,data_path,crop_dict,pre_file_name='pre_crop.nii.gz',save_file_name='pre_label.nii.gz',
+                 slots=None):
         '''
         :param coarse_path: 预测标签路径 coarse_path/id/label.nii.gz
         :param img_path: 真实图像路径 data_path/id/img.nii.gz
         :param save_path: 真实标签路径 label_path/id/label.nii.gz
         :param enhance_path: 增强图像路径 enhance_path/id/label.nii.gz
+        :param slots: utils.Executor.Volume_slots，pre_crop从共享内存读取，结果保存后放入共享内存供计算指标使用
         '''
         self.data_path=data_path
         self.pre_path=pre_path
         self.crop_dict=crop_dict
         self.pre_file_name=pre_file_name
         self.save_file_name=save_file_name
+        self.slots=slots
 
     def run(self,i):
         print(i)
@@ -88,13 +92,24 @@ class Recover_Crop:
         index = i_list.index(i)
         l_loc = self.crop_dict['box'][index]
 
-        pre_nii = nib.load(os.path.join(self.pre_path, i, self.pre_file_name))
-        pre = pre_nii.get_fdata()
-        img=nib.load(os.path.join(self.data_path, i, 'img.nii.gz')).get_fdata()
-
-        pre_label=np.zeros_like(img)
+        if self.slots is not None:
+            pre, affine = self.slots.load(os.path.join(self.pre_path, i, self.pre_file_name), share=False)
+            pre = pre.astype(np.float64)
+            self.slots.release(os.path.join(self.pre_path, i, self.pre_file_name))
+        else:
+            pre_nii = nib.load(os.path.join(self.pre_path, i, self.pre_file_name))
+            pre = pre_nii.get_fdata()
+            affine = pre_nii.affine
+        # 只需要原图像的大小，读取头文件即可
+        shape=nib.load(os.path.join(self.data_path, i, 'img.nii.gz')).shape
+
+        pre_label=np.zeros(shape)
         pre_label[l_loc[0]:l_loc[3],l_loc[1]:l_loc[4],l_loc[2]:l_loc[5]]=pre
 
-        nib.save(nib.Nifti1Image(pre,pre_nii.affine),os.path.join(self.pre_path, i, self.save_file_name))
+        if self.slots is not None:
+            # pre_crop由Recover_patch保存为float32，共享内存中同样用float32，计算指标时转为float64与文件读取的结果相同
+            self.slots.save(os.path.join(self.pre_path, i, self.save_file_name), pre, affine, share_dtype=np.float32)
+            return
+        nib.save(nib.Nifti1Image(pre,affine),os.path.join(self.pre_path, i, self.save_file_name))
 
 
@@ -0,0 +1,301 @@
+import os
+import json
+import time
+import atexit
+import hashlib
+import functools
+import multiprocessing
+import multiprocessing.pool
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import nibabel as nib
+
+'''
+常驻的进程池与共享内存中的图像
+各个阶段共用同一个进程池，不再每个阶段新建Pool(48)；图像读取一次后放入以文件路径命名的共享内存，
+同一个病例的pre_crop/pre_label/label在恢复patch、恢复裁剪、计算指标时不再重复从gzip解压
+共享内存的名字由路径、文件大小与修改时间得到，文件被改写后自动读取新的内容
+/dev/shm剩余空间不足时不放入共享内存，之后的阶段照常从文件读取
+'''
+
+HEADER = 4096
+SHM_DIR = '/dev/shm'
+# /dev/shm写满时写入的子进程因SIGBUS退出，Pool.imap会一直等待；放入前保留这么多剩余空间
+SHM_MARGIN = 256 * 1024 ** 2
+# 当前进程新建的共享内存，任务结束后交给主进程，由主进程统一释放
+_created = []
+# 当前进程打开的共享内存，任务结束后关闭
+_opened = {}
+
+
+class Volume_slots:
+    def __init__(self, prefix=None):
+        '''
+        以文件路径命名的共享内存，头部为json(shape, dtype, affine)，数据从HEADER处开始
+        :param prefix: 共享内存名字的前缀，默认由主进程的pid得到
+        '''
+        self.prefix = 'cs%x_' % os.getpid() if prefix is None else prefix
+        # 主进程中记录的所有共享内存，clear时释放
+        self.names = set()
+
+    def __getstate__(self):
+        # 传给子进程时只需要前缀
+        return {'prefix': self.prefix, 'names': set()}
+
+    def slot_name(self, path):
+        stat = os.stat(path)
+        key = '%s|%d|%d' % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        return self.prefix + hashlib.sha1(key.encode()).hexdigest()[:20]
+
+    def get(self, path):
+        '''
+        :return: (只读的数组, affine)，共享内存不存在或还没写完时为None
+        '''
+        name = self.slot_name(path)
+        shm = _opened.get(name)
+        if shm is None:
+            try:
+                shm = shared_memory.SharedMemory(name)
+            except FileNotFoundError:
+                return None
+            _opened[name] = shm
+        if shm.buf[0] != 1:
+            return None
+        n = int(np.frombuffer(shm.buf, np.uint32, 1, 1)[0])
+        meta = json.loads(bytes(shm.buf[5:5 + n]))
+        img = np.ndarray(meta['shape'], np.dtype(meta['dtype']), buffer=shm.buf, offset=HEADER)
+        img.flags.writeable = False
+        return img, np.array(meta['affine'])
+
+    def put(self, path, img, affine):
+        '''
+        将已经保存在path的图像放入共享内存，同一个文件已经存在或/dev/shm空间不足时不放入
+        :return: 是否放入
+        '''
+        img = np.ascontiguousarray(img)
+        name = self.slot_name(path)
+        meta = json.dumps({'shape': img.shape, 'dtype': img.dtype.str, 'affine': np.asarray(affine).tolist()}).encode()
+        size = HEADER + max(img.nbytes, 1)
+        free = shm_free()
+        if free is not None and free < size + SHM_MARGIN:
+            return False
+        try:
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            return False
+        try:
+            # 立即分配全部页面，多个进程同时写入导致空间不足时得到ENOSPC而不是写入时的SIGBUS
+            if hasattr(os, 'posix_fallocate') and getattr(shm, '_fd', -1) >= 0:
+                os.posix_fallocate(shm._fd, 0, size)
+        except OSError:
+            shm.close()
+            shm.unlink()
+            return False
+        _created.append(name)
+        view = np.ndarray(img.shape, img.dtype, buffer=shm.buf, offset=HEADER)
+        view[...] = img
+        del view
+        shm.buf[1:5] = np.uint32(len(meta)).tobytes()
+        shm.buf[5:5 + len(meta)] = meta
+        # 最后写入标志，其他进程只读取写完的图像
+        shm.buf[0] = 1
+        # 写入的进程不保留映射，被释放后内存可以立即回收
+        shm.close()
+        return True
+
+    def load(self, path, share=True):
+        '''
+        代替nib.load(path).get_fdata()，返回的数组为文件中的数据类型，只读
+        :param share: 从文件读取时放入共享内存；最后一个使用者设为False
+        :return: (图像, affine)
+        '''
+        slot = self.get(path)
+        if slot is not None:
+            return slot
+        nii = nib.load(path)
+        img = np.asanyarray(nii.dataobj)
+        if share:
+            self.put(path, img, nii.affine)
+        return img, nii.affine
+
+    def release(self, path):
+        '''
+        图像不再被读取时释放，可在子进程中调用
+        '''
+        name = self.slot_name(path)
+        shm = _opened.pop(name, None)
+        try:
+            if shm is None:
+                shm = shared_memory.SharedMemory(name)
+            shm.unlink()
+            shm.close()
+        except (FileNotFoundError, BufferError):
+            pass
+
+    def save(self, path, img, affine, share_dtype=None):
+        '''
+        代替nib.save，保存后放入共享内存，下一个阶段直接读取
+        :param share_dtype: 放入共享内存时转换的类型(如二值图像用np.uint8)，文件仍按img的类型保存
+        '''
+        nib.save(nib.Nifti1Image(img, affine), path)
+        self.put(path, img if share_dtype is None else img.astype(share_dtype), affine)
+
+    def collect(self):
+        # 主进程中收回本进程新建的共享内存
+        self.names.update(_created)
+        del _created[:]
+
+    def clear(self):
+        '''
+        释放所有共享内存，只在主进程中调用
+        '''
+        self.collect()
+        detach()
+        for name in self.names:
+            try:
+                shm = shared_memory.SharedMemory(name)
+            except FileNotFoundError:
+                continue
+            shm.close()
+            shm.unlink()
+        self.names = set()
+
+
+def shm_free():
+    # /dev/shm的剩余字节数，不存在时(非Linux)为None
+    try:
+        stat = os.statvfs(SHM_DIR)
+    except OSError:
+        return None
+    return stat.f_bavail * stat.f_frsize
+
+
+def detach():
+    # 关闭当前进程打开的共享内存，仍被数组引用的保持打开
+    for name in list(_opened):
+        try:
+            _opened[name].close()
+        except BufferError:
+            continue
+        _opened.pop(name)
+
+
+def task_name(func):
+    while isinstance(func, functools.partial):
+        func = func.func
+    name = getattr(func, '__name__', type(func).__name__)
+    owner = getattr(func, '__self__', None)
+    return name if owner is None else '%s.%s' % (type(owner).__name__, name)
+
+
+def run_task(func, star, process, args):
+    # 执行一个任务，返回结果、耗时以及子进程中新建的共享内存；线程中与主进程共用，不在这里收回
+    t0 = time.time()
+    r = func(*args) if star else func(args)
+    t = time.time() - t0
+    if not process:
+        return r, t, []
+    created = list(_created)
+    del _created[:]
+    detach()
+    return r, t, created
+
+
+class Executor:
+    def __init__(self, pools=None):
+        '''
+        常驻的进程/线程池，第一次使用时才创建；子进程在第一次使用时fork，任务函数需要在此之前定义
+        :param pools: 进程数，默认为cpu个数
+        '''
+        self.pools = os.cpu_count() if pools is None else pools
+        self.process = None
+        self.thread = None
+        self.slots = Volume_slots()
+        # 队列中还没有完成的任务数，以及每个函数的任务数、总耗时、最长耗时
+        self.submitted = 0
+        self.finished = 0
+        self.timing = {}
+
+    def depth(self):
+        return self.submitted - self.finished
+
+    def pool(self, thread=False):
+        if thread:
+            if self.thread is None:
+                self.thread = multiprocessing.pool.ThreadPool(self.pools)
+            return self.thread
+        if self.process is None:
+            # 子进程与主进程共用一个resource_tracker，否则在一个进程中新建、在另一个进程中释放的共享内存会被误报
+            resource_tracker.ensure_running()
+            self.process = multiprocessing.Pool(self.pools)
+        return self.process
+
+    def imap(self, func, iterable, star=False, thread=False, unordered=False, name=None):
+        '''
+        :param func: 需要可以pickle(如类实例的方法)
+        :param star: 每个元素为参数元组，同starmap
+        :param thread: 使用线程池
+        :param unordered: 按完成的顺序返回
+        :param name: 计时使用的名字，默认为函数名
+        :return: 结果的生成器
+        '''
+        items = list(iterable)
+        name = task_name(func) if name is None else name
+        pool = self.pool(thread)
+        task = functools.partial(run_task, func, star, not thread)
+        self.submitted += len(items)
+        done = 0
+        try:
+            for r, t, created in (pool.imap_unordered if unordered else pool.imap)(task, items):
+                done += 1
+                self.finished += 1
+                self.slots.names.update(created)
+                record = self.timing.setdefault(name, [0, 0.0, 0.0])
+                record[0] += 1
+                record[1] += t
+                record[2] = max(record[2], t)
+                yield r
+        finally:
+            # 中途出错或未取完时，队列深度不再计入剩下的任务
+            self.finished += len(items) - done
+            self.slots.collect()
+
+    def map(self, func, iterable, thread=False):
+        return list(self.imap(func, iterable, thread=thread))
+
+    def starmap(self, func, iterable, thread=False):
+        return list(self.imap(func, iterable, star=True, thread=thread))
+
+    def report(self):
+        '''
+        :return: 队列深度以及每个函数的任务数、总耗时、平均耗时、最长耗时
+        '''
+        lines = ['queue depth:%d | finished:%d' % (self.depth(), self.finished)]
+        for name, (n, total, longest) in self.timing.items():
+            lines.append('%s | tasks:%d | total:%.2fs | mean:%.3fs | max:%.3fs' % (name, n, total, total / n, longest))
+        return '\n'.join(lines)
+
+    def close(self):
+        for pool in [self.process, self.thread]:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.process = None
+        self.thread = None
+        self.slots.clear()
+
+
+_executor = None
+
+
+def get_executor(pools=None):
+    '''
+    当前进程共用的Executor，进程数由进程池创建前最后一次给出的pools决定(如先用了线程池)，退出时关闭
+    '''
+    global _executor
+    if _executor is None:
+        _executor = Executor(pools)
+        atexit.register(_executor.close)
+    elif pools is not None and _executor.process is None:
+        _executor.pools = pools
+    return _executor
@@ -1,21 +1,387 @@
 from skimage.filters import ridges
+from scipy import ndimage as ndi
+from scipy.ndimage import distance_transform_edt
+from itertools import combinations_with_replacement
 import nibabel as nib
 import numpy as np
+import gzip
+import shutil
 import os
+import math
 import multiprocessing
 
 class Frangi():
-    def __init__(self,img_path,enhance_save_path,enhance_name='frangi.nii.gz'):
+    def __init__(self,img_path,enhance_save_path,enhance_name='frangi.nii.gz',engine=None,roi_path=None,
+                 roi_name='pre_label.nii.gz',roi_radius=10,cache_path=None):
+        '''
+        :param engine: Frangi_engine，为None时用skimage对整幅图像滤波
+        :param roi_path: 粗分割路径 roi_path/id/roi_name，给出时只在膨胀roi_radius后的区域内计算(需要engine)
+        :param cache_path: run_box的tile缓存路径，为None时不缓存
+        '''
         self.img_path=img_path
         self.enhance_name=enhance_name
         self.enhance_save_path=enhance_save_path
+        self.engine=engine
+        self.roi_path=roi_path
+        self.roi_name=roi_name
+        self.roi_radius=roi_radius
+        self.cache=None if cache_path is None else Frangi_cache(cache_path,engine)
 
     def run_enhance(self,i):
         print(i)
         i_path = os.path.join(self.img_path, i, 'img.nii.gz')
+        os.makedirs(os.path.join(self.enhance_save_path, i),exist_ok=True)
+        save_path = os.path.join(self.enhance_save_path, i, self.enhance_name)
+        if self.engine is not None:
+            roi = None if self.roi_path is None else (os.path.join(self.roi_path, i, self.roi_name), self.roi_radius)
+            self.engine.run(i_path, save_path, roi)
+            print(i,':done')
+            return
         img_nii = nib.load(i_path)
         img = img_nii.get_fdata()
         img = ridges.frangi(img, sigmas=range(1, 5, 2), black_ridges=False)
+        nib.save(nib.Nifti1Image(img, img_nii.affine), save_path)
+        print(i,':done')
+
+    def run_box(self,i,box):
+        '''
+        只计算Crop_pre裁剪框内的Frangi，结果与整幅图像滤波后裁剪相同，保存为enhance_save_path/id/enhance_name
+        :param box: crop_fold_k.npy中的裁剪框 [x_min, y_min, z_min, x_max, y_max, z_max]
+        '''
+        i_path = os.path.join(self.img_path, i, 'img.nii.gz')
         os.makedirs(os.path.join(self.enhance_save_path, i),exist_ok=True)
-        nib.save(nib.Nifti1Image(img, img_nii.affine), os.path.join(self.enhance_save_path, i, self.enhance_name))
-        print(i,':done')
\ No newline at end of file
+        save_path = os.path.join(self.enhance_save_path, i, self.enhance_name)
+        box = [int(b) for b in box]
+        if self.cache is None:
+            self.engine.run(i_path, save_path, box=box)
+            print(i,':done')
+            return
+        computed, reused = self.cache.run(i, i_path, save_path, box)
+        print(i,':done, tiles computed %d, reused %d' % (computed, reused))
+
+
+class Slab_reader:
+    def __init__(self, dataobj, halo):
+        '''
+        沿z方向依次读取[z0-halo, z1+halo)与图像的交集，相邻两段重叠的层保留在内存中，每层只从文件中读取一次
+        z0需要递增，.nii.gz只向前解压
+        :param dataobj: nib.load(path, keep_file_open=True).dataobj
+        '''
+        self.dataobj = dataobj
+        self.halo = halo
+        self.nz = dataobj.shape[2]
+        self.buffer = None
+        self.start = 0
+        self.end = 0
+
+    def load(self, a, b):
+        return np.asarray(self.dataobj[:, :, a:b], dtype=np.float32)
+
+    def read(self, z0, z1):
+        '''
+        :return: slab (X,Y,b-a), a
+        '''
+        a, b = max(0, z0 - self.halo), min(self.nz, z1 + self.halo)
+        if self.buffer is None or a < self.start:
+            self.buffer = self.load(a, b)
+        elif a < self.end:
+            self.buffer = np.concatenate([self.buffer[:, :, a - self.start:], self.load(self.end, b)], axis=2)
+        else:
+            self.buffer = self.load(a, b)
+        self.start, self.end = a, b
+        return self.buffer, a
+
+
+class Nii_writer:
+    def __init__(self, path, shape, affine):
+        '''
+        按z方向依次写出float32的nii(.gz)。nii按Fortran顺序存储，一段z层就是文件中连续的一段，不需要整幅图像在内存中
+        先写临时文件，close时再改名
+        '''
+        header = nib.Nifti1Image(np.zeros((1, 1, 1), dtype=np.float32), affine).header
+        header.set_data_shape(shape)
+        header.set_data_offset(352)
+        self.path = path
+        self.tmp_path = path + '.%d.part' % os.getpid()
+        self.raw = open(self.tmp_path, 'wb')
+        # gzip头中不写入时间与文件名，相同的结果得到相同的文件
+        self.f = gzip.GzipFile(filename='', mode='wb', compresslevel=1, fileobj=self.raw, mtime=0) \
+            if path.endswith('.gz') else self.raw
+        # 348字节的头与4字节的扩展标志，数据从352字节开始
+        header.write_to(self.f)
+
+    def write(self, slab):
+        self.f.write(np.asarray(slab, dtype=np.float32).tobytes(order='F'))
+
+    def close(self):
+        self.f.close()
+        self.raw.close()
+        os.replace(self.tmp_path, self.path)
+
+
+def hessian_truncate(sigma, truncate=None):
+    # skimage的_hessian_matrix_with_gaussian：sigma>1时截断8倍，否则100倍
+    if truncate is not None:
+        return truncate
+    return 8 if sigma > 1 else 100
+
+
+def hessian_halo(sigma, truncate=None):
+    '''
+    两次高斯导数卷积的核半径之和，块四周留出这么多体素时块内结果与整幅图像滤波相同
+    '''
+    return 2 * int(hessian_truncate(sigma, truncate) * sigma / math.sqrt(2) + 0.5)
+
+
+def hessian_elems(block, sigma, truncate=None):
+    '''
+    与skimage.feature.hessian_matrix(use_gaussian_derivatives=True)相同：沿一个方向做sigma/√2的一阶高斯导数，
+    结果再沿另一个方向做一次，得到Hessian的6个分量 [Hxx, Hxy, Hxz, Hyy, Hyz, Hzz]，float32
+    :param truncate: 高斯核截断的倍数，None时与skimage相同
+    '''
+    kwargs = dict(sigma=1 / math.sqrt(2) * sigma, mode='reflect', truncate=hessian_truncate(sigma, truncate),
+                  output=np.float32)
+    orders = [[1, 0, 0], [0, 1, 0], [0, 0, 1]]
+    gradients = [ndi.gaussian_filter(block, order=orders[a], **kwargs) for a in range(3)]
+    return [ndi.gaussian_filter(gradients[a], order=orders[b], **kwargs)
+            for a, b in combinations_with_replacement(range(3), 2)]
+
+
+def structure_norm(H):
+    # Hessian的Frobenius范数，即特征值平方和的平方根(skimage.frangi中的s)
+    hxx, hxy, hxz, hyy, hyz, hzz = H
+    return np.sqrt(hxx ** 2 + hyy ** 2 + hzz ** 2 + 2 * (hxy ** 2 + hxz ** 2 + hyz ** 2))
+
+
+def vesselness(H, alpha, beta, gamma):
+    '''
+    与skimage.filters.frangi相同的血管响应(3D)，特征值按绝对值从小到大排列
+    :param H: Hessian分量
+    :return: float32，形状与H的分量相同
+    '''
+    hxx, hxy, hxz, hyy, hyz, hzz = [h.ravel() for h in H]
+    M = np.stack([hxx, hxy, hxz, hxy, hyy, hyz, hxz, hyz, hzz], axis=-1).reshape(-1, 3, 3)
+    eig = np.linalg.eigvalsh(M)
+    eig = np.take_along_axis(eig, np.abs(eig).argsort(axis=1), axis=1)
+    lambda1 = eig[:, 0]
+    lambda2 = np.maximum(eig[:, 1], 1e-10)
+    lambda3 = np.maximum(eig[:, 2], 1e-10)
+    r_a = lambda2 / lambda3
+    r_b = np.abs(lambda1) / np.sqrt(lambda2 * lambda3)
+    s2 = (eig ** 2).sum(axis=1)
+    with np.errstate(over='ignore'):
+        v = (1 - np.exp(-r_a ** 2 / (2 * alpha ** 2))) * np.exp(-r_b ** 2 / (2 * beta ** 2))
+    v *= 1 - np.exp(-s2 / (2 * gamma ** 2))
+    return v.astype(np.float32).reshape(H[0].shape)
+
+
+class Frangi_engine:
+    def __init__(self, sigmas=range(1, 5, 2), alpha=0.5, beta=0.5, gamma=None, black_ridges=False,
+                 block_size=(128, 128, 32), truncate=8):
+        '''
+        分块的多尺度Frangi滤波：沿z方向逐段读入，每段再分为x,y方向的块，块四周留出两次高斯导数卷积的核半径，float32计算，
+        结果逐段写入文件。truncate=8时内存峰值只与块大小和图像的x,y大小有关，与z方向长度无关
+        :param sigmas: 高斯尺度，与原来的ridges.frangi(sigmas=range(1, 5, 2))相同
+        :param gamma: 为None时与skimage相同，取第一个尺度下s最大值的一半(先单独扫描一遍)；给出roi时只在roi内统计
+        :param black_ridges: False为亮的血管
+        :param block_size: 每块输出的大小 [x,y,z]
+        :param truncate: 高斯核截断的倍数，默认8，sigma<=1的核在截断处的权重已小于1e-14，与skimage的差在float32精度内(约1e-5)，
+                         halo为34；None时与skimage的截断完全相同(sigma<=1时为100)，halo为142，常常超过图像的z长度，
+                         每块几乎要对整幅图像计算，只用于核对结果
+        '''
+        self.sigmas = list(sigmas)
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        self.black_ridges = black_ridges
+        self.block_size = block_size
+        self.truncate = truncate
+        self.halo = max(hessian_halo(s, truncate) for s in self.sigmas)
+
+    def blocks(self, shape, reader, roi_reader, roi_radius, box=None):
+        '''
+        依次给出每段z层的读入数据与其中需要计算的块
+        :param box: None或[x_min, y_min, z_min, x_max, y_max, z_max]，只计算框内
+        :return: z0, z1, slab, slab_start, [(x0, x1, y0, y1, mask)]，mask为None时整块输出
+        '''
+        bx, by, bz = self.block_size
+        box = [0, 0, 0] + list(shape) if box is None else box
+        for z0 in range(box[2], box[5], bz):
+            z1 = min(z0 + bz, box[5])
+            slab, s0 = reader.read(z0, z1)
+            if not self.black_ridges:
+                slab = -slab
+            if roi_reader is not None:
+                roi, r0 = roi_reader.read(z0, z1)
+            block = []
+            for x0 in range(box[0], box[3], bx):
+                for y0 in range(box[1], box[4], by):
+                    x1, y1 = min(x0 + bx, box[3]), min(y0 + by, box[4])
+                    mask = None
+                    if roi_reader is not None:
+                        # 块四周roi_radius内的粗分割，膨胀后取出块内部分
+                        ax, ay = max(0, x0 - roi_radius), max(0, y0 - roi_radius)
+                        r = roi[ax:min(shape[0], x1 + roi_radius), ay:min(shape[1], y1 + roi_radius)] > 0.5
+                        if not r.any():
+                            continue
+                        mask = distance_transform_edt(~r) <= roi_radius
+                        mask = mask[x0 - ax:x1 - ax, y0 - ay:y1 - ay, z0 - r0:z1 - r0]
+                        if not mask.any():
+                            continue
+                    block.append((x0, x1, y0, y1, mask))
+            yield z0, z1, slab, s0, block
+
+    def block_hessian(self, slab, s0, x0, x1, y0, y1, z0, z1, sigma):
+        # 带halo的块计算Hessian，只返回块内部分
+        shape = slab.shape
+        ax, ay = max(0, x0 - self.halo), max(0, y0 - self.halo)
+        data = slab[ax:min(shape[0], x1 + self.halo), ay:min(shape[1], y1 + self.halo)]
+        H = hessian_elems(data, sigma, self.truncate)
+        return [h[x0 - ax:x1 - ax, y0 - ay:y1 - ay, z0 - s0:z1 - s0] for h in H]
+
+    def block_vesselness(self, slab, s0, x0, x1, y0, y1, z0, z1, gamma):
+        # 块内各尺度响应的最大值
+        v = np.zeros((x1 - x0, y1 - y0, z1 - z0), dtype=np.float32)
+        for sigma in self.sigmas:
+            H = self.block_hessian(slab, s0, x0, x1, y0, y1, z0, z1, sigma)
+            np.maximum(v, vesselness(H, self.alpha, self.beta, gamma), out=v)
+        return v
+
+    def open(self, img_path, roi):
+        img_nii = nib.load(img_path, keep_file_open=True)
+        reader = Slab_reader(img_nii.dataobj, self.halo)
+        roi_reader, roi_radius = None, 0
+        if roi is not None:
+            roi_radius = roi[1]
+            roi_reader = Slab_reader(nib.load(roi[0], keep_file_open=True).dataobj, roi_radius)
+        return img_nii, reader, roi_reader, roi_radius
+
+    def get_gamma(self, img_path, roi):
+        img_nii, reader, roi_reader, roi_radius = self.open(img_path, roi)
+        s_max = 0
+        for z0, z1, slab, s0, block in self.blocks(img_nii.shape, reader, roi_reader, roi_radius):
+            for x0, x1, y0, y1, mask in block:
+                s = structure_norm(self.block_hessian(slab, s0, x0, x1, y0, y1, z0, z1, self.sigmas[0]))
+                if mask is not None:
+                    s = s[mask]
+                s_max = max(s_max, float(s.max()) if s.size else 0)
+        gamma = s_max / 2
+        return gamma if gamma != 0 else 1
+
+    def run(self, img_path, save_path, roi=None, box=None):
+        '''
+        :param img_path: 输入图像 .nii/.nii.gz
+        :param save_path: 输出 .nii/.nii.gz，float32
+        :param roi: None或(粗分割路径, 膨胀半径)，只计算膨胀后的区域，其余为0
+        :param box: None或Crop_pre的裁剪框[x_min, y_min, z_min, x_max, y_max, z_max]，只输出框内，
+                    框边缘仍使用框外的图像，结果与整幅图像滤波后再裁剪相同
+        '''
+        gamma = self.gamma if self.gamma is not None else self.get_gamma(img_path, roi)
+        img_nii, reader, roi_reader, roi_radius = self.open(img_path, roi)
+        box = [0, 0, 0] + list(img_nii.shape) if box is None else box
+        writer = Nii_writer(save_path, (box[3] - box[0], box[4] - box[1], box[5] - box[2]), img_nii.affine)
+        for z0, z1, slab, s0, block in self.blocks(img_nii.shape, reader, roi_reader, roi_radius, box):
+            out = np.zeros((box[3] - box[0], box[4] - box[1], z1 - z0), dtype=np.float32)
+            for x0, x1, y0, y1, mask in block:
+                v = self.block_vesselness(slab, s0, x0, x1, y0, y1, z0, z1, gamma)
+                if mask is not None:
+                    v[~mask] = 0
+                out[x0 - box[0]:x1 - box[0], y0 - box[1]:y1 - box[1]] = v
+            writer.write(out)
+        writer.close()
+
+    def key(self):
+        # 决定结果的参数，作为缓存目录名
+        return 'sigma_%s_a%g_b%g_g%s_%s_t%s' % ('-'.join('%g' % s for s in self.sigmas), self.alpha, self.beta,
+                                               'auto' if self.gamma is None else '%g' % self.gamma,
+                                               'black' if self.black_ridges else 'white',
+                                               'sk' if self.truncate is None else '%g' % self.truncate)
+
+
+class Frangi_cache:
+    def __init__(self, cache_dir, engine, tile_size=(64, 64, 32)):
+        '''
+        按(病例, 参数)缓存Frangi结果：图像按固定网格分为tile，每个tile计算一次后保存为npy，
+        不同fold或粗分割模型的裁剪框只计算尚未缓存的tile，重叠部分直接读取
+        gamma取整幅图像第一个尺度下s最大值的一半，与裁剪框无关，缓存的tile对任意裁剪框都相同
+        :param cache_dir: 缓存路径 cache_dir/id/engine.key()/
+        :param engine: Frangi_engine
+        :param tile_size: tile大小 [x,y,z]
+        '''
+        self.cache_dir = cache_dir
+        self.engine = engine
+        self.tile_size = tile_size
+
+    def case_dir(self, id, img_path):
+        # 图像改变(大小或修改时间不同)时清空该病例的缓存
+        path = os.path.join(self.cache_dir, id, self.engine.key())
+        stat = os.stat(img_path)
+        source = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        source_path = os.path.join(path, 'source.npy')
+        if os.path.exists(source_path) and not np.array_equal(np.load(source_path), source):
+            shutil.rmtree(path)
+        if not os.path.exists(source_path):
+            os.makedirs(path, exist_ok=True)
+            np.save(source_path, source)
+        return path
+
+    def get_gamma(self, path, img_path):
+        if self.engine.gamma is not None:
+            return self.engine.gamma
+        gamma_path = os.path.join(path, 'gamma.npy')
+        if os.path.exists(gamma_path):
+            return float(np.load(gamma_path))
+        gamma = self.engine.get_gamma(img_path, None)
+        save_npy(gamma_path, np.array(gamma))
+        return gamma
+
+    def run(self, id, img_path, save_path, box):
+        '''
+        :param id: 病例
+        :param img_path: 输入图像 .nii/.nii.gz
+        :param save_path: 输出 .nii/.nii.gz，只包含裁剪框内
+        :param box: [x_min, y_min, z_min, x_max, y_max, z_max]
+        :return: 计算的tile数, 从缓存读取的tile数
+        '''
+        path = self.case_dir(id, img_path)
+        gamma = self.get_gamma(path, img_path)
+        img_nii = nib.load(img_path, keep_file_open=True)
+        shape = img_nii.shape
+        reader = Slab_reader(img_nii.dataobj, self.engine.halo)
+        tx, ty, tz = self.tile_size
+        writer = Nii_writer(save_path, (box[3] - box[0], box[4] - box[1], box[5] - box[2]), img_nii.affine)
+        computed, reused = 0, 0
+        for z0 in range(box[2] // tz * tz, box[5], tz):
+            z1 = min(z0 + tz, shape[2])
+            out = np.zeros((box[3] - box[0], box[4] - box[1], z1 - z0), dtype=np.float32)
+            slab = None
+            for x0 in range(box[0] // tx * tx, box[3], tx):
+                for y0 in range(box[1] // ty * ty, box[4], ty):
+                    x1, y1 = min(x0 + tx, shape[0]), min(y0 + ty, shape[1])
+                    tile_path = os.path.join(path, '%d_%d_%d.npy' % (x0, y0, z0))
+                    if os.path.exists(tile_path):
+                        v = np.load(tile_path)
+                        reused += 1
+                    else:
+                        # 这一层tile有未缓存的才读入图像
+                        if slab is None:
+                            slab, s0 = reader.read(z0, z1)
+                            if not self.engine.black_ridges:
+                                slab = -slab
+                        v = self.engine.block_vesselness(slab, s0, x0, x1, y0, y1, z0, z1, gamma)
+                        save_npy(tile_path, v)
+                        computed += 1
+                    # tile与裁剪框的交集
+                    ax, ay = max(x0, box[0]), max(y0, box[1])
+                    bx, by = min(x1, box[3]), min(y1, box[4])
+                    out[ax - box[0]:bx - box[0], ay - box[1]:by - box[1]] = v[ax - x0:bx - x0, ay - y0:by - y0]
+            writer.write(out[:, :, max(z0, box[2]) - z0:min(z1, box[5]) - z0])
+        writer.close()
+        return computed, reused
+
+
+def save_npy(path, array):
+    # 先写临时文件再改名，其他进程不会读到不完整的文件
+    tmp_path = path + '.%d.part.npy' % os.getpid()
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
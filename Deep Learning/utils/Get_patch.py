@@ -5,98 +5,177 @@ import os
 import pandas as pd
 import multiprocessing
 from skimage.morphology import skeletonize
+from utils.Morphology import mask_box
 
 
-def get_patch(image, label, enhance, patch_size):
-
+def clip_patch_start(center, shape, patch_size):
     '''
-    根据真实标签中心线来选取训练集，训练集有无标签比例为1：1
-    :param image: 真实图像
-    :param label: 真实标签
-    :param flag_label: 先验区域
+    批量计算patch的起点和终点，边界处理与逐点裁剪一致
+    :param center: patch中心 (N,3)
+    :param shape: 图像大小
     :param patch_size: patch的大小
-    :return: data_patch_list:图像patch合集 ;label_patch_list,标签patch合集; loc_record patch位置合集
+    :return: s:patch起点 (N,3) ; e:patch终点 (N,3)
     '''
+    shape = np.broadcast_to(np.array(shape), center.shape)
+    s = center - patch_size // 2
+    e = center + patch_size // 2
 
-    flag_label = label
-    shape = flag_label.shape
-    shape = np.array(shape)
-    label_patch_list = []
-    data_patch_list = []
-    enhance_patch_list = []
-    flag_record = skeletonize(flag_label.astype(np.uint8))
-    i, j, k = np.where(flag_record == 1)
-    loc_record = []
+    low = s < 0
+    e[low] = patch_size
+    s[low] = 0
 
-    # 沿着中心线裁剪
-    pos = 0
-    neg = 0
-    for index in range(i.shape[0]):
-        if flag_record[i[index], j[index], k[index]] == 1:
-            c = np.array([i[index], j[index], k[index]])
-            s = c - patch_size // 2
-            e = c + patch_size // 2
-            z_s = np.zeros_like(s)
+    high = e > shape
+    s[high] = shape[high] - patch_size
+    e[high] = shape[high]
+    return s, e
 
-            e[s < z_s] = patch_size
-            s[s < z_s] = 0
 
-            s[e > shape] = shape[e > shape] - patch_size
-            e[e > shape] = shape[e > shape]
+def skeleton_loc(mask):
+    '''
+    只在mask的包围盒内提取中心线，盒外全为0，因此结果与整幅图像skeletonize相同
+    :param mask: 二值图像
+    :return: 中心线点坐标 (N,3)，顺序与np.where相同
+    '''
+    box = mask_box(mask, 1)
+    if box is None:
+        return np.zeros((0, 3), dtype=np.int64)
+    s = np.array([b.start for b in box])
+    skeleton = skeletonize(mask[box].astype(np.uint8))
+    i, j, k = np.where(skeleton == 1)
+    return np.stack([i, j, k], axis=1) + s
+
 
-            label_patch = label[s[0]:e[0], s[1]:e[1], s[2]:e[2]]
-            label_patch_list.append(label_patch)
+def centerline_patch_start(loc, shape, patch_size):
+    '''
+    沿中心线贪心选取patch，结果与逐体素遍历并清零flag_record的方式相同
+    中心线点按第0维有序，每个patch只需检查searchsorted截取的一段点
+    :param loc: 中心线点坐标 (N,3)，顺序与np.where相同
+    :param shape: 图像大小
+    :param patch_size: patch的大小
+    :return: patch起点 (M,3)
+    '''
+    s, e = clip_patch_start(loc.copy(), shape, patch_size)
+
+    alive = np.ones(loc.shape[0], dtype=bool)
+    start_list = []
+    index = 0
+    while index < loc.shape[0]:
+        start_list.append(s[index])
+        lo = np.searchsorted(loc[:, 0], s[index, 0], side='left')
+        hi = np.searchsorted(loc[:, 0], e[index, 0], side='left')
+        sub = loc[lo:hi]
+        inside = (sub[:, 1] >= s[index, 1]) & (sub[:, 1] < e[index, 1]) & \
+                 (sub[:, 2] >= s[index, 2]) & (sub[:, 2] < e[index, 2])
+        alive[lo:hi] &= ~inside
+
+        step = np.argmax(alive[index:])
+        if not alive[index + step]:
+            break
+        index = index + step
 
-            data_patch = image[s[0]:e[0], s[1]:e[1], s[2]:e[2]]
-            data_patch_list.append(data_patch)
+    return np.array(start_list, dtype=loc.dtype).reshape(-1, 3)
 
-            enhance_patch = enhance[s[0]:e[0], s[1]:e[1], s[2]:e[2]]
-            enhance_patch_list.append(enhance_patch)
 
-            loc_record.append(s)
-            flag_record[s[0]:e[0], s[1]:e[1], s[2]:e[2]] = 0
-            pos = pos + 1
+def grid_occupancy(volume, start_list, patch_size):
+    '''
+    沿三个轴依次用reduceat统计每个网格patch内是否有非零体素
+    :param volume: 3D array
+    :param start_list: 每个轴上patch起点(升序)组成的列表
+    :param patch_size: patch的大小
+    :return: bool array (len(x),len(y),len(z))
+    '''
+    occ = (volume != 0).view(np.uint8)
+    for axis, start in enumerate(start_list):
+        index = np.stack([start, start + patch_size], axis=1).flatten()
+        # reduceat的下标不能等于轴长，最后一个终点即轴的末尾时直接去掉
+        if index[-1] >= occ.shape[axis]:
+            index = index[:-1]
+        occ = np.maximum.reduceat(occ, index, axis=axis)
+        occ = np.take(occ, np.arange(0, 2 * start.shape[0], 2), axis=axis)
+    return occ != 0
+
+
+def negative_patch_start(label, patch_size, num, rng=np.random):
+    '''
+    在规则网格上随机选取不含标签的patch，随机数的使用与逐个检查的方式相同
+    :param label: 真实标签
+    :param patch_size: patch的大小
+    :param num: 负样本个数，与正样本个数相同
+    :param rng: 随机数生成器，默认使用np.random的全局状态
+    :return: patch起点 (M,3)
+    '''
+    shape = label.shape
     x = np.arange(patch_size // 2, shape[0], patch_size)
     y = np.arange(patch_size // 2, shape[1], patch_size)
     z = np.arange(patch_size // 2, shape[2], patch_size)
     i, j, k = np.meshgrid(x, y, z)
     i, j, k = i.flatten(), j.flatten(), k.flatten()
     arr = np.arange(i.shape[0])
-    np.random.shuffle(arr)
-    arr = arr.tolist()
+    rng.shuffle(arr)
 
-    for index in arr:
-        c = np.array([i[index], j[index], k[index]])
-        s = c - patch_size // 2
-        e = c + patch_size // 2
-        z_s = np.zeros_like(s)
+    center = np.stack([i[arr], j[arr], k[arr]], axis=1)
+    s, _ = clip_patch_start(center, shape, patch_size)
 
-        e[s < z_s] = patch_size
-        s[s < z_s] = 0
+    axis_start = [clip_patch_start(c.reshape(-1, 1), shape[a:a + 1], patch_size)[0].flatten()
+                  for a, c in enumerate([x, y, z])]
+    occ = grid_occupancy(label, axis_start, patch_size)
+    empty = ~occ[np.searchsorted(axis_start[0], s[:, 0]),
+                 np.searchsorted(axis_start[1], s[:, 1]),
+                 np.searchsorted(axis_start[2], s[:, 2])]
+    # 逐个检查时每一步之后都判断neg>=pos，没有正样本时只会检查第一个位置
+    if num == 0:
+        empty = empty[:1]
+    return s[:empty.shape[0]][empty][:max(num, 1)]
 
-        s[e > shape] = shape[e > shape] - patch_size
-        e[e > shape] = shape[e > shape]
 
-        label_patch = label[s[0]:e[0], s[1]:e[1], s[2]:e[2]]
-
-        if label_patch.sum() == 0:
-            label_patch_list.append(label_patch)
-            data_patch = image[s[0]:e[0], s[1]:e[1], s[2]:e[2]]
-            data_patch_list.append(data_patch)
+def get_patch(image, label, enhance, patch_size):
 
-            enhance_patch = enhance[s[0]:e[0], s[1]:e[1], s[2]:e[2]]
-            enhance_patch_list.append(enhance_patch)
+    '''
+    根据真实标签中心线来选取训练集，训练集有无标签比例为1：1
+    :param image: 真实图像
+    :param label: 真实标签
+    :param flag_label: 先验区域
+    :param patch_size: patch的大小
+    :return: data_patch_list:图像patch合集 ;label_patch_list,标签patch合集; loc_record patch位置合集
+    '''
 
-            loc_record.append(s)
-            neg = neg + 1
+    flag_label = label
 
-        if neg >= pos:
-            break
+    # 沿着中心线裁剪
+    pos_start = centerline_patch_start(skeleton_loc(flag_label), label.shape, patch_size)
+    # 在无标签区域随机裁剪
+    neg_start = negative_patch_start(label, patch_size, pos_start.shape[0])
 
+    label_patch_list = []
+    data_patch_list = []
+    enhance_patch_list = []
+    loc_record = []
+    for s in np.concatenate([pos_start, neg_start], axis=0):
+        e = s + patch_size
+        label_patch_list.append(label[s[0]:e[0], s[1]:e[1], s[2]:e[2]])
+        data_patch_list.append(image[s[0]:e[0], s[1]:e[1], s[2]:e[2]])
+        enhance_patch_list.append(enhance[s[0]:e[0], s[1]:e[1], s[2]:e[2]])
+        loc_record.append(s)
 
     return data_patch_list, label_patch_list, enhance_patch_list, loc_record
 
 
+def grid_patch_start(shape, patch_size):
+    '''
+    规则网格上相邻patch重叠一半的patch起点
+    :param shape: 图像大小
+    :param patch_size: patch的大小
+    :return: patch起点 (M,3)
+    '''
+    x = np.arange(patch_size // 2, shape[0], patch_size // 2)
+    y = np.arange(patch_size // 2, shape[1], patch_size // 2)
+    z = np.arange(patch_size // 2, shape[2], patch_size // 2)
+    i, j, k = np.meshgrid(x, y, z)
+    center = np.stack([i.flatten(), j.flatten(), k.flatten()], axis=1)
+    s, _ = clip_patch_start(center, shape, patch_size)
+    return s
+
+
 def get_patch_valid(image, label, enhance, patch_size):
     '''
     规则裁剪，制作重复区域
@@ -107,51 +186,101 @@ def get_patch_valid(image, label, enhance, patch_size):
     :return:
     '''
 
-    shape = label.shape
-    shape = np.array(shape)
     label_patch_list = []
     data_patch_list = []
     enhance_patch_list = []
-
-    img_record = label.copy()
-    # i,j,k=np.where(label==1)
-    x = np.arange(patch_size // 2, shape[0], patch_size // 2)
-    y = np.arange(patch_size // 2, shape[1], patch_size //2)
-    z = np.arange(patch_size // 2, shape[2], patch_size //2)
-    i, j, k = np.meshgrid(x, y, z)
-    i, j, k = i.flatten(), j.flatten(), k.flatten()
-
     loc_record = []
 
-    for index in range(i.shape[0]):
-        c = np.array([i[index], j[index], k[index]])
-        s = c - patch_size // 2
-        e = c + patch_size // 2
-        z_s = np.zeros_like(s)
-
-        e[s < z_s] = patch_size
-        s[s < z_s] = 0
-
-        s[e > shape] = shape[e > shape] - patch_size
-        e[e > shape] = shape[e > shape]
-
-        label_patch = label[s[0]:e[0], s[1]:e[1], s[2]:e[2]]
-        label_patch_list.append(label_patch)
+    for s in grid_patch_start(label.shape, patch_size):
+        e = s + patch_size
+        label_patch_list.append(label[s[0]:e[0], s[1]:e[1], s[2]:e[2]])
+        data_patch_list.append(image[s[0]:e[0], s[1]:e[1], s[2]:e[2]])
+        enhance_patch_list.append(enhance[s[0]:e[0], s[1]:e[1], s[2]:e[2]])
+        loc_record.append(s)
 
-        data_patch = image[s[0]:e[0], s[1]:e[1], s[2]:e[2]]
-        data_patch_list.append(data_patch)
+    return data_patch_list, label_patch_list, enhance_patch_list, loc_record
 
-        enhance_patch_list.append(enhance[s[0]:e[0], s[1]:e[1], s[2]:e[2]])
 
-        loc_record.append(s)
+def save_patch_record(save_path, ID, loc_record, record_type='csv', source=None):
+    '''
+    一次性写出一个病例的patch位置，代替逐行增加DataFrame并反复to_csv
+    :param save_path: 保存目录 save_path/ID.csv 或 save_path/ID.npz
+    :param ID: 病例id，patch文件名为ID_index.nii.gz
+    :param loc_record: patch位置合集 (N,3)
+    :param record_type: 'csv' 与原来的csv相同 ; 'npz' 按列保存的int32数组 ; 'both' 两种都保存，
+                        只保存一种时删除该病例另一种格式的旧位置表
+    :param source: 生成位置表时的源文件信息，给出时一起保存在npz中，用于判断位置表是否失效
+    '''
+    loc = np.array(loc_record, dtype=np.int32).reshape(-1, 3)
+    name = np.array([ID + '_%d.nii.gz' % index for index in range(loc.shape[0])])
+    # load_patch_record优先读取npz，旧的npz会遮住新写的csv，两种格式保持一致
+    for suffix in ['npz', 'csv']:
+        if record_type not in [suffix, 'both']:
+            try:
+                os.remove(os.path.join(save_path, ID + '.' + suffix))
+            except FileNotFoundError:
+                pass
+    if record_type in ['npz', 'both']:
+        extra = dict() if source is None else {'source': np.asarray(source)}
+        # 先写临时文件再改名，其他进程不会读到不完整的文件
+        tmp_path = os.path.join(save_path, '%s.%d.part.npz' % (ID, os.getpid()))
+        np.savez(tmp_path, name=name, x=loc[:, 0], y=loc[:, 1], z=loc[:, 2], **extra)
+        os.replace(tmp_path, os.path.join(save_path, ID + '.npz'))
+    if record_type in ['csv', 'both']:
+        df = pd.DataFrame({'x': loc[:, 0], 'y': loc[:, 1], 'z': loc[:, 2]}, index=name)
+        df.to_csv(os.path.join(save_path, ID + '.csv'))
+
+
+def load_patch_record(record_path, ID):
+    '''
+    读取save_patch_record保存的patch位置，优先读取npz
+    :param record_path: 保存目录
+    :param ID: 病例id
+    :return: name:patch文件名 (N,) ; loc:patch起点 (N,3)
+    '''
+    npz_path = os.path.join(record_path, ID + '.npz')
+    if os.path.exists(npz_path):
+        record = np.load(npz_path)
+        return record['name'], np.stack([record['x'], record['y'], record['z']], axis=1)
+    record = pd.read_csv(os.path.join(record_path, ID + '.csv'), index_col=0)
+    return record.index.to_numpy(), record[['x', 'y', 'z']].to_numpy()
 
-        img_record[s[0]:e[0], s[1]:e[1], s[2]:e[2]] = 0
 
-    return data_patch_list, label_patch_list, enhance_patch_list, loc_record
+def save_patch_stack(save_path, ID, patch_lists, loc_record, affine, patch_size):
+    '''
+    将一个病例的全部patch写入一个连续的float32数组文件，可以用np.load(mmap_mode='r')直接切片读取
+    :param save_path: 保存目录 save_path/ID.npy, save_path/ID_record.npz
+    :param ID: 病例id
+    :param patch_lists: 各个通道的patch列表,如[img_list, label_list, enhance_list]
+    :param loc_record: patch位置合集
+    :param affine: 原图像的affine
+    :param patch_size: patch的大小
+    :return: patch个数
+    '''
+    num = len(loc_record)
+    shape = (num, len(patch_lists), patch_size, patch_size, patch_size)
+    stack_path = os.path.join(save_path, ID + '.npy')
+    if num == 0:
+        np.save(stack_path, np.zeros(shape, dtype=np.float32))
+    else:
+        stack = np.lib.format.open_memmap(stack_path, mode='w+', dtype=np.float32, shape=shape)
+        for c, p_list in enumerate(patch_lists):
+            for index, p in enumerate(p_list):
+                stack[index, c] = p
+        stack.flush()
+        del stack
+    loc = np.array(loc_record, dtype=np.int32).reshape(-1, 3)
+    np.savez(os.path.join(save_path, ID + '_record.npz'), loc=loc, affine=affine)
+    return num
 
 
 class Get_patch:
-    def __init__(self, data_path, label_path, frangi_path, save_path, patch_size, data_type):
+    def __init__(self, data_path, label_path, frangi_path, save_path, patch_size, data_type, save_type='nii',
+                 record_type='csv'):
+        '''
+        :param save_type: 'nii' 每个patch保存为nii.gz ; 'npy' 每个病例保存为一个patch数组文件
+        :param record_type: patch位置的保存格式 'csv', 'npz' or 'both'
+        '''
         self.data_path = data_path
         self.label_path = label_path
         self.frangi_path = frangi_path
@@ -159,17 +288,22 @@ class Get_patch:
         self.save_label_path = os.path.join(save_path, 'patch_%d' % patch_size, '%s_label_patch' % data_type)
         self.save_frangi_path = os.path.join(save_path, 'patch_%d' % patch_size, '%s_enhance_patch' % data_type)
         self.save_record_path = os.path.join(save_path, 'patch_%d' % patch_size, 'csv_patch_record')
+        self.save_stack_path = os.path.join(save_path, 'patch_%d' % patch_size, '%s_patch_stack' % data_type)
         self.patch_size = patch_size
         self.data_type = data_type
+        self.save_type = save_type
+        self.record_type = record_type
 
-        os.makedirs(self.save_img_path,exist_ok=True)
-        os.makedirs(self.save_label_path,exist_ok=True)
-        os.makedirs(self.save_frangi_path,exist_ok=True)
+        if save_type == 'npy':
+            os.makedirs(self.save_stack_path, exist_ok=True)
+        else:
+            os.makedirs(self.save_img_path,exist_ok=True)
+            os.makedirs(self.save_label_path,exist_ok=True)
+            os.makedirs(self.save_frangi_path,exist_ok=True)
         os.makedirs(self.save_record_path,exist_ok=True)
 
     def run_main(self, i):
         print(i)
-        df = pd.DataFrame(columns=['x', 'y', 'z'])
         d_path = os.path.join(self.data_path, i, 'img.nii.gz')
         l_path = os.path.join(self.label_path, i, 'label.nii.gz')
         e_path = os.path.join(self.frangi_path, i, 'frangi.nii.gz')
@@ -194,12 +328,15 @@ class Get_patch:
         img_list, label_list, enhance_list, loc_record = g_p(img, p_label, enhance, self.patch_size)
         ID = i
         affine = l_nii.affine
-        for index, p in enumerate(img_list):
-            nib.save(nib.Nifti1Image(p, affine), os.path.join(self.save_img_path, ID + '_%d.nii.gz' % index))
-            nib.save(nib.Nifti1Image(label_list[index], affine),
-                     os.path.join(self.save_label_path, ID + '_%d.nii.gz' % index))
-            df.loc[ID + '_%d.nii.gz' % index] = [loc_record[index][0], loc_record[index][1], loc_record[index][2]]
-            nib.save(nib.Nifti1Image(enhance_list[index], affine),
-                     os.path.join(self.save_frangi_path, ID + '_%d.nii.gz' % index))
-            df.to_csv(os.path.join(self.save_record_path, ID + '.csv'))
+        if self.save_type == 'npy':
+            save_patch_stack(self.save_stack_path, ID, [img_list, label_list, enhance_list], loc_record, affine,
+                             self.patch_size)
+        else:
+            for index, p in enumerate(img_list):
+                nib.save(nib.Nifti1Image(p, affine), os.path.join(self.save_img_path, ID + '_%d.nii.gz' % index))
+                nib.save(nib.Nifti1Image(label_list[index], affine),
+                         os.path.join(self.save_label_path, ID + '_%d.nii.gz' % index))
+                nib.save(nib.Nifti1Image(enhance_list[index], affine),
+                         os.path.join(self.save_frangi_path, ID + '_%d.nii.gz' % index))
+        save_patch_record(self.save_record_path, ID, loc_record, self.record_type)
 
@@ -2,7 +2,7 @@ import numpy as np
 import nibabel as nib
 import os
 import pandas as pd
-from skimage.morphology import skeletonize
+from utils.Get_patch import centerline_patch_start, skeleton_loc, save_patch_stack, save_patch_record
 
 
 def get_patch(image, label,flag_label, patch_size):
@@ -14,44 +14,23 @@ def get_patch(image, label,flag_label, patch_size):
     :return: data_patch_list:图像patch合集 ;label_patch_list,标签patch合集; loc_record patch位置合集
     '''
 
-    shape = flag_label.shape
-    shape = np.array(shape)
     label_patch_list = []
     data_patch_list = []
-    flag_record = skeletonize(flag_label.astype(np.uint8))
-    i, j, k = np.where(flag_record == 1)
     loc_record = []
 
     # 沿着中心线裁剪
-    pos = 0
-    for index in range(i.shape[0]):
-        if flag_record[i[index], j[index], k[index]] == 1:
-            c = np.array([i[index], j[index], k[index]])
-            s = c - patch_size // 2
-            e = c + patch_size // 2
-            z_s = np.zeros_like(s)
-
-            e[s < z_s] = patch_size
-            s[s < z_s] = 0
-
-            s[e > shape] = shape[e > shape] - patch_size
-            e[e > shape] = shape[e > shape]
-
-            label_patch = label[s[0]:e[0], s[1]:e[1], s[2]:e[2]]
-            label_patch_list.append(label_patch)
-
-            data_patch = image[s[0]:e[0], s[1]:e[1], s[2]:e[2]]
-            data_patch_list.append(data_patch)
-
-            loc_record.append(s)
-            flag_record[s[0]:e[0], s[1]:e[1], s[2]:e[2]] = 0
-            pos = pos + 1
+    for s in centerline_patch_start(skeleton_loc(flag_label), flag_label.shape, patch_size):
+        e = s + patch_size
+        label_patch_list.append(label[s[0]:e[0], s[1]:e[1], s[2]:e[2]])
+        data_patch_list.append(image[s[0]:e[0], s[1]:e[1], s[2]:e[2]])
+        loc_record.append(s)
 
     return data_patch_list, label_patch_list, loc_record
 
 
 class Get_patch_from_pre:
-    def __init__(self, data_path, label_path, pre_path, save_path, patch_size,data_type,prior_name='pre_cl.nii.gz'):
+    def __init__(self, data_path, label_path, pre_path, save_path, patch_size,data_type,prior_name='pre_cl.nii.gz',
+                 save_type='nii',record_type='csv'):
         '''
         :param data_path: 真实图像路径 data_path/id/img.nii.gz 输入的是data_path
         :param label_path: 真实标签路径：label_path/id/label.nii.gz 输入的是label_path
@@ -59,6 +38,8 @@ class Get_patch_from_pre:
         :param save_path: 储存patch合集的位置
         :param patch_size: patch大小为int
         :param data_type: str 数据类型，train or valid
+        :param save_type: 'nii' 每个patch保存为nii.gz ; 'npy' 每个病例保存为一个patch数组文件
+        :param record_type: patch位置的保存格式 'csv', 'npz' or 'both'
         '''
 
         self.data_path = data_path
@@ -71,13 +52,18 @@ class Get_patch_from_pre:
         self.save_img_path = os.path.join(save_path, 'patch_%d' % patch_size, '%s_img_patch' % data_type)
         self.save_label_path = os.path.join(save_path, 'patch_%d' % patch_size, '%s_label_patch' % data_type)
         self.save_record_path = os.path.join(save_path, 'patch_%d' % patch_size, 'csv_patch_record')
-
-        os.makedirs(self.save_img_path,exist_ok=True)
-        os.makedirs(self.save_label_path,exist_ok=True)
+        self.save_stack_path = os.path.join(save_path, 'patch_%d' % patch_size, '%s_patch_stack' % data_type)
+        self.save_type = save_type
+        self.record_type = record_type
+
+        if save_type == 'npy':
+            os.makedirs(self.save_stack_path, exist_ok=True)
+        else:
+            os.makedirs(self.save_img_path,exist_ok=True)
+            os.makedirs(self.save_label_path,exist_ok=True)
         os.makedirs(self.save_record_path,exist_ok=True)
 
     def run(self, i):
-        df = pd.DataFrame(columns=['x', 'y', 'z'])
         d_path = os.path.join(self.data_path, i, 'img.nii.gz')
         l_path = os.path.join(self.label_path, i, 'label.nii.gz')
         p_path=os.path.join(self.pre_path,i,self.prior_name)
@@ -96,11 +82,13 @@ class Get_patch_from_pre:
         ID = i
         affine = d_nii.affine
 
-        for index, p in enumerate(img_list):
-            nib.save(nib.Nifti1Image(p, affine), os.path.join(self.save_img_path, ID + '_%d.nii.gz' % index))
-            nib.save(nib.Nifti1Image(label_list[index], affine),
-                     os.path.join(self.save_label_path, ID + '_%d.nii.gz' % index))
-            df.loc[ID + '_%d.nii.gz' % index] = [loc_record[index][0], loc_record[index][1], loc_record[index][2]]
-            df.to_csv(os.path.join(self.save_record_path, ID + '.csv'))
+        if self.save_type == 'npy':
+            save_patch_stack(self.save_stack_path, ID, [img_list, label_list], loc_record, affine, self.patch_size)
+        else:
+            for index, p in enumerate(img_list):
+                nib.save(nib.Nifti1Image(p, affine), os.path.join(self.save_img_path, ID + '_%d.nii.gz' % index))
+                nib.save(nib.Nifti1Image(label_list[index], affine),
+                         os.path.join(self.save_label_path, ID + '_%d.nii.gz' % index))
+        save_patch_record(self.save_record_path, ID, loc_record, self.record_type)
 
 
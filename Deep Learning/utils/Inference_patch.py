@@ -0,0 +1,107 @@
+import numpy as np
+import os
+import time
+import resource
+import torch
+import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor
+from utils.utils import normalize
+from utils.Get_patch import grid_patch_start, load_patch_record
+from utils.Recover_patch import Patch_blender
+
+
+def peak_rss():
+    # 当前进程的内存峰值(MB)，优先读取/proc中的VmHWM(ru_maxrss在exec后会保留父进程的峰值)，单位都是KB
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM'):
+                    return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Patch_inference:
+    def __init__(self, model, device, data_path, save_pre_path, patch_size, batch_size, add_enhance=False,
+                 record_path=None, mode='max', save_file_name='pre_crop.nii.gz'):
+        '''
+        按病例的滑窗推断：直接从3D图像切出patch，成批送入网络，预测在内存中融合，每个病例只保存一个3D图像，
+        不再经过pre_patch文件
+        :param model: 训练好的网络
+        :param device: 推断使用的设备
+        :param data_path: 图像路径 data_path/id/img.nii.gz，add_enhance时还需要data_path/id/frangi.nii.gz
+        :param save_pre_path: 保存路径 save_pre_path/id/save_file_name
+        :param patch_size: patch的大小
+        :param batch_size: 每次送入网络的patch个数
+        :param add_enhance: 是否加入frangi增强作为第二个通道
+        :param record_path: patch位置记录的目录，有该病例的记录时使用记录的位置，否则使用半重叠的网格
+        :param mode: 重叠区域的融合方式 'max', 'mean' or 'gaussian'
+        '''
+        self.model = model
+        self.device = device
+        self.data_path = data_path
+        self.save_pre_path = save_pre_path
+        self.patch_size = patch_size
+        self.batch_size = batch_size
+        self.add_enhance = add_enhance
+        self.record_path = record_path
+        self.mode = mode
+        self.save_file_name = save_file_name
+
+    def get_loc(self, id, shape):
+        if self.record_path is not None and (os.path.exists(os.path.join(self.record_path, id + '.npz')) or
+                                             os.path.exists(os.path.join(self.record_path, id + '.csv'))):
+            return load_patch_record(self.record_path, id)[1]
+        return np.array(grid_patch_start(shape, self.patch_size))
+
+    def load_case(self, id):
+        '''
+        :return: 输入图像(C,x,y,z) float32，与patch数据集的预处理相同；affine；patch起点(N,3)
+        '''
+        img_nii = nib.load(os.path.join(self.data_path, id, 'img.nii.gz'))
+        img = img_nii.get_fdata(dtype=np.float32)
+        if self.add_enhance:
+            enhance = nib.load(os.path.join(self.data_path, id, 'frangi.nii.gz')).get_fdata(dtype=np.float32)
+            volume = np.stack([img, enhance], axis=0)
+        else:
+            volume = normalize(img)[np.newaxis]
+        return volume, img_nii.affine, self.get_loc(id, img.shape)
+
+    def predict(self, volume, loc):
+        p = self.patch_size
+        blender = Patch_blender(volume.shape[1:], p, self.mode)
+        for b in range(0, loc.shape[0], self.batch_size):
+            s = loc[b:b + self.batch_size]
+            batch = np.stack([volume[:, x:x + p, y:y + p, z:z + p] for x, y, z in s], axis=0)
+            with torch.no_grad():
+                outputs = torch.sigmoid(self.model(torch.from_numpy(batch).to(self.device)))
+            blender.add(outputs.squeeze(1).cpu().numpy(), s)
+        return blender.result()
+
+    def save(self, id, img, affine):
+        img_bina = (img > 0.5).astype(np.float32)
+        os.makedirs(os.path.join(self.save_pre_path, id), exist_ok=True)
+        nib.save(nib.Nifti1Image(img_bina, affine), os.path.join(self.save_pre_path, id, self.save_file_name))
+
+    def run(self, id):
+        volume, affine, loc = self.load_case(id)
+        self.save(id, self.predict(volume, loc), affine)
+
+    def run_all(self, ID_list):
+        '''
+        逐个病例推断，读取下一个病例与当前病例的推断同时进行
+        :return: 病例数，cases/s，内存峰值(MB)
+        '''
+        self.model.eval()
+        t0 = time.time()
+        with ThreadPoolExecutor(1) as pool:
+            future = pool.submit(self.load_case, ID_list[0]) if len(ID_list) > 0 else None
+            for n, id in enumerate(ID_list):
+                volume, affine, loc = future.result()
+                if n + 1 < len(ID_list):
+                    future = pool.submit(self.load_case, ID_list[n + 1])
+                self.save(id, self.predict(volume, loc), affine)
+                print('id:', id)
+        t = time.time() - t0
+        speed = len(ID_list) / t if t > 0 else 0
+        print('cases:%d | %.3f cases/s | peak RSS:%.0fMB' % (len(ID_list), speed, peak_rss()))
+        return len(ID_list), speed, peak_rss()
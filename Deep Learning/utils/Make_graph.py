@@ -1,9 +1,9 @@
 import numpy as np
 from skimage.filters import sobel
 import nibabel as nib
-from utils.utils import loc_convert, dijkstra, get_line, extract_slice
+from utils.utils import loc_convert, dijkstra, get_lines, extract_slice, slice_rotate_mat
 from utils.Calculate_metrics import get_region_num
-from utils.utils import convert_np_graph
+from utils.utils import convert_np_graph, Centerline_graph
 import dgl
 from scipy.ndimage.interpolation import zoom
 from skimage.morphology import skeletonize
@@ -13,6 +13,7 @@ from dgl.data.utils import save_graphs, load_graphs
 import os
 from scipy import ndimage
 import glob
+import hashlib
 
 
 def get_contour(img):
@@ -23,26 +24,11 @@ def get_contour(img):
     return contour
 
 
-def get_point_feature(point, normal, image, contour, spacing, radiu_stride=32, tangle=15):
+def ray_grid(spacing, radiu_stride=32, tangle=15):
     '''
-    该函数输入一个点的坐标，切线方向，以及原图像，对应的轮廓图像以及空间的分辨率,最后得到24个方向的特征+半径
-    :param point:中心线点 (N,3)
-    :param normal:该中心点上的法向量 (N,3)
-    :param image: 3D图像
-    :param spacing:体素空间大小 (1,3)
-    :return:X 为每一个中心线点的特征 (N,24,33)
+    射线上各点在64x64切片网格上的下标，与节点无关，只需要计算一次
+    :return: (360//tangle, radiu_stride+1, 2)
     '''
-    # 首先得到初始点序列
-    # 对于任意过点point并与normal垂直的直线都位于垂直平面上
-    # 令x=point[0]-1,y=point[1]-1
-    # normal需要经过去零处理
-    N = point.shape[0]
-    docker = np.zeros_like(image)
-    epsilon = 1e-12
-    normal[normal == 0] = epsilon
-    normal = normal / np.linalg.norm(normal, axis=1).reshape(N, 1)
-
-    # 两次旋转
     # 第一次现在xy平面初始化24射线,初始坐标方向为垂直方向，初始化点为原点
     init_vec = np.array([0, 0, 1]).reshape(1, 3)
     init_point = np.array([0, 0, 0]).reshape(1, 3)
@@ -54,9 +40,6 @@ def get_point_feature(point, normal, image, contour, spacing, radiu_stride=32, t
     stride = stride[:, np.newaxis]
     stride = np.repeat(stride, 3, axis=1)
     init_point_arr = init_point + stride * 0.1 * radius_vector
-    point_list = []
-
-    slicer, _, true_loc = extract_slice(docker, point, normal, 32)
 
     point1_list = []
     for index, i in enumerate(range(0, 360, tangle)):
@@ -64,57 +47,64 @@ def get_point_feature(point, normal, image, contour, spacing, radiu_stride=32, t
         point1_list.append(point1)
 
     point1_list = np.array(point1_list)  # (24,33,3)
-    point1_list = np.floor(point1_list / spacing).astype(np.int)  # (24,33,3)
-    point2 = true_loc[:, :, point1_list[:, :, 0], point1_list[:, :, 1]]  # (N,3,24,33)
-
-    debug = False
-    if debug == True:
-        a = np.zeros_like(image)
-        for p, i in enumerate(point_list):
-            index = i
-            a[index[-1, 0], index[-1, 1], index[-1, 2]] = p
-        print('debug')
-        slicer, _, _ = extract_slice(a, point, normal, 32)
-        x, y = np.where(slicer == 1)
-        # print(print(x.shape))
-        # plt.imshow(slicer)
-        # plt.show()
-
-    # point_list = np.array(point2)
-    point2 = np.transpose(point2, (0, 2, 3, 1))  # (N,24,33,3)
-    point2 = point2 * spacing  # (N,24,33,3)
-
-    # 特征和标签，前33维是特征，最后一维是半径长度,最后三维为方向信息
-    X = np.zeros((N, 360 // tangle, radiu_stride + 2))
-
-    for i in range(point2.shape[1]):  # for i in 24
-        xyz_index = np.round(point2[:, i, :, :] / spacing.reshape(1, 3)).astype(np.int)  # (N,33,3)
-        # xyz_index=point_list[i,:,:]
-        c_p = np.zeros((xyz_index.shape[0], xyz_index.shape[1]))  # (N,33)
-        for p_index in range(xyz_index.shape[1]):  # for p_index in 33
+    return np.floor(point1_list / spacing).astype(np.int64)[:, :, :2]  # (24,33,2)
 
-            mid_loc = xyz_index[:, p_index, :]  # (N,3)
-            flag = (mid_loc[:, 0] >= 0) & (mid_loc[:, 0] < image.shape[0]) & (mid_loc[:, 1] >= 0) & (
-                        mid_loc[:, 1] < image.shape[1]) & (mid_loc[:, 2] >= 0) & (mid_loc[:, 2] < image.shape[2])
-            X[flag, i, p_index] = image[mid_loc[flag, 0], mid_loc[flag, 1], mid_loc[flag, 2]]
-            c_p[flag, p_index] = contour[mid_loc[flag, 0], mid_loc[flag, 1], mid_loc[flag, 2]]
 
-        edge_index = []
-        for n in range(N):
-            c_index = np.where(c_p[n, :] != 0)
-            if c_index[0].shape[0] == 0:
-                contour_index = radiu_stride
-            elif c_index[0].shape[0] == 1:
-                contour_index = c_index[0][0]
-            else:
-                contour_index = np.max(c_index[0])
-            edge_index.append(contour_index)  # (N)
-
-        edge_point = xyz_index[list(range(xyz_index.shape[0])), edge_index]  # (N,3)
-
-        d = np.sqrt(np.sum((edge_point * spacing - point * spacing) ** 2, axis=1))  # (N,)
+def get_point_feature(point, normal, image, contour, spacing, radiu_stride=32, tangle=15, interp='nearest'):
+    '''
+    该函数输入一个点的坐标，切线方向，以及原图像，对应的轮廓图像以及空间的分辨率,最后得到24个方向的特征+半径
+    所有节点、方向与半径上的点一次取值
+    :param point:中心线点 (N,3)
+    :param normal:该中心点上的法向量 (N,3)
+    :param image: 3D图像
+    :param spacing:体素空间大小 (1,3)
+    :param interp: 'nearest' 射线上的点取整后取值，越界的坐标置0，与extract_slice相同 ; 'linear' 三线性插值，越界取0
+    :return:X 为每一个中心线点的特征 (N,24,33)
+    '''
+    N = point.shape[0]
+    epsilon = 1e-12
+    normal[normal == 0] = epsilon
+    normal = normal / np.linalg.norm(normal, axis=1).reshape(N, 1)
+    spacing = np.asarray(spacing).reshape(3)
+    shape = np.array(image.shape)
+
+    # 射线上的点在64x64切片网格上的下标(i,j)对应切片平面坐标(j-32,i-32,0)，旋转到与法向量垂直后平移到中心线点
+    grid = ray_grid(spacing, radiu_stride, tangle)
+    plane = np.stack([grid[:, :, 1] - 32, grid[:, :, 0] - 32, np.zeros_like(grid[:, :, 0])], axis=-1)  # (24,33,3)
+    rotate = slice_rotate_mat(normal)  # (N,3,3)
+    sub_loc = np.einsum('nij,asj->nasi', rotate, plane.astype(np.float64)) + point[:, np.newaxis, np.newaxis, :]
+
+    if interp == 'nearest':
+        xyz_index = np.round(sub_loc)
+        xyz_index[xyz_index >= shape] = 0
+        xyz_index[xyz_index < 0] = 0
+        xyz_index = xyz_index.astype(np.int64)  # (N,24,33,3)
+        point2 = xyz_index * spacing
+        value = image[xyz_index[..., 0], xyz_index[..., 1], xyz_index[..., 2]]
+        c_p = contour[xyz_index[..., 0], xyz_index[..., 1], xyz_index[..., 2]]
+        edge_loc = xyz_index
+    elif interp == 'linear':
+        point2 = sub_loc * spacing
+        value = ndimage.map_coordinates(image, sub_loc.reshape(-1, 3).T, order=1, mode='constant', cval=0)
+        value = value.reshape(sub_loc.shape[:3])
+        xyz_index = np.round(sub_loc).astype(np.int64)
+        flag = np.all((xyz_index >= 0) & (xyz_index < shape), axis=-1)
+        c_p = np.zeros(flag.shape)
+        c_p[flag] = contour[xyz_index[flag, 0], xyz_index[flag, 1], xyz_index[flag, 2]]
+        edge_loc = sub_loc
+    else:
+        raise ValueError("value error,no setting")
+
+    # 特征和标签，前33维是特征，最后一维是半径长度
+    X = np.zeros((N, 360 // tangle, radiu_stride + 2))
+    X[:, :, :radiu_stride + 1] = value
 
-        X[:, i, radiu_stride + 1] = d
+    # 每条射线上最后一个轮廓点，没有轮廓点时取射线的终点
+    hit = c_p != 0
+    edge_index = radiu_stride - np.argmax(hit[:, :, ::-1], axis=2)
+    edge_index[~hit.any(axis=2)] = radiu_stride
+    edge_point = np.take_along_axis(edge_loc, edge_index[:, :, np.newaxis, np.newaxis], axis=2)[:, :, 0]  # (N,24,3)
+    X[:, :, radiu_stride + 1] = np.sqrt(np.sum((edge_point * spacing - point[:, np.newaxis, :] * spacing) ** 2, axis=2))
 
     dist_map = np.sqrt(np.sum((point2 - point[:, np.newaxis, np.newaxis, :] * spacing) ** 2, axis=3))  # (N,24,33)
 
@@ -124,27 +114,13 @@ def get_point_feature(point, normal, image, contour, spacing, radiu_stride=32, t
 def divide_cl(cl):
     # cl中只有一个连通域
     # 寻找分支节点
-    x, y, z = np.where(cl == 1)
     new_cl = cl.copy()
-    point_nums = len(x)
-    loc = np.array([x, y, z]).T
-
-    # generate matrix of adj
-    adj = np.zeros((point_nums, point_nums))
-
-    # calculate adj
-    for i in range(point_nums):
-        for j in range(i + 1, point_nums):
-            d = np.sqrt(np.sum((loc[i, :] - loc[j, :]) ** 2))
-            adj[i, j] = d
-    adj = adj + adj.T
-    adj[adj > 1.8] = 0
-
-    # find leaf
-    for i in range(point_nums):
-        p = adj[i, :]
-        if np.sum(p != 0) > 2:
-            cl[loc[i, 0], loc[i, 1], loc[i, 2]] = 0
+    graph = Centerline_graph(cl)
+    loc = graph.loc
+
+    # 去掉分支节点
+    branch = graph.branches()
+    cl[loc[branch, 0], loc[branch, 1], loc[branch, 2]] = 0
 
     # 统计分段
     cl_rm_branch = sl(cl)
@@ -152,30 +128,131 @@ def divide_cl(cl):
     return cl_rm_branch
 
 
-def img_resample(img_nii, new_spacing):
+def resample_shape(header, new_spacing):
+    '''
+    只根据nii头文件计算重采样后的图像大小，不需要读取图像
+    :param header: nii头文件
+    :param new_spacing: 目标体素大小
+    :return: (3,)
+    '''
+    spacing = np.array(header.get_zooms())
+    img_shape = np.array(header.get_data_shape())
+    out_shape = spacing * img_shape / np.array(new_spacing)
+    return np.round(out_shape).astype(np.int64).flatten()
+
+
+def img_resample(img_nii, new_spacing, order=0):
     # 读取nii里面的数据
-    header = img_nii.header
-    spacing = header.get_zooms()
-    spacing = np.array(spacing)
     img = img_nii.get_fdata()
     img_shape = np.array(img.shape)
-    new_spacing = np.array(new_spacing)
 
     # 计算新的图片大小
-    out_shape = spacing * img_shape / new_spacing
-    out_shape = np.round(out_shape).astype(np.int)
-    out_shape = out_shape.flatten()
+    out_shape = resample_shape(img_nii.header, new_spacing)
     # 插值
 
     s = (out_shape[0] / img_shape[0], out_shape[1] / img_shape[1], out_shape[2] / img_shape[2])
 
-    new_image = zoom(img, zoom=s, order=0)
+    new_image = zoom(img, zoom=s, order=order)
 
     new_nii = nib.Nifti1Image(new_image, img_nii.affine)
     new_nii.header['pixdim'][1:4] = new_spacing
     return new_nii, new_image
 
 
+class Resample_cache:
+    def __init__(self, cache_path, max_size=None):
+        '''
+        重采样结果的硬盘缓存，按 病例id + 源文件的路径、大小与修改时间 + 目标spacing + 插值方式 命名，源文件改变后自动失效。
+        以压缩的npz保存(图像float32，标签uint8)，超过容量时删除最久没有使用的缓存
+        :param cache_path: 缓存目录，可以被不同fold、train/valid以及多个进程共用
+        :param max_size: 缓存容量(GB)，None为不限制
+        '''
+        self.cache_path = cache_path
+        self.max_size = max_size
+        os.makedirs(cache_path, exist_ok=True)
+
+    def key(self, id, src_path, new_spacing, order):
+        # 只读取源文件的stat，不再对整个.nii.gz计算hash
+        stat = os.stat(src_path)
+        spacing = '_'.join('%g' % i for i in np.array(new_spacing, dtype=np.float64).flatten())
+        h = hashlib.sha1(('%s|%d|%d|%s|%d' % (os.path.abspath(src_path), stat.st_size, stat.st_mtime_ns, spacing,
+                                              order)).encode()).hexdigest()
+        return '%s_%s' % (id, h[:16])
+
+    def get(self, id, src_path, new_spacing, order=0, dtype=np.float32):
+        '''
+        与img_resample(nib.load(src_path), new_spacing, order)相同，但结果以dtype保存并从缓存读取
+        :return: new_nii, new_image
+        '''
+        file_name = os.path.join(self.cache_path, self.key(id, src_path, new_spacing, order) + '.npz')
+        try:
+            # 更新修改时间，用于LRU；其他进程的evict可能在任何时候删除该文件，此时重新计算
+            os.utime(file_name)
+            with np.load(file_name) as f:
+                new_image, affine = f['img'], f['affine']
+        except FileNotFoundError:
+            img_nii = nib.load(src_path)
+            new_image = img_resample(img_nii, new_spacing, order)[1].astype(dtype)
+            affine = img_nii.affine
+            # 先写临时文件再改名，多个进程同时写同一个病例时不会读到不完整的文件
+            tmp_name = '%s.%d.tmp' % (file_name, os.getpid())
+            with open(tmp_name, 'wb') as f:
+                np.savez_compressed(f, img=new_image, affine=affine)
+            os.replace(tmp_name, file_name)
+            self.evict()
+        new_nii = nib.Nifti1Image(new_image, affine)
+        new_nii.header['pixdim'][1:4] = new_spacing
+        return new_nii, new_image
+
+    def evict(self):
+        if self.max_size is None:
+            return
+        file_list = []
+        for i in glob.glob(os.path.join(self.cache_path, '*.npz')):
+            try:
+                st = os.stat(i)
+            except FileNotFoundError:
+                continue
+            file_list.append((st.st_mtime, st.st_size, i))
+        # 从最近使用的开始累加，超过容量的全部删除
+        file_list.sort(reverse=True)
+        total = 0
+        for _, size, i in file_list:
+            total += size
+            if total > self.max_size * 1024 ** 3:
+                try:
+                    os.remove(i)
+                except FileNotFoundError:
+                    pass
+
+
+def ring_lattice_edges(layer_num, radius_nums):
+    '''
+    圆柱形环状网格的边：相邻编号相连，每层首尾相连，相邻两层对应节点及斜向节点相连，全部为双向边
+    边的顺序与原来逐层调用add_edges时相同
+    :param layer_num: 中心线点的个数
+    :param radius_nums: 每层射线的个数
+    :return: src, dst (E,)
+    '''
+    node_num = layer_num * radius_nums
+    r = radius_nums
+    start = np.arange(layer_num)[:, np.newaxis] * r  # (L,1)
+    head, tail = start, start + r - 1
+    a = start[:-1] + np.arange(r)  # (L-1,r)
+    b = a + r
+
+    # 除最后一层外，每层的边按 首尾, 对应, 斜向, 斜向, 首尾斜向 排列，每组先正向再反向
+    pairs = [(head[:-1], tail[:-1]), (a, b), (a[:, :-1], b[:, 1:]), (a[:, 1:], b[:, :-1]), (head[:-1], tail[:-1] + r)]
+    layer_src = np.concatenate([x for p, q in pairs for x in (p, q)], axis=1)
+    layer_dst = np.concatenate([x for p, q in pairs for x in (q, p)], axis=1)
+
+    src = np.concatenate([np.arange(0, node_num - 1), np.arange(1, node_num), layer_src.reshape(-1),
+                          [head[-1, 0], tail[-1, 0]]])
+    dst = np.concatenate([np.arange(1, node_num), np.arange(0, node_num - 1), layer_dst.reshape(-1),
+                          [tail[-1, 0], head[-1, 0]]])
+    return src, dst
+
+
 class Construct_graph:
     def __init__(self, cl_all, image, contour, spacing, tangle, radiu_stride=32):
         self.cl_all = cl_all
@@ -210,23 +287,6 @@ class Construct_graph:
         loc = node_dict['loc']
         radius_nums = 360 // tangle
 
-        # 初始化图，根据path的位置进行编码
-        node_num = loc.shape[0] * radius_nums
-        g = dgl.DGLGraph()
-        g.add_nodes(node_num)
-
-        # 构图1
-        # 初始化
-        g.ndata['xv'] = th.zeros(node_num, 33)
-        g.ndata['rv'] = th.zeros(node_num)
-        g.ndata['dist_map'] = th.zeros(node_num, 33)
-        g.ndata['loc'] = th.zeros(node_num, 33, 3)
-        g.ndata['layer'] = th.zeros(node_num, 1)
-        g.ndata['normal'] = th.zeros(node_num, 33, 3)
-        g.ndata['point'] = th.zeros(node_num, 33, 3)
-        g.add_edges(th.arange(0, node_num - 1), th.arange(1, node_num))
-        g.add_edges(th.arange(1, node_num), th.arange(0, node_num - 1))
-
         # 构造特征
         point = loc
         normal = node_dict['normal']
@@ -239,121 +299,79 @@ class Construct_graph:
         X_loc_all = feature_list[1]  # (N,24,33,3)
         dist_map_all = feature_list[2]  # (N,24,33)
 
-        for i in range(loc.shape[0]):
-
-            X = X_all[i, :, :]
-            X_loc = X_loc_all[i, :, :, :]
-            dist_map = dist_map_all[i, :, :]
-
-            # print(X)
-            # print(dist_map)
-
-            g.ndata['xv'][(i * radius_nums):((i + 1) * radius_nums)] = th.tensor(X[:, :(radiu_stride + 1)])
-            g.ndata['rv'][(i * radius_nums):((i + 1) * radius_nums)] = th.tensor(X[:, -1])
-            g.ndata['dist_map'][(i * radius_nums):((i + 1) * radius_nums)] = th.tensor(dist_map)
-            g.ndata['loc'][(i * radius_nums):((i + 1) * radius_nums)] = th.tensor(X_loc)
-            g.ndata['layer'][(i * radius_nums):((i + 1) * radius_nums)] = th.zeros(1, 1) + i
-            g.ndata['normal'][(i * radius_nums):((i + 1) * radius_nums)] = th.tensor(normal[i, :])
-            g.ndata['point'][(i * radius_nums):((i + 1) * radius_nums)] = th.tensor(point[i, :])
-
-            # 连边
-            g.add_edges(i * radius_nums, (i + 1) * radius_nums - 1)
-            g.add_edges((i + 1) * radius_nums - 1, i * radius_nums)
-            if i != loc.shape[0] - 1:
-                g.add_edges(th.arange((i * radius_nums), ((i + 1) * radius_nums)),
-                            th.arange(((i + 1) * radius_nums), ((i + 2) * radius_nums)))
-                g.add_edges(th.arange(((i + 1) * radius_nums), ((i + 2) * radius_nums)),
-                            th.arange((i * radius_nums), ((i + 1) * radius_nums)))
-
-                g.add_edges(th.arange((i * radius_nums), ((i + 1) * radius_nums) - 1),
-                            th.arange(((i + 1) * radius_nums) + 1, ((i + 2) * radius_nums)))
-                g.add_edges(th.arange(((i + 1) * radius_nums) + 1, ((i + 2) * radius_nums)),
-                            th.arange((i * radius_nums), ((i + 1) * radius_nums) - 1))
-
-                g.add_edges(th.arange((i * radius_nums) + 1, ((i + 1) * radius_nums)),
-                            th.arange(((i + 1) * radius_nums), ((i + 2) * radius_nums) - 1))
-                g.add_edges(th.arange(((i + 1) * radius_nums), ((i + 2) * radius_nums) - 1),
-                            th.arange((i * radius_nums) + 1, ((i + 1) * radius_nums)))
-                g.add_edges(i * radius_nums, (i + 2) * radius_nums - 1)
-                g.add_edges((i + 2) * radius_nums - 1, i * radius_nums)
+        # 所有边一次add_edges，边的顺序与逐层add_edges时相同
+        layer_num = loc.shape[0]
+        node_num = layer_num * radius_nums
+        src, dst = ring_lattice_edges(layer_num, radius_nums)
+        g = dgl.DGLGraph()
+        g.add_nodes(node_num)
+        g.add_edges(th.tensor(src), th.tensor(dst))
+
+        step = radiu_stride + 1
+        g.ndata['xv'] = th.tensor(X_all[:layer_num, :, :step].reshape(node_num, step), dtype=th.float32)
+        g.ndata['rv'] = th.tensor(X_all[:layer_num, :, -1].reshape(node_num), dtype=th.float32)
+        g.ndata['dist_map'] = th.tensor(dist_map_all[:layer_num].reshape(node_num, step), dtype=th.float32)
+        g.ndata['loc'] = th.tensor(X_loc_all[:layer_num].reshape(node_num, step, 3), dtype=th.float32)
+        g.ndata['layer'] = th.tensor(np.repeat(np.arange(layer_num), radius_nums).reshape(node_num, 1),
+                                     dtype=th.float32)
+        g.ndata['normal'] = th.tensor(np.broadcast_to(np.repeat(normal[:layer_num], radius_nums, axis=0)[:, np.newaxis],
+                                                      (node_num, step, 3)).copy(), dtype=th.float32)
+        g.ndata['point'] = th.tensor(np.broadcast_to(np.repeat(point[:layer_num], radius_nums, axis=0)[:, np.newaxis],
+                                                     (node_num, step, 3)).copy(), dtype=th.float32)
         return g
 
 
-def recover_node(g, image, spacing, str_key):
+def fill_slices(slicer):
     '''
+    对一组2D切片逐张做闭运算与孔洞填充。切片堆叠成3D，结构元只在切片平面内连通，一次完成所有切片
+    :param slicer: (N,h,w)
+    :return: (N,h,w) bool
+    '''
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = ndimage.generate_binary_structure(2, 1)
+    closed = ndimage.binary_closing(slicer, structure)
+    return ndimage.binary_fill_holes(closed, structure)
+
 
+def recover_node(g, image, spacing, str_key):
+    '''
+    按边表一次画出所有边对应的线段，再对每层中心处x,y,z三个方向的切片成批做孔洞填充
     :param g:图，一个图等于一个冠状动脉
     :param image: 图像大小
     :param spacing: 体素空间大小
-    :return: 3d numpy array
+    :return: 3d numpy array，血管内为1
     '''
 
     label = np.zeros_like(image)
-    # label_index = np.zeros_like(image)
     cl = np.zeros_like(image)
     # 半径长度
     rv = g.ndata[str_key].numpy()
     rv = rv.reshape(rv.shape[0], 1)
     # 位置
-    loc = np.round(g.ndata['loc'].numpy() / spacing).astype(np.int)
+    loc = np.round(g.ndata['loc'].numpy() / spacing).astype(np.int64)
     # 距离
     dist_map = g.ndata['dist_map'].numpy()
     mid_var = np.abs(dist_map - rv)
     min_index = np.argmin(mid_var, axis=1)
     edge_loc = loc[np.arange(dist_map.shape[0]), min_index, :]
 
-    # 连线
-    adj = g.adj().to_dense()
+    # 连线，重复的边只画一次
     n = g.number_of_nodes()
-    for ii in range(n):
-        neighbor_node = th.where(adj[ii, :] == 1)[0]
-        for j in neighbor_node:
-            point1 = edge_loc[ii, :]
-            point2 = edge_loc[j, :]
-
-            line = get_line(point1, point2, dim=3)
-            line1 = np.floor(line).astype(np.int)
-            line2 = np.ceil(line).astype(np.int)
-            label[line1[:, 0], line1[:, 1], line1[:, 2]] = 1
-            label[line2[:, 0], line2[:, 1], line2[:, 2]] = 1
+    src, dst = g.edges()
+    key = np.unique(src.numpy().astype(np.int64) * n + dst.numpy().astype(np.int64))
+    line = get_lines(edge_loc[key // n], edge_loc[key % n])
+    line = np.concatenate([np.floor(line), np.ceil(line)]).astype(np.int64)
+    label[line[:, 0], line[:, 1], line[:, 2]] = 1
 
+    # 切片都从连线后的label中取出，填充后一起写回
     center = loc[list(range(0, rv.shape[0], 24)), 0, :]
-    x_v = np.array([1, 0, 0]).reshape(1, 3)
-    x_v = np.repeat(x_v, repeats=center.shape[0], axis=0)
-    x_slicer, x_sub_loc, x_true_loc = extract_slice(label, center, x_v, 32)
-
-    y_v = np.array([0, 1, 0]).reshape(1, 3)
-    y_v = np.repeat(y_v, repeats=center.shape[0], axis=0)
-    y_slicer, y_sub_loc, y_true_loc = extract_slice(label, center, y_v, 32)
-
-    z_v = np.array([0, 0, 1]).reshape(1, 3)
-    z_v = np.repeat(z_v, repeats=center.shape[0], axis=0)
-    z_slicer, z_sub_loc, z_true_loc = extract_slice(label, center, z_v, 32)
-
-    for i_index in range(center.shape[0]):
-        xx = ndimage.binary_closing(x_slicer[i_index, :, :])
-        x_slicer[i_index, :, :] = ndimage.binary_fill_holes(xx)
-
-        yy = ndimage.binary_closing(y_slicer[i_index, :, :])
-        y_slicer[i_index, :, :] = ndimage.binary_fill_holes(yy)
-
-        zz = ndimage.binary_closing(z_slicer[i_index, :, :])
-        z_slicer[i_index, :, :] = ndimage.binary_fill_holes(zz)
-
-        label[x_true_loc[i_index, 0, :, :], x_true_loc[i_index, 1, :, :], x_true_loc[i_index, 2, :, :]] = \
-            label[x_true_loc[i_index, 0, :, :], x_true_loc[i_index, 1, :, :], x_true_loc[i_index, 2, :, :]] + x_slicer[
-                                                                                                              i_index,
-                                                                                                              :, :]
-
-        label[y_true_loc[i_index, 0, :, :], y_true_loc[i_index, 1, :, :], y_true_loc[i_index, 2, :, :]] = \
-            label[y_true_loc[i_index, 0, :, :], y_true_loc[i_index, 1, :, :], y_true_loc[i_index, 2, :, :]] + y_slicer[
-                                                                                                              i_index,
-                                                                                                              :, :]
-
-        label[z_true_loc[i_index, 0, :, :], z_true_loc[i_index, 1, :, :], z_true_loc[i_index, 2, :, :]] = \
-            label[z_true_loc[i_index, 0, :, :], z_true_loc[i_index, 1, :, :], z_true_loc[i_index, 2, :, :]] + z_slicer[
-                                                                                                              i_index,
-                                                                                                              :, :]
+    fill_loc = []
+    for v in np.eye(3, dtype=np.int64):
+        slicer, _, true_loc = extract_slice(label, center, np.repeat(v[np.newaxis], center.shape[0], axis=0), 32)
+        i, x, y = np.nonzero(fill_slices(slicer))
+        fill_loc.append(true_loc[i, :, x, y])
+    fill_loc = np.concatenate(fill_loc)
+    label[fill_loc[:, 0], fill_loc[:, 1], fill_loc[:, 2]] = 1
 
     return label, cl
 
@@ -371,8 +389,8 @@ class Recover_label:
         img_nii = nib.load(os.path.join(self.data_path, id, 'img.nii.gz'))
         # label_nii = nib.load(os.path.join(self.data_path, id, 'label.nii.gz'))
 
-        # image = img_nii.get_fdata()
-        _, image = img_resample(img_nii, self.spacing)
+        # 只需要重采样后的大小，从头文件得到
+        image = np.zeros(resample_shape(img_nii.header, self.spacing))
 
         img_new = np.zeros_like(image)
         # print(os.listdir(save_pre_path))
@@ -402,24 +420,24 @@ class Recover_label:
 
 
 class Make_Graph:
-    def __init__(self, image_path, label_path, cl_path, save_graph_path, dtype):
+    def __init__(self, image_path, label_path, cl_path, save_graph_path, dtype, cache=None):
+        '''
+        :param cache: Resample_cache，为None时每次都重新重采样
+        '''
         self.image_path = image_path
         self.label_path = label_path
         self.cl_path = cl_path
         self.save_graph_path = save_graph_path
         self.dtype = dtype
+        self.cache = cache
+        self.spacing = np.array([0.5, 0.5, 0.5])
 
     def run(self, id):
         s_path = os.path.join(self.save_graph_path, self.dtype)
         os.makedirs(s_path, exist_ok=True)
-        img_nii = nib.load(os.path.join(self.image_path, id, 'img.nii.gz'))
-        label_nii = nib.load(os.path.join(self.label_path, id, 'label.nii.gz'))
-        cl_nii = nib.load(os.path.join(self.cl_path, id, 'pre_label.nii.gz'))
 
-        spacing = np.array([0.5, 0.5, 0.5])
-        new_image_nii, image = img_resample(img_nii, spacing)
-        new_label_nii, label = img_resample(label_nii, spacing)
-        new_cl_nii, cl = img_resample(cl_nii, spacing)
+        spacing = self.spacing
+        image, label, cl = self.resample(id)
 
         # label = label_nii.get_fdata()
         cl = skeletonize(cl.astype(np.uint8))
@@ -431,7 +449,7 @@ class Make_Graph:
         mk_graph = Construct_graph(cl_branch, image, label, spacing, 15)
 
         for i in range(1, cl_num + 1):
-            per_lc = (cl_branch == i).astype(np.int)
+            per_lc = (cl_branch == i).astype(np.int64)
             if per_lc.sum() <= 5:
                 continue
             g = mk_graph.construct_graph(per_lc)
@@ -439,4 +457,12 @@ class Make_Graph:
         print(id + ':成功保存')
 
     def resample(self, id):
-        pass
+        '''
+        :return: 重采样到self.spacing的 图像, 标签, 粗分割结果
+        '''
+        path_list = [(os.path.join(self.image_path, id, 'img.nii.gz'), np.float32),
+                     (os.path.join(self.label_path, id, 'label.nii.gz'), np.uint8),
+                     (os.path.join(self.cl_path, id, 'pre_label.nii.gz'), np.uint8)]
+        if self.cache is None:
+            return [img_resample(nib.load(path), self.spacing)[1] for path, _ in path_list]
+        return [self.cache.get(id, path, self.spacing, dtype=dtype)[1] for path, dtype in path_list]
@@ -8,7 +8,7 @@ from dgl.data.utils import save_graphs, load_graphs
 import os
 import re
 from utils.Calculate_metrics import get_region_num
-from utils.utils import dijkstra
+from utils.utils import Centerline_graph
 
 Inf = math.inf
 
@@ -18,40 +18,17 @@ def convert_np_tree(img):
     :return: tree_struct_data
     '''
     # find the points of centerline
-    x, y, z = np.where(img == 1)
-    point_nums = len(x)
-    loc = np.array([x, y, z]).T
-
-    # generate matrix of adj
-    adj = np.zeros((point_nums, point_nums))
-
-    # calculate adj
-    for i in range(point_nums):
-        for j in range(i + 1, point_nums):
-            d = np.sqrt(np.sum((loc[i, :] - loc[j, :]) ** 2))
-            adj[i, j] = d
-    adj = adj + adj.T
-    adj[adj > 1.8] = 0
+    graph = Centerline_graph(img)
+    loc = graph.loc
 
     # find leaf
-    leaf = []
-    leaf_loc = []
-    for i in range(point_nums):
-        p = adj[i, :]
-        if np.sum(p != 0) == 1:
-            leaf.append(i)
-            leaf_loc.append(loc[i, :])
-
-    adj[adj == 0] = float('inf')
-    for i in range(point_nums):
-        adj[i, i] = 0
+    leaf = graph.leaves()
+    leaf_loc = loc[leaf]
 
     if len(leaf_loc)<=1:
 
         return None,None
 
-    leaf_loc = np.array(leaf_loc)
-    leaf = np.array(leaf)
     z = leaf_loc[:, 2]
     root = np.argmax(z)
     root_index = leaf[root]
@@ -62,11 +39,13 @@ def convert_np_tree(img):
     node_dict['loc'] = loc
     node_dict['leaves'] = leaf
 
-    # path_dict['leaf_node']
+    # path_dict['leaf_node']，所有路径从同一棵最短路径树中读出
+    parent = graph.shortest_path_tree(root_index)
     for i in leaf:
         if i != root_index:
-            p = dijkstra(adj.copy(), root_index, i)
-            path_dict[str(i)] = p
+            p = graph.get_path(parent, root_index, i)
+            if p is not None:
+                path_dict[str(i)] = p
     return path_dict, node_dict
 
 def get_picture2d(node_loc, img, label, patch_size):
@@ -136,45 +115,77 @@ def get_picture3d(node_loc, img, label, patch_size):
     return np.array([img_3d, label_3d, i, j, k])
 
 
-def convert_dgl(path_set, img_list, path_dict):
-    # 根据path_set编号
-    path_set = path_set.tolist()
+def patch_origin(node_loc, shape, patch_size):
+    '''
+    所有节点对应3D块的起点，与get_picture3d相同：x,y以节点为中心，z方向从节点向下取patch_size[2]层，越界时向内平移
+    :param node_loc: 节点坐标 (N,3)
+    :param shape: 图像大小
+    :param patch_size: [x,y,z]
+    :return: (N,3)
+    '''
+    p = np.array(patch_size)
+    start = node_loc - np.array([p[0] // 2, p[1] // 2, p[2]])
+    return np.clip(start, 0, np.array(shape) - p)
+
+
+def get_patches(img, origin, patch_size):
+    '''
+    一次取出所有起点处的3D块，不生成坐标网格
+    :param origin: (N,3)
+    :return: (N,x,y,z)
+    '''
+    window = np.lib.stride_tricks.sliding_window_view(img, tuple(patch_size))
+    return window[origin[:, 0], origin[:, 1], origin[:, 2]]
+
+
+def convert_dgl(path_set, node_data, path_dict):
+    '''
+    :param path_set: 节点在中心线上的编号，图中的节点按该顺序编号
+    :param node_data: 节点特征的字典，值为 (N,...)，与path_set顺序相同，建图后一次写入
+    :param path_dict: 根节点到各叶子节点的路径
+    '''
+    # 中心线编号 -> 图中节点编号，path_set无需有序
+    path_set = np.asarray(path_set)
+    order = np.argsort(path_set, kind='stable')
+    sorted_set = path_set[order]
+
+    def node_id(name):
+        return order[np.searchsorted(sorted_set, name)]
+
+    path_list = [np.asarray(path_dict[k], dtype=np.int64) for k in path_dict.keys()]
+    empty = [np.zeros(0, dtype=np.int64)]
+    # 每条路径上 子节点->父节点 的边
+    src = node_id(np.concatenate([p[1:] for p in path_list] + empty))
+    dst = node_id(np.concatenate([p[:-1] for p in path_list] + empty))
+    # 不同路径共用的边只保留第一次出现的，顺序与逐条添加时相同
+    _, first = np.unique(src * len(path_set) + dst, return_index=True)
+    first = np.sort(first)
     g = dgl.DGLGraph()
     g.add_nodes(len(path_set))
-    for k in path_dict.keys():
-        p = path_dict[k]
-        for index in range(len(p) - 1):
-            dgl_src = path_set.index(p[index + 1])
-            dgl_dst = path_set.index(p[index])
-            if g.has_edges_between(dgl_src, dgl_dst):
-                continue
-            g.add_edges(dgl_src, dgl_dst)
-            g.nodes[dgl_src].data['data'], g.nodes[dgl_src].data['label'] = th.tensor(
-                np.expand_dims(img_list[dgl_src, 0, :, :, :], axis=0)), th.tensor(
-                np.expand_dims(img_list[dgl_src, 1, :, :, :], axis=0))
-            g.nodes[dgl_src].data['loc'] = th.tensor(np.expand_dims(img_list[dgl_src, 2:5, :, :, :], axis=0))
-
-            g.nodes[dgl_dst].data['data'], g.nodes[dgl_dst].data['label'] = th.tensor(
-                np.expand_dims(img_list[dgl_dst, 0, :, :, :], axis=0)), th.tensor(
-                np.expand_dims(img_list[dgl_dst, 1, :, :, :], axis=0))
-            g.nodes[dgl_dst].data['loc'] = th.tensor(np.expand_dims(img_list[dgl_dst, 2:5, :, :, :], axis=0))
+    g.add_edges(th.tensor(src[first]), th.tensor(dst[first]))
+    for key, value in node_data.items():
+        g.ndata[key] = th.tensor(value)
 
     return g
 
 
 def recover_img(g, img):
     # img=img_nii.get_fdata()
-    loc = g.ndata['loc'].numpy()
     pre_label = g.ndata['pre_label'].numpy()
     pre_label = np.squeeze(pre_label, axis=1)
-    X, Y, Z = loc[:, 0, :, :], loc[:, 1, :, :], loc[:, 2, :, :]
-    # X=np.ascontiguousarray(X).flatten().astype(np.int)
-    # Y = np.ascontiguousarray(Y).flatten().astype(np.int)
-    # Z = np.ascontiguousarray(Z).flatten().astype(np.int)
-    # pre_label=np.ascontiguousarray(pre_label).flatten()
-    X = X.astype(np.int)
-    Y = Y.astype(np.int)
-    Z = Z.astype(np.int)
+    if 'origin' in g.ndata:
+        # 由块的起点得到坐标
+        origin = g.ndata['origin'].numpy().astype(np.int64)
+        px, py, pz = pre_label.shape[1:]
+        X = origin[:, 0].reshape(-1, 1, 1, 1) + np.arange(px).reshape(1, -1, 1, 1)
+        Y = origin[:, 1].reshape(-1, 1, 1, 1) + np.arange(py).reshape(1, 1, -1, 1)
+        Z = origin[:, 2].reshape(-1, 1, 1, 1) + np.arange(pz).reshape(1, 1, 1, -1)
+    else:
+        loc = g.ndata['loc'].numpy()
+        X, Y, Z = loc[:, 0, :, :], loc[:, 1, :, :], loc[:, 2, :, :]
+        X = X.astype(np.int64)
+        Y = Y.astype(np.int64)
+        Z = Z.astype(np.int64)
 
     img_recover = np.zeros_like(img)
     img_recover[X, Y, Z] = pre_label
@@ -221,18 +232,14 @@ class Convert_tree:
         label_path = os.path.join(self.label_path, id, 'label.nii.gz')
 
         all_cl = nib.load(cl_path).get_fdata()
-        img = nib.load(img_path).get_fdata()
-        true_label = nib.load(label_path).get_fdata()
+        img = nib.load(img_path).get_fdata(dtype=np.float32)
+        true_label = nib.load(label_path).get_fdata(dtype=np.float32)
         a = get_region_num(all_cl, 1)
         b = get_region_num(all_cl, 2) - a
         ab_list = [a,b]
 
         dt = self.data_type
-
-        if len(self.patch_size)==3:
-            g_picture=get_picture3d
-        else:
-            g_picture=get_picture2d
+        save_path = os.path.join(self.save_graph_path, 'patch_%d_%d_%d' % tuple(self.patch_size), dt)
 
         for index, ii in enumerate(ab_list):
             if ii.sum() <=5 :
@@ -240,27 +247,19 @@ class Convert_tree:
             cl = ii
             path_dict, node_dict = convert_np_tree(cl)
 
-            if path_dict==None:
+            if path_dict==None or len(path_dict)==0:
                 continue
 
-            path_list = []
-            for k in path_dict.keys():
-                path_list = path_list + path_dict[k]
-            path_set = np.unique(np.array(path_list))
-            img_list = []
-            for i in range(len(path_set)):
-                node = node_dict['loc'][path_set[i], :]
-                image3d = g_picture(node, img, true_label, self.patch_size)
-                img_list.append(image3d)
-            img_list = np.array(img_list)
-            g = convert_dgl(path_set, img_list, path_dict)
-            os.makedirs(os.path.join(self.save_graph_path, 'patch_%d_%d_%d' % (self.patch_size[0],self.patch_size[1],
-                                                                               self.patch_size[2]), dt), exist_ok=True)
+            path_set = np.unique(np.concatenate([path_dict[k] for k in path_dict.keys()]))
+            # 每个节点只保存块的起点，块的坐标在恢复时由起点得到
+            origin = patch_origin(node_dict['loc'][path_set, :], img.shape, self.patch_size)
+            node_data = {'data': get_patches(img, origin, self.patch_size),
+                         'label': get_patches(true_label, origin, self.patch_size),
+                         'origin': origin}
+            g = convert_dgl(path_set, node_data, path_dict)
+            os.makedirs(save_path, exist_ok=True)
             if g.num_nodes()!=0:
-                save_graphs(
-                    os.path.join(self.save_graph_path, 'patch_%d_%d_%d' % (self.patch_size[0],self.patch_size[1],
-                                                                           self.patch_size[2]), dt, '%s_g%d.bin' % (id, index)),
-                    [g])
+                save_graphs(os.path.join(save_path, '%s_g%d.bin' % (id, index)), [g])
 
 class Recover_img:
     def __init__(self,img_path,save_path,graph_path,save_file_name='pre_32.nii.gz'):
@@ -0,0 +1,73 @@
+import numpy as np
+from skimage.morphology import skeletonize
+
+'''
+二值图像的形态学操作，只在前景的包围盒内计算，结果为uint8
+'''
+
+
+def mask_box(mask, pad=0):
+    '''
+    前景的包围盒
+    :param mask: 二值图像
+    :param pad: 包围盒向外扩展的体素数，超出图像的部分截断
+    :return: 每个维度的slice，没有前景时为None
+    '''
+    foreground = mask != 0
+    box = []
+    for axis in range(mask.ndim):
+        index = np.where(np.any(foreground, axis=tuple(a for a in range(mask.ndim) if a != axis)))[0]
+        if index.shape[0] == 0:
+            return None
+        box.append(slice(max(index[0] - pad, 0), min(index[-1] + 1 + pad, mask.shape[axis])))
+    return tuple(box)
+
+
+def square_distance(mask, r):
+    '''
+    到前景的欧氏距离的平方，只计算到r为止：平方距离可以沿各个方向分别取最小值，每个方向只需平移2r次
+    :param mask: 二值图像
+    :param r: 最大距离
+    :return: uint16，距离大于r的体素为r*r+1
+    '''
+    cap = r * r + 1
+    d = np.where(mask != 0, 0, cap).astype(np.uint16)
+    for axis in range(mask.ndim):
+        out = d.copy()
+        for k in range(1, min(r, mask.shape[axis] - 1) + 1):
+            head = tuple(slice(None, -k) if a == axis else slice(None) for a in range(mask.ndim))
+            tail = tuple(slice(k, None) if a == axis else slice(None) for a in range(mask.ndim))
+            np.minimum(out[tail], d[head] + k * k, out=out[tail])
+            np.minimum(out[head], d[tail] + k * k, out=out[head])
+        d = np.minimum(out, cap, out=out)
+    return d
+
+
+def ball_dilation(mask, r):
+    '''
+    半径为r的球形膨胀，与binary_dilation(mask, generate_sphere3d(r))相同
+    即到前景的欧氏距离不超过r的体素
+    :param mask: 二值图像
+    :param r: 球的半径
+    :return: uint8
+    '''
+    out = np.zeros(mask.shape, dtype=np.uint8)
+    box = mask_box(mask, r)
+    if box is None:
+        return out
+    out[box] = square_distance(mask[box], r) <= r * r
+    return out
+
+
+def skeleton(mask):
+    '''
+    只在包围盒(向外留1个体素)内提取中心线，盒外全为0，结果与整幅图像skeletonize相同
+    :param mask: 二值图像
+    :return: uint8
+    '''
+    out = np.zeros(mask.shape, dtype=np.uint8)
+    box = mask_box(mask, 1)
+    if box is None:
+        return out
+    out[box] = skeletonize((mask[box] != 0).astype(np.uint8)) != 0
+    return out
@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import hashlib
+import collections
+import functools
+from utils.Executor import get_executor
+
+'''
+增量运行的流水线：每个节点声明输入与输出的路径模板，按病例拆分为任务
+任务的key由节点名、参数与所有输入文件的内容哈希得到，key未变且输出未被改动时跳过
+上游重新计算但输出内容不变时，下游不会重新计算
+状态保存在一个json文件中：{'tasks': {节点: {病例: {'key', 'outputs'}}}, 'files': {路径: [大小, 修改时间, 哈希]}}
+'''
+
+
+class Node:
+    def __init__(self, name, run, inputs, outputs, cases=None, per_case=True, batch=False, params=None):
+        '''
+        :param name: 节点名，在状态文件中唯一，与fold有关的节点应包含fold
+        :param run: per_case时为run(id)，batch时为run(id_list)只传入需要重新计算的病例，否则为run()
+                    使用进程池时需要可以pickle(如类实例的方法)
+        :param inputs: 输入文件或目录的路径模板，'{id}'替换为病例
+        :param outputs: 输出文件或目录的路径模板
+        :param cases: 病例列表；per_case为False时只用于展开模板中的'{id}'
+        :param per_case: 每个病例一个任务；False时整个节点为一个任务
+        :param batch: per_case时一次调用run处理所有需要重新计算的病例(如GPU推断，只加载一次模型)
+        :param params: 影响结果的其他参数，需要可以json序列化，改变时重新计算
+        '''
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.cases = [] if cases is None else list(cases)
+        self.per_case = per_case
+        self.batch = batch
+        self.params = params
+
+    def expand(self, templates, case):
+        if case is not None:
+            return [os.path.normpath(t.format(id=case)) for t in templates]
+        paths = []
+        for t in templates:
+            if '{id}' in t:
+                paths += [os.path.normpath(t.format(id=c)) for c in self.cases]
+            else:
+                paths.append(os.path.normpath(t))
+        return paths
+
+    def tasks(self):
+        '''
+        :return: [(病例, 输入路径, 输出路径)]，整个节点为一个任务时病例为None
+        '''
+        cases = self.cases if self.per_case else [None]
+        return [(c, self.expand(self.inputs, c), self.expand(self.outputs, c)) for c in cases]
+
+
+def call_task(run, case):
+    # 进程池中执行单个病例
+    run(case)
+    return case
+
+
+def parents(path):
+    # 路径的所有上级目录
+    result = []
+    while True:
+        path = os.path.dirname(path)
+        if path in ['', os.sep] or path in result:
+            return result
+        result.append(path)
+
+
+class Path_set:
+    def __init__(self, paths=()):
+        '''
+        一组输出路径，判断某个输入是否与其中的路径相同，或其中一个是另一个的上级目录
+        '''
+        self.paths = set()
+        self.dirs = set()
+        self.update(paths)
+
+    def update(self, paths):
+        for p in paths:
+            self.paths.add(p)
+            self.dirs.update(parents(p))
+
+    def overlap(self, paths):
+        return any(p in self.paths or p in self.dirs or any(d in self.paths for d in parents(p)) for p in paths)
+
+
+class Pipeline:
+    def __init__(self, state_path, pools=4):
+        '''
+        :param state_path: 状态文件
+        :param pools: 按病例执行时的进程数，1为在当前进程中依次执行；所有节点共用一个常驻进程池
+        '''
+        self.state_path = state_path
+        self.pools = pools
+        self.nodes = collections.OrderedDict()
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                self.state = json.load(f)
+        else:
+            self.state = {'tasks': {}, 'files': {}}
+
+    def add(self, node):
+        if node.name in self.nodes:
+            raise ValueError('duplicate node %s' % node.name)
+        self.nodes[node.name] = node
+        return node
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+        tmp_path = self.state_path + '.%d.part' % os.getpid()
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def file_hash(self, path):
+        '''
+        文件内容的sha1，大小与修改时间不变时使用记录的值；目录为其中所有文件的相对路径与哈希的哈希
+        :return: 不存在时为None
+        '''
+        if os.path.isdir(path):
+            h = hashlib.sha1()
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    p = os.path.join(root, name)
+                    h.update(os.path.relpath(p, path).encode())
+                    h.update(self.file_hash(p).encode())
+            return h.hexdigest()
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        record = self.state['files'].get(path)
+        if record is not None and record[0] == stat.st_size and record[1] == stat.st_mtime_ns:
+            return record[2]
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(functools.partial(f.read, 1 << 22), b''):
+                h.update(chunk)
+        self.state['files'][path] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+        return h.hexdigest()
+
+    def task_key(self, node, inputs):
+        h = hashlib.sha1(json.dumps([node.name, node.params], sort_keys=True).encode())
+        for p in inputs:
+            file_hash = self.file_hash(p)
+            if file_hash is None:
+                return None
+            h.update(p.encode())
+            h.update(file_hash.encode())
+        return h.hexdigest()
+
+    def order(self, targets=None):
+        '''
+        某个节点的输入是另一个节点的输出(或在其目录下)时，后者在前
+        :param targets: 只运行这些节点及其上游，None为全部
+        :return: 节点名的拓扑顺序
+        '''
+        outputs = {n: Path_set(p for t in node.tasks() for p in t[2]) for n, node in self.nodes.items()}
+        upstream = {n: set() for n in self.nodes}
+        for n, node in self.nodes.items():
+            inputs = [p for t in node.tasks() for p in t[1]]
+            for m in self.nodes:
+                if m != n and outputs[m].overlap(inputs):
+                    upstream[n].add(m)
+        if targets is not None:
+            keep, stack = set(), list(targets)
+            while stack:
+                n = stack.pop()
+                if n not in keep:
+                    keep.add(n)
+                    stack += list(upstream[n])
+            upstream = {n: upstream[n] & keep for n in upstream if n in keep}
+        order = []
+        while len(order) < len(upstream):
+            ready = [n for n in self.nodes if n in upstream and n not in order and not (upstream[n] - set(order))]
+            if not ready:
+                raise ValueError('pipeline has cycle')
+            order += ready
+        return order
+
+    def stale(self, node, case, key, outputs):
+        record = self.state['tasks'].get(node.name, {}).get(str(case))
+        if record is None or key is None or record['key'] != key:
+            return True
+        return any(self.file_hash(p) != record['outputs'].get(p) for p in outputs)
+
+    def record(self, node, case, key, outputs):
+        missing = [p for p in outputs if self.file_hash(p) is None]
+        if missing:
+            raise FileNotFoundError('%s %s did not write %s' % (node.name, case, missing[0]))
+        self.state['tasks'].setdefault(node.name, {})[str(case)] = {
+            'key': key, 'outputs': {p: self.file_hash(p) for p in outputs}}
+
+    def run(self, targets=None, dry_run=False, force=()):
+        '''
+        :param targets: 只运行这些节点及其上游
+        :param dry_run: 只列出需要重新计算的任务；上游需要重新计算时，依赖其输出的下游任务也列出
+        :param force: 这些节点的所有任务都重新计算
+        :return: {节点: (重新计算的任务数, 任务数, 耗时)}
+        '''
+        summary = collections.OrderedDict()
+        pending = Path_set()
+        try:
+            for name in self.order(targets):
+                node = self.nodes[name]
+                todo = []
+                for case, inputs, outputs in node.tasks():
+                    if dry_run and pending.overlap(inputs):
+                        todo.append((case, None, outputs))
+                        continue
+                    key = self.task_key(node, inputs)
+                    if key is None and not dry_run:
+                        missing = [p for p in inputs if self.file_hash(p) is None]
+                        raise FileNotFoundError('%s %s: missing input %s' % (name, case, missing[0]))
+                    if name in force or self.stale(node, case, key, outputs):
+                        todo.append((case, key, outputs))
+                print('%s: %d/%d tasks to run' % (name, len(todo), len(node.tasks())))
+                t0 = time.time()
+                if dry_run:
+                    pending.update(p for t in todo for p in t[2])
+                elif todo:
+                    self.execute(node, todo)
+                summary[name] = (len(todo), len(node.tasks()), time.time() - t0)
+        finally:
+            if not dry_run:
+                self.save()
+        return summary
+
+    def execute(self, node, todo):
+        tasks = {case: (key, outputs) for case, key, outputs in todo}
+        if not node.per_case:
+            node.run()
+            self.record(node, None, *tasks[None])
+        elif node.batch:
+            node.run([case for case, key, outputs in todo])
+            for case, key, outputs in todo:
+                self.record(node, case, key, outputs)
+        elif self.pools > 1 and len(todo) > 1:
+            # 每完成一个病例就记录，中断后已完成的病例不再重复计算
+            for case in get_executor(self.pools).imap(functools.partial(call_task, node.run), list(tasks),
+                                                      unordered=True, name=node.name):
+                self.record(node, case, *tasks[case])
+        else:
+            for case in tasks:
+                call_task(node.run, case)
+                self.record(node, case, *tasks[case])
@@ -2,6 +2,7 @@ import numpy as np
 import pandas as pd
 import os
 import nibabel as nib
+from utils.Get_patch import load_patch_record
 
 
 def add_patch(img, patch, s, p_size):
@@ -12,8 +13,72 @@ def add_patch(img, patch, s, p_size):
     return img
 
 
+def gaussian_weight(patch_size, sigma_scale=0.125):
+    '''
+    patch中心权重大、边缘权重小的高斯权重
+    :param patch_size: patch的大小
+    :param sigma_scale: sigma与patch大小之比
+    :return: float32 (p,p,p)，最大值为1
+    '''
+    x = np.arange(patch_size) - (patch_size - 1) / 2
+    g = np.exp(-x ** 2 / (2 * (sigma_scale * patch_size) ** 2))
+    w = g[:, np.newaxis, np.newaxis] * g[np.newaxis, :, np.newaxis] * g[np.newaxis, np.newaxis, :]
+    return (w / w.max()).astype(np.float32)
+
+
+class Patch_blender:
+    def __init__(self, shape, patch_size, mode='max', sigma_scale=0.125):
+        '''
+        把一批patch预测融合回3D图像，全部使用float32
+        :param shape: 3D图像大小
+        :param patch_size: patch的大小
+        :param mode: 重叠区域的融合方式 'max', 'mean' or 'gaussian'
+        :param sigma_scale: gaussian融合时sigma与patch大小之比
+        '''
+        if mode not in ['max', 'mean', 'gaussian']:
+            raise ValueError("value error,no setting")
+        self.patch_size = patch_size
+        self.mode = mode
+        self.value = np.zeros(shape, dtype=np.float32)
+        self.weight = None if mode == 'max' else np.zeros(shape, dtype=np.float32)
+        if mode == 'gaussian':
+            self.kernel = gaussian_weight(patch_size, sigma_scale)
+        else:
+            self.kernel = np.ones((patch_size,) * 3, dtype=np.float32)
+
+    def add(self, patch, loc):
+        '''
+        :param patch: 一批patch预测 (N,p,p,p)
+        :param loc: patch起点 (N,3)
+        '''
+        p = self.patch_size
+        patch = np.asarray(patch, dtype=np.float32).reshape(-1, p, p, p)
+        s = np.asarray(loc, dtype=np.int64).reshape(-1, 3)
+        e = s + p
+        # 连续的切片视图上原地计算比花式索引的scatter更快，而且没有临时数组
+        if self.mode == 'max':
+            for n in range(patch.shape[0]):
+                v = self.value[s[n, 0]:e[n, 0], s[n, 1]:e[n, 1], s[n, 2]:e[n, 2]]
+                np.maximum(v, patch[n], out=v)
+        else:
+            patch = patch * self.kernel
+            for n in range(patch.shape[0]):
+                v = self.value[s[n, 0]:e[n, 0], s[n, 1]:e[n, 1], s[n, 2]:e[n, 2]]
+                w = self.weight[s[n, 0]:e[n, 0], s[n, 1]:e[n, 1], s[n, 2]:e[n, 2]]
+                np.add(v, patch[n], out=v)
+                np.add(w, self.kernel, out=w)
+
+    def result(self):
+        if self.mode == 'max':
+            return self.value
+        img = np.zeros_like(self.value)
+        np.divide(self.value, self.weight, out=img, where=self.weight > 0)
+        return img
+
+
 class Recover_patch():
-    def __init__(self, patch_size, patch_pre, record_csv_path, save_pre_path, data_path,save_file_name='pre_label.nii.gz'):
+    def __init__(self, patch_size, patch_pre, record_csv_path, save_pre_path, data_path,save_file_name='pre_label.nii.gz',
+                 mode='max', slots=None):
         '''
         将patch整合为原来3D图像的大小
         :param patch_size: patch的大小
@@ -21,6 +86,8 @@ class Recover_patch():
         :param record_csv: 保存patch位置的文件目录 record_csv_path/id.csv
         :param save_pre_path: 保存生成3D图像的位置 data_path/img.nii.gz
         :param data_path: 原数据的目录
+        :param mode: 重叠区域的融合方式 'max', 'mean' or 'gaussian'
+        :param slots: utils.Executor.Volume_slots，保存的同时放入共享内存，供恢复裁剪直接读取
         '''
 
         self.patch_size = patch_size
@@ -29,28 +96,68 @@ class Recover_patch():
         self.save_pre_path = save_pre_path
         self.data_path = data_path
         self.save_file_name=save_file_name
+        self.mode = mode
+        self.slots = slots
+        # 直接接收推断结果时，每个病例的融合器以及还没有收到的patch个数
+        self.blender = dict()
+        self.record = dict()
+        self.remain = dict()
+
+    def new_blender(self, id):
+        # 只读取头文件得到图像大小
+        shape = nib.load(os.path.join(self.data_path, id, 'img.nii.gz')).shape
+        return Patch_blender(shape, self.patch_size, self.mode)
+
+    def save(self, id, img, affine):
+        img_bina = (img > 0.5).astype(np.float32)
+        os.makedirs(os.path.join(self.save_pre_path, id), exist_ok=True)
+        if self.slots is not None:
+            self.slots.save(os.path.join(self.save_pre_path, id, self.save_file_name), img_bina, affine)
+            return
+        nib.save(nib.Nifti1Image(img_bina, affine),os.path.join(self.save_pre_path, id, self.save_file_name))
 
     def run_recover(self, id):
 
         os.makedirs(self.save_pre_path, exist_ok=True)
         print('id:', id)
-        o_data = nib.load(os.path.join(self.data_path, id, 'img.nii.gz')).get_data()
-
-        img = np.zeros_like(o_data, dtype=np.float)
+        blender = self.new_blender(id)
         flag = 0
         p_affine = 0
-        record = pd.read_csv(os.path.join(self.record_csv_path, id + '.csv'), index_col=0)
+        name, loc = load_patch_record(self.record_csv_path, id)
 
-        for i in record.index:
+        for i, s in zip(name, loc):
             p_nii = nib.load(os.path.join(self.patch_pre, i))
             if flag == 0:
                 flag = 1
                 p_affine = p_nii.affine
-            s = (record.loc[i]['x'], record.loc[i]['y'], record.loc[i]['z'])
-            img = add_patch(img, p_nii.get_data(), s, self.patch_size)
-        img_bina = np.copy(img)
-        img_bina[img > 0.5] = 1
-        img_bina[img <= 0.5] = 0
-        os.makedirs(os.path.join(self.save_pre_path, id), exist_ok=True)
-        # nib.save(nib.Nifti1Image(img, p_affine),os.path.join(self.save_pre_path, id, self.patch_size))
-        nib.save(nib.Nifti1Image(img_bina, p_affine),os.path.join(self.save_pre_path, id, self.save_file_name))
+            blender.add(p_nii.get_data(), s)
+        self.save(id, blender.result(), p_affine)
+
+    def recover_array(self, id, patch, loc, affine):
+        '''
+        不经过pre_patch文件，直接由一个病例的全部patch预测得到3D图像
+        :param patch: (N,p,p,p)
+        :param loc: (N,3)
+        '''
+        blender = self.new_blender(id)
+        blender.add(patch, loc)
+        self.save(id, blender.result(), affine)
+
+    def add_batch(self, ID, pre, affine):
+        '''
+        接收推断循环中的一个batch，ID为patch名(id_index)，一个病例的patch全部收到后保存并释放内存
+        :param ID: patch名列表
+        :param pre: (B,p,p,p)
+        :param affine: (B,4,4)
+        '''
+        for n, name in enumerate(ID):
+            id, index = name.rsplit('_', 1)
+            if id not in self.blender:
+                self.record[id] = load_patch_record(self.record_csv_path, id)[1]
+                self.remain[id] = self.record[id].shape[0]
+                self.blender[id] = self.new_blender(id)
+            self.blender[id].add(pre[n], self.record[id][int(index)])
+            self.remain[id] -= 1
+            if self.remain[id] == 0:
+                self.save(id, self.blender.pop(id).result(), np.asarray(affine[n]))
+                self.record.pop(id)
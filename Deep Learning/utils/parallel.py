@@ -1,11 +1,12 @@
 import time
 from functools import partial
-from pathos.pools import ProcessPool, ThreadPool
 from tqdm import tqdm
+from utils.Executor import get_executor
 
 def parallel(func, *args, show=False, thread=False, **kwargs):
     """
-    并行计算
+    并行计算，使用常驻的进程/线程池(utils.Executor)，不再每次新建并清除pathos的池
+    进程池用pickle而不是pathos的dill传递函数，func需要是模块级函数或类实例的方法，不能是lambda或闭包(线程池不受限制)
     :param func: 函数，必选参数
     :param args: list/tuple/iterable,1个或多个函数的动态参数，必选参数
     :param show:bool,默认False,是否显示计算进度
@@ -15,26 +16,21 @@ def parallel(func, *args, show=False, thread=False, **kwargs):
     """
     # 冻结静态参数
     p_func = partial(func, **kwargs)
-    # 打开进程/线程池
-    pool = ThreadPool() if thread else ProcessPool()
+    executor = get_executor()
     try:
         if show:
             start = time.time()
             # imap方法
             with tqdm(total=len(args[0]), desc="计算进度") as t:  # 进度条设置
                 r = []
-                for i in pool.imap(p_func, *args):
+                for i in executor.imap(p_func, zip(*args), star=True, thread=thread):
                     r.append(i)
-                    t.set_postfix({'并行函数': func.__name__, "计算花销": "%ds" % (time.time() - start)})
+                    t.set_postfix({'并行函数': func.__name__, "计算花销": "%ds" % (time.time() - start),
+                                   '队列深度': executor.depth()})
                     t.update()
         else:
             # map方法
-            r = pool.map(p_func, *args)
+            r = executor.starmap(p_func, zip(*args), thread=thread)
         return r
     except Exception as e:
         print(e)
-    finally:
-        # 关闭池
-        pool.close()  # close the pool to any new jobs
-        pool.join()  # cleanup the closed worker processes
-        pool.clear()  # Remove server with matching state
\ No newline at end of file
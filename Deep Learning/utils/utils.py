@@ -1,8 +1,10 @@
 import pandas as pd
 import numpy as np
 import math
+import heapq
 import scipy.linalg as linalg
 from scipy.ndimage.interpolation import zoom
+from scipy.sparse import csr_matrix
 from monai.transforms import RandFlip, RandRotate
 
 
@@ -32,12 +34,60 @@ def get_line(x_start, x_end, dim=3):
     x_point = x_start[np.newaxis, :] + d_stride * v
     return x_point
 
+
+def get_lines(x_start, x_end):
+    '''
+    一次得到多条线段上的点，每条线段的点与get_line(x_start[i], x_end[i])相同
+    :param x_start: 起点 (E,3)
+    :param x_end: 终点 (E,3)
+    :return: 所有线段的点拼接在一起 (M,3)
+    '''
+    v = x_end - x_start
+    d = np.sqrt(np.sum(v ** 2, axis=1))
+    # 长度为0的线段只有起点
+    num = np.where(d == 0, 1, np.floor(d)).astype(np.int64)
+    v = v / np.where(d == 0, 1, d)[:, np.newaxis]
+    index = np.repeat(np.arange(d.shape[0]), num)
+    d_stride = np.arange(index.shape[0]) - np.repeat(np.cumsum(num) - num, num)
+    return x_start[index] + d_stride[:, np.newaxis] * v[index]
+
 # 旋转矩阵 欧拉角
 def rotate_mat(axis, radian):
     rot_matrix = linalg.expm(np.cross(np.eye(3), axis / linalg.norm(axis) * radian))
     return rot_matrix
 
 
+def rotate_mat_batch(axis, radian):
+    '''
+    用Rodrigues公式一次得到N个旋转矩阵，与逐个调用rotate_mat的结果相同
+    :param axis: 旋转轴 (N,3)
+    :param radian: 弧度 (N,)
+    :return: (N,3,3)
+    '''
+    axis = axis / np.linalg.norm(axis, axis=1, keepdims=True)
+    k = np.cross(np.eye(3)[np.newaxis, :, :], axis[:, np.newaxis, :])  # (N,3,3)
+    radian = np.asarray(radian).reshape(-1, 1, 1)
+    return np.eye(3) + np.sin(radian) * k + (1 - np.cos(radian)) * np.matmul(k, k)
+
+
+def slice_rotate_mat(v):
+    '''
+    把xy平面旋转到与法向量v垂直的旋转矩阵，旋转轴与角度的计算与extract_slice相同
+    :param v: 法向量 (N,3)
+    :return: (N,3,3)
+    '''
+    epsilon = 1e-12
+    h_v = np.array([0, 0, 1.0])
+    h_v[h_v == 0] = epsilon
+    v = v / np.linalg.norm(v, axis=1).reshape(-1, 1)
+    v[v == 0] = epsilon
+    hspVecXvec = np.cross(h_v, v) / np.linalg.norm(np.cross(h_v, v), axis=1).reshape(-1, 1)
+    acosineVal = np.arccos(np.dot(v, h_v))
+    hspVecXvec[np.isnan(hspVecXvec)] = epsilon
+    acosineVal[np.isnan(acosineVal)] = epsilon
+    return rotate_mat_batch(hspVecXvec, np.deg2rad(180 * acosineVal / math.pi))
+
+
 def loc_convert(loc, axis, radian):
     '''
 
@@ -119,59 +169,27 @@ def extract_slice(img, c, v, radius):
     '''
     N = v.shape[0]
 
-    epsilon = 1e-12
     x = np.arange(-radius, radius, 1)
     y = np.arange(-radius, radius, 1)
     X, Y = np.meshgrid(x, y)
     Z = np.zeros_like(X)
-    loc = np.array([X.flatten(), Y.flatten(), Z.flatten()])
-
-    hspInitialVector = np.array([0, 0, 1])
-    h_norm = np.linalg.norm(hspInitialVector)
-    h_v = hspInitialVector / h_norm
-    h_v[h_v == 0] = epsilon
-
-    v = v / np.linalg.norm(v, axis=1).reshape(N, 1)
-    v[v == 0] = epsilon
+    loc = np.array([X.flatten(), Y.flatten(), Z.flatten()], dtype=np.float64)
 
-    loc = loc_convert(loc, [0, 0, 1], 0)
-
-    hspVecXvec = np.cross(h_v, v) / np.linalg.norm(np.cross(h_v, v), axis=1).reshape(v.shape[0], 1)
-    h_v = h_v[np.newaxis, :]
-    acosineVal = np.arccos(np.dot(v, h_v.T))
-    hspVecXvec[np.isnan(hspVecXvec)] = epsilon
-    acosineVal[np.isnan(acosineVal)] = epsilon
-
-    loc_arr = []
-    for i in range(v.shape[0]):
-        loc_arr.append(loc_convert(loc, hspVecXvec[i, :], 180 * acosineVal[i, :] / math.pi))
-    loc_arr = np.array(loc_arr)
-
-    sub_loc = loc_arr + c[:, :, np.newaxis]
+    # 所有切片的旋转矩阵一次得到，所有像素的坐标一次旋转
+    sub_loc = np.matmul(slice_rotate_mat(v), loc) + c[:, :, np.newaxis]  # (N,3,4r^2)
     loc = np.round(sub_loc)
-
     loc = np.reshape(loc, (N, 3, X.shape[0], X.shape[1]))  # (N,3,64,64)
-    sliceInd = np.zeros((N, X.shape[0], X.shape[1]))
-    sliceInd[sliceInd == 0] = np.nan
-    slicer = np.copy(sliceInd)
-    for i in range(X.shape[0]):
-        for j in range(X.shape[1]):
-            ll = loc[:, :, i, j]
-            flag = (0 <= ll[:, 0]) & (ll[:, 0] < img.shape[0]) & (0 <= ll[:, 1]) & (ll[:, 1] < img.shape[1]) & (
-                    0 <= ll[:, 2]) & (ll[:, 2] < img.shape[2])
-            slicer[flag, i, j] = img[ll[flag, 0].astype(np.int), ll[flag, 1].astype(np.int), ll[flag, 2].astype(np.int)]
-
-    loc = np.transpose(loc, axes=(0, 2, 3, 1))  # (N,64,64,3)
-    loc[loc[:, :, :, 0] >= img.shape[0], 0] = 0
-    loc[loc[:, :, :, 1] >= img.shape[1], 1] = 0
-    loc[loc[:, :, :, 2] >= img.shape[2], 2] = 0
-    loc = np.transpose(loc, axes=(0, 3, 1, 2))  # (N,64,64,3)
-
-    slicer[np.isnan(slicer)] = 0
-
-    loc[loc < 0] = 0
-    loc = loc.astype(np.int)
-    return slicer, sub_loc, loc
+
+    # 越界的坐标分量置0后全部取值，再把越界的像素置0
+    shape = np.array(img.shape).reshape(1, 3, 1, 1)
+    ll = loc.astype(np.int64)
+    out = np.any((ll < 0) | (ll >= shape), axis=1)  # (N,64,64)
+    ll[ll >= shape] = 0
+    ll[ll < 0] = 0
+    slicer = img[ll[:, 0], ll[:, 1], ll[:, 2]].astype(np.float64, copy=False)
+    slicer[out] = 0
+    return slicer, sub_loc, ll
+
 
 def convert_np_graph(img):
     '''
@@ -182,40 +200,14 @@ def convert_np_graph(img):
     '''
     # 冠状动脉分段
 
-    # 找到中心线点的位置
-    x, y, z = np.where(img == 1)
-    point_nums = len(x)
-    loc = np.array([x, y, z]).T
-
-    # generate matrix of adj
-    adj = np.zeros((point_nums, point_nums))
-
-    # calculate adj
-    for i in range(point_nums):
-        for j in range(i + 1, point_nums):
-            d = np.sqrt(np.sum((loc[i, :] - loc[j, :]) ** 2))
-            adj[i, j] = d
-    #
-
-    adj = adj + adj.T
-    adj[adj > np.sqrt(3)] = 0
+    # 找到中心线点的位置与26邻域
+    graph = Centerline_graph(img)
+    loc = graph.loc
+    point_nums = graph.point_nums
 
     # find leaf
-    leaf = []
-    leaf_loc = []
-    for i in range(point_nums):
-        p = adj[i, :]
-        if np.sum(p != 0) == 1:
-            leaf.append(i)
-            leaf_loc.append(loc[i, :])
-
-
-    # adj[adj == 0] = float('inf')
-    for i in range(point_nums):
-        adj[i, i] = 0
-
-    leaf_loc = np.array(leaf_loc)
-    leaf = np.array(leaf)
+    leaf = graph.leaves()
+    leaf_loc = loc[leaf]
 
     z = leaf_loc[:, 2]
 
@@ -235,16 +227,18 @@ def convert_np_graph(img):
     path_list=[]
     index=root_index
     path_list.append(root_index)
+    visited = np.zeros(point_nums, dtype=bool)
+    visited[root_index] = True
     for i in range(point_nums):
-        neighbor=np.where(adj[index,:]!=0)[0]
-        # print(np.sum(adj[index,:]!=0))
-        # print(index)
-        for n in neighbor:
-            if n not in path_list:
-                # print(n)
+        last = index
+        for n in graph.neighbors(last):
+            if not visited[n]:
                 path_list.append(n)
+                visited[n] = True
                 index=n
-                continue
+        # 没有新的节点加入时后面的循环不会再改变路径
+        if index == last:
+            break
     path_dict[str(path_list[-1])]=path_list
     p_normal = np.gradient(loc[path_list, :], axis=0)
     node_dict['normal']=p_normal
@@ -254,6 +248,93 @@ def convert_np_graph(img):
     return path_dict, node_dict, normal_dict
 
 
+class Centerline_graph:
+    def __init__(self, img):
+        '''
+        中心线点的26邻域稀疏图，邻接矩阵为CSR格式，值为两点间的距离
+        :param img: 中心线图像，值为1的体素为中心线点
+        '''
+        x, y, z = np.where(img == 1)
+        self.loc = np.array([x, y, z]).T
+        self.point_nums = len(x)
+        n = self.point_nums
+
+        row, col, dist = [], [], []
+        if n > 0:
+            # 在外扩一个体素的外接框内做线性编号，np.where的结果已经按编号排好序，用二分查找得到邻居
+            start = self.loc.min(axis=0) - 1
+            shape = self.loc.max(axis=0) - start + 2
+            key = np.ravel_multi_index((self.loc - start).T, shape)
+            stride = np.array([shape[1] * shape[2], shape[2], 1])
+            for offset in np.array(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing='ij')).reshape(3, -1).T:
+                # 每对邻居只从线性编号较小的一侧查找一次
+                step = np.dot(offset, stride)
+                if step <= 0:
+                    continue
+                j = np.minimum(np.searchsorted(key, key + step), n - 1)
+                found = key[j] == key + step
+                row.append(np.nonzero(found)[0])
+                col.append(j[found])
+                dist.append(np.full(found.sum(), np.sqrt(np.sum(offset ** 2))))
+        row = np.concatenate(row) if row else np.zeros(0, dtype=np.int64)
+        col = np.concatenate(col) if col else np.zeros(0, dtype=np.int64)
+        dist = np.concatenate(dist) if dist else np.zeros(0)
+        self.adj = csr_matrix((np.concatenate([dist, dist]), (np.concatenate([row, col]), np.concatenate([col, row]))),
+                              shape=(n, n))
+        self.adj.sort_indices()
+        self.indices = self.adj.indices.astype(np.int64)
+        self.degree = np.diff(self.adj.indptr)
+
+    def neighbors(self, i):
+        # 按编号从小到大排列
+        return self.indices[self.adj.indptr[i]:self.adj.indptr[i + 1]]
+
+    def leaves(self):
+        return np.where(self.degree == 1)[0]
+
+    def branches(self):
+        return np.where(self.degree > 2)[0]
+
+    def shortest_path_tree(self, begin):
+        '''
+        以begin为起点的最短路径树，用二叉堆实现；距离相同时先处理编号小的节点，路径与dijkstra的结果相同
+        :param begin: 起点编号
+        :return: parent 每个节点在最短路径上的前一个节点，起点与不可达的节点为-1
+        '''
+        indptr = self.adj.indptr.tolist()
+        indices = self.indices.tolist()
+        weight = self.adj.data.tolist()
+        dist = [float('inf')] * self.point_nums
+        parent = [-1] * self.point_nums
+        collected = [False] * self.point_nums
+        dist[begin] = 0
+        heap = [(0, int(begin))]
+        while heap:
+            d, v = heapq.heappop(heap)
+            if collected[v]:
+                continue
+            collected[v] = True
+            for k in range(indptr[v], indptr[v + 1]):
+                i = indices[k]
+                if not collected[i] and d + weight[k] < dist[i]:
+                    dist[i] = d + weight[k]
+                    parent[i] = v
+                    heapq.heappush(heap, (dist[i], i))
+        return parent
+
+    def get_path(self, parent, begin, end):
+        '''
+        从最短路径树中读出begin到end的路径，end不可达时返回None
+        '''
+        path = [end]
+        while parent[path[-1]] != -1:
+            path.append(parent[path[-1]])
+        if path[-1] != begin:
+            return None
+        path.reverse()
+        return path
+
+
 class Transform:
     def __init__(self, flip=0.5, rotate=0.5):
         self.flip = flip